@@ -0,0 +1 @@
+# Benchmarks, run from the backend directory: python -m bench.<name> --help
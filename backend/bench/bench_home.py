@@ -0,0 +1,131 @@
+"""
+Benchmark of the /home query: per-guest recursive CTE (legacy) vs single set-based query
+
+Usage (from the backend directory, needs a MySQL/MariaDB user allowed to
+create the scratch database):
+
+    python -m bench.bench_home --guests 20 100 500 [--days 730]
+
+Each run first checks that both list the same days for every guest.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from bench.generator import Scale, add_connection_arguments, generate, use_scratch_database
+from config.database import db_config
+from dao.home_dao import home_dao
+
+LEGACY_PERSONS_QUERY = """
+    SELECT id, nome, cognome, visibile
+    FROM persona
+    WHERE visibile = 1
+"""
+
+LEGACY_ACTIVITIES_QUERY = """
+    WITH RECURSIVE date_range AS (
+        SELECT CURDATE() - INTERVAL 6 DAY as date_val
+        UNION ALL
+        SELECT date_val + INTERVAL 1 DAY
+        FROM date_range
+        WHERE date_val < CURDATE()
+    ),
+    weekdays AS (
+        SELECT date_val,
+            DAY(date_val) as giorno,
+            MONTH(date_val) as mese_int,
+            YEAR(date_val) as anno
+        FROM date_range
+        WHERE DAYOFWEEK(date_val) BETWEEN 2 AND 6
+    )
+    SELECT
+        w.giorno,
+        w.mese_int,
+        w.anno,
+        COALESCE(COUNT(pa.id_persona), 0) as activity_count
+    FROM weekdays w
+    LEFT JOIN partecipazione_attivita pa ON pa.id_persona = %s
+        AND pa.giorno = w.giorno
+        AND pa.mese_int = w.mese_int
+        AND pa.anno = w.anno
+    GROUP BY w.giorno, w.mese_int, w.anno
+    HAVING activity_count < 2
+    ORDER BY w.anno DESC, w.mese_int DESC, w.giorno DESC
+"""
+
+def legacy_get_home_data() -> list:
+    """The previous N+1 implementation, kept here as the baseline"""
+    connection = db_config.get_connection()
+    cursor = connection.cursor()
+    try:
+        cursor.execute(LEGACY_PERSONS_QUERY)
+        home_data = []
+        for guest_id, nome, cognome, visibile in cursor.fetchall():
+            cursor.execute(LEGACY_ACTIVITIES_QUERY, (guest_id,))
+            home_data.append({
+                'id': guest_id,
+                'name': nome,
+                'surname': cognome,
+                'visible': visibile,
+                'activities': [{'day': row[0], 'month_int': row[1]} for row in cursor.fetchall()]
+            })
+        return home_data
+    finally:
+        cursor.close()
+        connection.close()
+
+def seed(guests: int, days: int = 730, gap_rate: float = 0.05) -> None:
+    """Generate guests with a morning and an afternoon activity on most weekdays (live semester only)"""
+    generate(Scale(guests=guests, semesters=0, days=days, gap_rate=gap_rate, seed=guests))
+
+def missing_days(home_data: list) -> dict:
+    """guest id: the (day, month) pairs listed as missing"""
+    return {guest['id']: sorted((day['day'], day['month_int']) for day in guest['activities'])
+            for guest in home_data}
+
+def measure(fn, repeat: int, setup=None) -> dict:
+    """Run fn repeat times (after one warm-up) and return latency percentiles in ms.
+
+    setup, if given, runs untimed before every call (e.g. to empty a cache).
+    """
+    fn()
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'p50_ms': round(statistics.median(samples), 2),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_connection_arguments(parser)
+    parser.add_argument('--guests', type=int, nargs='+', default=[20, 100, 500])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--days', type=int, default=730,
+                        help='days of activity history per guest (the new query must not read them all)')
+    args = parser.parse_args()
+
+    use_scratch_database(args)
+    results = []
+    for guests in args.guests:
+        seed(guests, args.days)
+        if missing_days(legacy_get_home_data()) != missing_days(home_dao.get_home_data()):
+            sys.exit(f"{guests} guests: the set-based query lists other days than the legacy one")
+        results.append({
+            'guests': guests,
+            'days': args.days,
+            'legacy': measure(legacy_get_home_data, args.repeat),
+            'set_based': measure(home_dao.get_home_data, args.repeat),
+        })
+        print(json.dumps(results[-1]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Benchmark of the per-guest record reads before and after the migrations (and partitioning)
+
+Generates the dataset without migrating it, then for every record table
+runs EXPLAIN and times the read the DAOs used to send (id_semestre IS NULL
+or = %s, ORDER BY anno, mese_int, giorno) for the guest with the most rows,
+in the live and a closed semester; applies the migrations and does the same
+with the read they send now (semestre_chiave = %s ORDER BY data, on the
+(id_persona, semestre_chiave, data) index). With --partition the tables are
+then partitioned by semester and measured a third time.
+
+With --copy-of the generated rows are replaced by those of another database
+on the same server (a copy of production), copied into the tables as the
+application first created them, and the closed semester measured is the
+latest one. Usage (from the backend directory):
+
+    python -m bench.bench_records --guests 30 --semesters 4 --repeat 50 [--partition]
+    python -m bench.bench_records --copy-of cdd_legrigne_copy --repeat 50
+"""
+import argparse
+import json
+from dataclasses import asdict
+
+from bench.bench_home import measure
+from bench.generator import (
+    TABLES, add_connection_arguments, add_scale_arguments, generate, scale_from_args, use_scratch_database
+)
+from config import migrations, partitioning
+from config.database import db_config
+from dao.appreciations_summary_dao import semester_key
+
+def copy_rows(source: str) -> dict:
+    """Replace the rows of every generated table with those of source, return the number per table.
+
+    Only the columns the tables had before the migrations are copied: the
+    migrations then derive the others as they would in production.
+    """
+    connection = db_config.get_connection()
+    cursor = connection.cursor()
+    counts = {}
+    try:
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+        for table in TABLES:
+            cursor.execute("""
+                SELECT COLUMN_NAME FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+                ORDER BY ORDINAL_POSITION
+            """, (db_config.database, table))
+            column_list = ', '.join(f"`{row[0]}`" for row in cursor.fetchall())
+            cursor.execute(f"DELETE FROM `{table}`")
+            cursor.execute(f"INSERT INTO `{table}` ({column_list}) SELECT {column_list} FROM `{source}`.`{table}`")
+            counts[table] = cursor.rowcount
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        raise e
+    finally:
+        cursor.close()
+        connection.close()
+    return counts
+
+def latest_semester() -> int:
+    connection = db_config.get_connection()
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT MAX(id) FROM semestre")
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        connection.close()
+
+def legacy_read(table: str, person_id: int, semester) -> tuple:
+    semester_constraint = "= %s" if semester is not None else "IS NULL"
+    query = (f"SELECT * FROM `{table}` WHERE id_persona = %s AND id_semestre {semester_constraint} "
+             "ORDER BY anno DESC, mese_int DESC, giorno DESC")
+    return query, (person_id,) if semester is None else (person_id, semester)
+
+def indexed_read(table: str, person_id: int, semester) -> tuple:
+    query = f"SELECT * FROM `{table}` WHERE id_persona = %s AND semestre_chiave = %s ORDER BY data DESC"
+    return query, (person_id, semester_key(semester))
+
+def busiest_guest(cursor, table: str) -> int:
+    cursor.execute(f"SELECT id_persona FROM `{table}` GROUP BY id_persona ORDER BY COUNT(*) DESC LIMIT 1")
+    row = cursor.fetchone()
+    return row[0] if row else 1
+
+def explain(cursor, query: str, params: tuple) -> list:
+    cursor.execute("EXPLAIN " + query, params)
+    columns = [column[0] for column in cursor.description]
+    return [
+        {name: row[columns.index(name)] for name in ('partitions', 'type', 'key', 'rows', 'Extra') if name in columns}
+        for row in cursor.fetchall()
+    ]
+
+def run(read_query, semesters: dict, repeat: int) -> dict:
+    connection = db_config.get_connection()
+    cursor = connection.cursor()
+    results = {}
+    try:
+        for table in migrations.RECORD_TABLES:
+            person_id = busiest_guest(cursor, table)
+            for label, semester in semesters.items():
+                query, params = read_query(table, person_id, semester)
+
+                def read():
+                    cursor.execute(query, params)
+                    cursor.fetchall()
+                results[f"{table} {label}"] = {
+                    'plan': explain(cursor, query, params),
+                    **measure(read, repeat),
+                }
+    finally:
+        cursor.close()
+        connection.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_connection_arguments(parser)
+    add_scale_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--partition', action='store_true', help='also measure the tables partitioned by semester')
+    parser.add_argument('--copy-of', help='database on the same server whose rows replace the generated ones')
+    args = parser.parse_args()
+
+    use_scratch_database(args)
+    scale = scale_from_args(args)
+    rows = generate(scale, migrate=False)
+    semesters = {'live': None}
+    if args.copy_of:
+        rows = copy_rows(args.copy_of)
+        closed = latest_semester()
+        if closed is not None:
+            semesters['closed'] = closed
+    elif scale.semesters:
+        semesters['closed'] = 1
+
+    report = {
+        'scale': asdict(scale) if not args.copy_of else {'copy_of': args.copy_of},
+        'rows': rows,
+        'before': run(legacy_read, semesters, args.repeat),
+    }
+    migrations.apply()
+    report['after'] = run(indexed_read, semesters, args.repeat)
+    if args.partition:
+        partitioning.enable(drop_foreign_keys=True)
+        report['partitioned'] = run(indexed_read, semesters, args.repeat)
+    for stage in ('after', 'partitioned'):
+        for name, result in report.get(stage, {}).items():
+            if report['before'][name]['p50_ms']:
+                result['p50_vs_before'] = round(result['p50_ms'] / report['before'][name]['p50_ms'], 3)
+    print(json.dumps(report, indent=2, default=str))
+
+if __name__ == '__main__':
+    main()
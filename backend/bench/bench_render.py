@@ -0,0 +1,132 @@
+"""
+Micro-benchmark of chart rendering: pyplot per call (legacy) vs charts.rendering templates
+
+Needs no database. Usage (from the backend directory):
+
+    python -m bench.bench_render --points 30 180 720 --repeat 20 --threads 4
+"""
+
+import argparse
+import datetime
+import io
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import matplotlib
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+
+from bench.bench_home import measure
+from charts import rendering
+
+matplotlib.use('Agg')
+
+def legacy_line_plot(dates, series, ylabel, ylim=None, integer_y=False) -> bytes:
+    """The servlets' former pyplot code, shared by the three line charts"""
+    plt.figure(figsize=(10, 6))
+    for values, label, marker, color in series:
+        plt.plot(dates, values, marker=marker, label=label, linewidth=2, color=color)
+    plt.xlabel('Data')
+    plt.ylabel(ylabel)
+    plt.legend()
+    plt.grid(True, alpha=0.3)
+    if integer_y:
+        plt.gca().yaxis.set_major_locator(plt.MaxNLocator(integer=True))
+    if ylim:
+        plt.ylim(*ylim)
+    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    img_buffer = io.BytesIO()
+    plt.savefig(img_buffer, format='png')
+    plt.close()
+    return img_buffer.getvalue()
+
+def legacy_appreciation_plot(labels, adesione_values, partecipazione_values, title) -> bytes:
+    """The appreciations servlet's former pyplot code"""
+    plt.figure(figsize=(10, 6))
+    x = range(len(labels))
+    width = 0.35
+    plt.bar([i - width/2 for i in x], adesione_values, width, label='Adesione', color='#005073')
+    plt.bar([i + width/2 for i in x], partecipazione_values, width, label='Partecipazione', color='#60A5FA')
+    plt.xticks(x, labels)
+    plt.xlabel('Attività')
+    plt.ylabel('%')
+    plt.title(title)
+    plt.legend()
+    plt.grid(True, alpha=0.3)
+    plt.gca().yaxis.set_major_locator(plt.MaxNLocator(integer=True))
+    plt.ylim(0, 104)
+    plt.tight_layout()
+    img_buf = io.BytesIO()
+    plt.savefig(img_buf, format='png')
+    plt.close()
+    return img_buf.getvalue()
+
+def make_cases(points: int) -> dict:
+    """Synthetic inputs for every chart kind, as (legacy, engine) render callables"""
+    start = datetime.datetime(2024, 1, 1)
+    dates = [start + datetime.timedelta(hours=12 * i) for i in range(points)]
+    weights = [70 + random.uniform(-3, 3) for _ in dates]
+    min_pressures = [random.randint(60, 90) for _ in dates]
+    max_pressures = [random.randint(110, 150) for _ in dates]
+    moods = [random.randint(1, 8) for _ in dates]
+    communications = [random.randint(1, 8) for _ in dates]
+    labels = [f'ATT{i}' for i in range(12)]
+    adesione = [random.randint(0, 100) for _ in labels]
+    partecipazione = [random.randint(0, 100) for _ in labels]
+
+    return {
+        'weight': (
+            lambda: legacy_line_plot(dates, [(weights, 'Peso', 'o', '#005073')], 'Peso (kg)'),
+            lambda: rendering.render_weight(dates, weights),
+        ),
+        'vitals': (
+            lambda: legacy_line_plot(dates, [(max_pressures, 'Massima', 's', '#60A5FA'),
+                                             (min_pressures, 'Minima', 'o', '#005073')], 'Valore (mmHg)'),
+            lambda: rendering.render_vitals(dates, min_pressures, max_pressures),
+        ),
+        'activities': (
+            lambda: legacy_line_plot(dates, [(moods, 'Umore', 'o', '#005073'),
+                                             (communications, 'Comunicazione', 's', '#60A5FA')],
+                                     'Indice', ylim=(0.5, 8.5), integer_y=True),
+            lambda: rendering.render_activities(dates, moods, communications),
+        ),
+        'appreciation': (
+            lambda: legacy_appreciation_plot(labels, adesione, partecipazione, 'Mario Rossi - Gennaio'),
+            lambda: rendering.render_appreciation(labels, adesione, partecipazione, 'Mario Rossi - Gennaio'),
+        ),
+    }
+
+def throughput(fn, threads: int, renders: int) -> float:
+    """Charts per second when rendering from several threads at once"""
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        # Warm up every thread's templates before timing
+        list(executor.map(lambda _: fn(), range(threads)))
+        start = time.perf_counter()
+        list(executor.map(lambda _: fn(), range(renders)))
+        return round(renders / (time.perf_counter() - start), 1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--points', type=int, nargs='+', default=[30, 180, 720])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=4,
+                        help='threads for the engine throughput run (pyplot is not thread-safe)')
+    args = parser.parse_args()
+
+    random.seed(0)
+    for points in args.points:
+        for kind, (legacy, engine) in make_cases(points).items():
+            print(json.dumps({
+                'kind': kind,
+                'points': points,
+                'legacy': measure(legacy, args.repeat),
+                'engine': measure(engine, args.repeat),
+                'engine_charts_per_s': throughput(engine, args.threads, args.repeat * args.threads),
+            }))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Benchmark suite: every DAO read method and every chart endpoint on a synthetic dataset
+
+Generates the dataset with bench.generator (unless --reuse), then times each
+DAO read method inside a request context, for the live semester and a closed
+one, and each chart endpoint through the Flask test client: JSON with the
+plot URL, JSON with the embedded base64 plot, the PNG with an empty and with
+a warm plot cache, the raw series, and a whole appreciations graph session.
+Prints (and with --output saves) p50/p95 JSON; --compare adds the p50 ratio
+to a previous run's file. Usage (from the backend directory):
+
+    python -m bench.bench_suite --guests 30 --semesters 2 --output after.json --compare before.json
+"""
+import argparse
+import datetime
+import json
+import shutil
+import sys
+import tempfile
+from dataclasses import asdict
+
+from flask import session
+
+from bench.bench_home import measure
+from bench.generator import (
+    add_connection_arguments, add_scale_arguments, generate, scale_from_args, use_scratch_database
+)
+from charts.plot_cache import plot_cache
+from dao.account_dao import account_dao
+from dao.activities_dao import activities_dao
+from dao.home_dao import home_dao
+from dao.hydration_dao import hydration_dao
+from dao.logbook_dao import logbook_dao
+from dao.problembehavior_dao import problem_behavior_dao
+from dao.seizure_dao import seizure_dao
+from dao.semester_dao import semester_dao
+from dao.shower_dao import shower_dao
+from dao.target_dao import target_dao
+from dao.toilet_dao import toilet_dao
+from dao.vital_dao import vital_dao
+from dao.weight_dao import weight_dao
+from main import create_app
+
+PERSON_ID = 1
+MONTH_OFFSET_DAYS = 30  # month of the per-month queries: the one of 30 days ago
+
+def dao_reads(person_id: int, month: int) -> dict:
+    """name: callable of every DAO read method, run inside a request context"""
+    return {
+        'home.get_home_data': home_dao.get_home_data,
+        'activities.get_activities': lambda: activities_dao.get_activities(person_id, None),
+        'activities.get_activities(month)': lambda: activities_dao.get_activities(person_id, month),
+        'activities.get_activity_series': lambda: activities_dao.get_activity_series(person_id, None),
+        'activities.get_appreciations': lambda: activities_dao.get_appreciations(),
+        'activities.get_appreciations(month)': lambda: activities_dao.get_appreciations(month=month),
+        'activities.get_appreciations_series': lambda: activities_dao.get_appreciations_series(),
+        'activities.get_activities_list': activities_dao.get_activities_list,
+        'logbook.get_logbook_entries': lambda: logbook_dao.get_logbook_entries(person_id),
+        'target.get_target_entries': lambda: target_dao.get_target_entries(person_id),
+        'toilet.get_toilet_entries': lambda: toilet_dao.get_toilet_entries(person_id),
+        'shower.get_shower_entries': lambda: shower_dao.get_shower_entries(person_id),
+        'hydration.get_hydration_entries': lambda: hydration_dao.get_hydration_entries(person_id),
+        'seizure.get_seizures': lambda: seizure_dao.get_seizures(person_id),
+        'problembehavior.get_problem_behaviors': lambda: problem_behavior_dao.get_problem_behaviors(person_id),
+        'vital.get_vital_measurements': lambda: vital_dao.get_vital_measurements(person_id),
+        'vital.get_vital_series': lambda: vital_dao.get_vital_series(person_id),
+        'weight.get_weight_measurements': lambda: weight_dao.get_weight_measurements(person_id),
+        'weight.get_weight_series': lambda: weight_dao.get_weight_series(person_id),
+        'semester.get_semesters': semester_dao.get_semesters,
+        'account.get_all_account_infos': account_dao.get_all_account_infos,
+    }
+
+def chart_endpoints(person_id: int) -> list:
+    """(name, url, cold): cold endpoints are timed with an empty plot cache"""
+    endpoints = []
+    for chart in ('vitals', 'weights', 'activities'):
+        url = f"/{chart}?person_id={person_id}"
+        endpoints += [
+            (f"{chart} json", url, False),
+            (f"{chart} json+base64 cold", f"{url}&plot=base64", True),
+            (f"{chart} json+base64 warm", f"{url}&plot=base64", False),
+            (f"{chart}/plot.png cold", f"/{chart}/plot.png?person_id={person_id}", True),
+            (f"{chart}/plot.png warm", f"/{chart}/plot.png?person_id={person_id}", False),
+            (f"{chart} series", f"{url}&format=series", False),
+        ]
+    endpoints.append(('appreciations series', '/appreciations?format=series', False))
+    return endpoints
+
+def empty_plot_cache() -> None:
+    shutil.rmtree(plot_cache.directory, ignore_errors=True)
+
+def login(client, semester) -> None:
+    with client.session_transaction() as client_session:
+        client_session['user_id'] = 1
+        client_session['name'] = 'Operatore1'
+        client_session['surname'] = 'Bench1'
+        client_session['permissions'] = 20
+        client_session['semester'] = semester
+
+def get_ok(client, url: str):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise Exception(f"GET {url} answered {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return response
+
+def appreciation_session(client) -> None:
+    """Open an appreciations page and read the graph stream until every graph is rendered"""
+    session_id = get_ok(client, '/appreciations').get_json()['session_id']
+    while True:
+        stream = get_ok(client, f"/appreciations/stream/{session_id}").get_data(as_text=True)
+        if 'event: done' in stream:
+            return
+
+def run(app, semesters: dict, repeat: int) -> list:
+    month = (datetime.date.today() - datetime.timedelta(days=MONTH_OFFSET_DAYS)).month
+    results = []
+
+    def record(kind: str, name: str, semester_label: str, timings: dict) -> None:
+        results.append({'kind': kind, 'name': name, 'semester': semester_label, **timings})
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    for semester_label, semester in semesters.items():
+        for name, read in dao_reads(PERSON_ID, month).items():
+            def call():
+                with app.test_request_context():
+                    session['user_id'] = 1
+                    session['semester'] = semester
+                    read()
+            record('dao', name, semester_label, measure(call, repeat))
+
+        client = app.test_client()
+        login(client, semester)
+        for name, url, cold in chart_endpoints(PERSON_ID):
+            record('endpoint', name, semester_label, measure(
+                lambda: get_ok(client, url), repeat, setup=empty_plot_cache if cold else None
+            ))
+        record('endpoint', 'appreciations graph session cold', semester_label, measure(
+            lambda: appreciation_session(client), max(1, repeat // 5), setup=empty_plot_cache
+        ))
+    return results
+
+def compare(results: list, previous_path: str) -> None:
+    """Add the p50 ratio (this run / previous run) to every result present in both"""
+    with open(previous_path) as f:
+        previous = {(r['kind'], r['name'], r['semester']): r for r in json.load(f)['results']}
+    for result in results:
+        before = previous.get((result['kind'], result['name'], result['semester']))
+        if before and before['p50_ms']:
+            result['p50_vs_previous'] = round(result['p50_ms'] / before['p50_ms'], 3)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_connection_arguments(parser)
+    add_scale_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--reuse', action='store_true', help='keep the data already in the scratch database')
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--compare', help='results file of a previous run')
+    args = parser.parse_args()
+
+    use_scratch_database(args)
+    scale = scale_from_args(args)
+    rows = None if args.reuse else generate(scale)
+
+    # The benchmark must neither read nor fill the server's plot cache
+    plot_cache.directory = tempfile.mkdtemp(prefix='cdd_bench_plots_')
+    app = create_app()
+    semesters = {'live': None}
+    if scale.semesters:
+        semesters['closed'] = 1
+    try:
+        results = run(app, semesters, args.repeat)
+    finally:
+        empty_plot_cache()
+
+    if args.compare:
+        compare(results, args.compare)
+    report = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'scale': asdict(scale),
+        'rows': rows,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report))
+
+if __name__ == '__main__':
+    main()
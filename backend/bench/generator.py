@@ -0,0 +1,462 @@
+"""
+Synthetic care-center dataset at a configurable scale
+
+Creates every table the DAOs read, in the scratch database db_config points
+at, and fills them with a deterministic dataset: N guests followed for M
+closed semesters plus the live one (id_semestre NULL, ending today), with a
+morning and an afternoon activity on most weekdays, toilet entries twice a
+day, weekly showers and blood pressure, monthly weights, occasional logbook,
+targeted activity, seizure and problem behavior entries, operator accounts
+signing them, and the appreciations summary table. Usage (from the backend
+directory):
+
+    python -m bench.generator --guests 30 --semesters 2 --days 130
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import random
+from dataclasses import asdict, dataclass
+
+from config import migrations
+from config.database import db_config
+from config.query_cache import query_cache
+from dao.appreciations_summary_dao import appreciations_summary_dao
+from info import mesi_ita
+
+# Every generated operator logs in with this password (account.password is its SHA-256)
+OPERATOR_PASSWORD = 'bench'
+INSERT_BATCH = 5000
+
+ACTIVITIES = [
+    ('Arte', 'ART'), ('Cucina', 'CUC'), ('Musica', 'MUS'), ('Piscina', 'PIS'),
+    ('Giardinaggio', 'GIA'), ('Passeggiata', 'PAS'), ('Lettura', 'LET'),
+    ('Ginnastica', 'GIN'), ('Teatro', 'TEA'), ('Informatica', 'INF'),
+]
+
+PROBLEMS = [
+    ('Aggressività verso altri', 'etero'), ('Autolesionismo', 'auto'),
+    ('Distruzione di oggetti', 'oggetti'), ('Urla', 'verbale'),
+    ('Fuga', 'altro'), ('Rifiuto', 'altro'),
+]
+
+TABLES = {
+    'persona': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        nome VARCHAR(50) NOT NULL,
+        cognome VARCHAR(50) NOT NULL,
+        visibile TINYINT(1) NOT NULL DEFAULT 1
+    """,
+    'account': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        nome VARCHAR(50) NOT NULL,
+        cognome VARCHAR(50) NOT NULL,
+        password CHAR(64) NOT NULL,
+        privilegi INT NOT NULL DEFAULT 0
+    """,
+    'semestre': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        iniziale VARCHAR(30),
+        finale VARCHAR(30)
+    """,
+    'attivita': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        nome_attivita VARCHAR(100) NOT NULL,
+        abbreviazione VARCHAR(10) NOT NULL
+    """,
+    'problema': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        nome VARCHAR(100) NOT NULL,
+        classe VARCHAR(50)
+    """,
+    'partecipazione_attivita': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_persona INT NOT NULL,
+        giorno INT NOT NULL,
+        mese_int INT NOT NULL,
+        anno INT NOT NULL,
+        mattino TINYINT(1),
+        attivita INT,
+        adesione INT,
+        partecipazione INT,
+        umore INT,
+        comunicazione INT,
+        comportamento_problematico TINYINT(1),
+        id_semestre INT,
+        KEY (id_persona)
+    """,
+    'diario': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_persona INT NOT NULL,
+        giorno INT NOT NULL,
+        mese_int INT NOT NULL,
+        anno INT NOT NULL,
+        evento TEXT,
+        intervento TEXT,
+        firma INT,
+        id_semestre INT,
+        KEY (id_persona)
+    """,
+    'attivita_mirata': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_persona INT NOT NULL,
+        giorno INT NOT NULL,
+        mese_int INT NOT NULL,
+        anno INT NOT NULL,
+        evento TEXT,
+        intervento TEXT,
+        firma INT,
+        id_semestre INT,
+        KEY (id_persona)
+    """,
+    'bagno': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_persona INT NOT NULL,
+        giorno INT NOT NULL,
+        mese_int INT NOT NULL,
+        anno INT NOT NULL,
+        mattino TINYINT(1),
+        urina TINYINT(1),
+        feci TINYINT(1),
+        pannolone INT,
+        arrossamento TINYINT(1),
+        ciclo TINYINT(1),
+        cintura TINYINT(1),
+        firma INT,
+        id_semestre INT,
+        KEY (id_persona)
+    """,
+    'doccia': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_persona INT NOT NULL,
+        giorno INT NOT NULL,
+        mese_int INT NOT NULL,
+        anno INT NOT NULL,
+        fatto TINYINT(1),
+        note TEXT,
+        firma INT,
+        id_semestre INT,
+        KEY (id_persona)
+    """,
+    'idratazione': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_persona INT NOT NULL,
+        giorno INT NOT NULL,
+        mese_int INT NOT NULL,
+        anno INT NOT NULL,
+        fatto TINYINT(1),
+        note TEXT,
+        firma INT,
+        id_semestre INT,
+        KEY (id_persona)
+    """,
+    'pressione': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_persona INT NOT NULL,
+        giorno INT NOT NULL,
+        mese_int INT NOT NULL,
+        anno INT NOT NULL,
+        minima DECIMAL(5,1),
+        massima DECIMAL(5,1),
+        temperatura DECIMAL(4,1),
+        frequenza INT,
+        saturazione INT,
+        id_semestre INT,
+        KEY (id_persona)
+    """,
+    'peso': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_persona INT NOT NULL,
+        giorno INT NOT NULL,
+        mese_int INT NOT NULL,
+        anno INT NOT NULL,
+        peso DECIMAL(5,1),
+        id_semestre INT,
+        KEY (id_persona)
+    """,
+    'crisi_epilettica': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_persona INT NOT NULL,
+        giorno INT NOT NULL,
+        mese_int INT NOT NULL,
+        anno INT NOT NULL,
+        ora TIME,
+        durata INT,
+        note TEXT,
+        firma INT,
+        id_semestre INT,
+        KEY (id_persona)
+    """,
+    'comportamento_problema': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_persona INT NOT NULL,
+        giorno INT NOT NULL,
+        mese_int INT NOT NULL,
+        anno INT NOT NULL,
+        intensita INT,
+        durata INT,
+        causa TEXT,
+        contenimento TEXT,
+        firma INT,
+        id_semestre INT,
+        KEY (id_persona)
+    """,
+    'evento_comportamento': """
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        id_evento INT NOT NULL,
+        id_comportamento INT NOT NULL,
+        KEY (id_evento)
+    """,
+}
+
+@dataclass
+class Scale:
+    """Size of the generated dataset"""
+    guests: int = 30
+    semesters: int = 2        # closed semesters before the live one
+    days: int = 130           # calendar days per semester
+    operators: int = 8
+    gap_rate: float = 0.05    # share of activity slots left empty (shown on /home)
+    seed: int = 1
+
+def semester_days(scale: Scale, today: datetime.date = None):
+    """(date, id_semestre) of every calendar day, oldest first; the live semester ends today"""
+    today = today or datetime.date.today()
+    total = scale.days * (scale.semesters + 1)
+    for offset in range(total - 1, -1, -1):
+        index = (total - 1 - offset) // scale.days
+        yield today - datetime.timedelta(days=offset), (index + 1 if index < scale.semesters else None)
+
+def _insert(cursor, table: str, columns: tuple, rows) -> int:
+    """Insert rows in batches, return how many"""
+    query = f"""
+        INSERT INTO {table} ({', '.join(columns)})
+        VALUES ({', '.join(['%s'] * len(columns))})
+    """
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH:
+            cursor.executemany(query, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        cursor.executemany(query, batch)
+        count += len(batch)
+    return count
+
+def _semester_label(day: datetime.date) -> str:
+    return f"{day.day} {mesi_ita[day.month - 1]} {day.year}"
+
+def generate(scale: Scale, migrate: bool = True) -> dict:
+    """Recreate every table and fill it, return the number of rows per table.
+
+    The tables are created as the application first created them; migrate
+    then brings them to the current schema with config.migrations.
+    """
+    rng = random.Random(scale.seed)
+    days = list(semester_days(scale))
+    weekdays = [(day, semester) for day, semester in days if day.weekday() < 5]
+    guests = range(1, scale.guests + 1)
+    operators = range(1, scale.operators + 1)
+    counts = {}
+
+    def signed():
+        return rng.choice(operators)
+
+    connection = db_config.get_connection()
+    cursor = connection.cursor()
+    try:
+        for table in reversed(list(TABLES)):
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        for table in (migrations.MIGRATIONS_TABLE, migrations.ROLLOVER_TABLE, migrations.JOBS_TABLE):
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        for table, columns in TABLES.items():
+            cursor.execute(f"CREATE TABLE {table} ({columns})")
+
+        counts['persona'] = _insert(cursor, 'persona', ('nome', 'cognome', 'visibile'), (
+            (f"Nome{i}", f"Cognome{i}", 0 if i % 20 == 0 else 1) for i in guests
+        ))
+        password = hashlib.sha256(OPERATOR_PASSWORD.encode('utf-8')).hexdigest()
+        counts['account'] = _insert(cursor, 'account', ('nome', 'cognome', 'password', 'privilegi'), (
+            (f"Operatore{i}", f"Bench{i}", password, 20 if i == 1 else 0) for i in operators
+        ))
+        counts['semestre'] = _insert(cursor, 'semestre', ('iniziale', 'finale'), (
+            (_semester_label(days[k * scale.days][0]), _semester_label(days[(k + 1) * scale.days - 1][0]))
+            for k in range(scale.semesters)
+        ))
+        counts['attivita'] = _insert(cursor, 'attivita', ('nome_attivita', 'abbreviazione'), ACTIVITIES)
+        counts['problema'] = _insert(cursor, 'problema', ('nome', 'classe'), PROBLEMS)
+
+        def date_columns(day):
+            return day.day, day.month, day.year
+
+        def activities():
+            last_week = days[-1][0] - datetime.timedelta(days=7)
+            for day, semester in weekdays:
+                for guest in guests:
+                    for morning in (1, 0):
+                        if day > last_week and rng.random() < scale.gap_rate:
+                            continue
+                        if rng.random() < 0.04:
+                            # Absence: no activity, no scores
+                            yield (guest, *date_columns(day), morning, None, None, None, None, None, 0, semester)
+                            continue
+                        yield (guest, *date_columns(day), morning, rng.randint(1, len(ACTIVITIES)),
+                               rng.randint(1, 4), rng.randint(1, 4), rng.randint(1, 8), rng.randint(1, 8),
+                               1 if rng.random() < 0.03 else 0, semester)
+        counts['partecipazione_attivita'] = _insert(cursor, 'partecipazione_attivita', (
+            'id_persona', 'giorno', 'mese_int', 'anno', 'mattino', 'attivita', 'adesione',
+            'partecipazione', 'umore', 'comunicazione', 'comportamento_problematico', 'id_semestre'
+        ), activities())
+
+        def notes(table, rate):
+            for day, semester in weekdays:
+                for guest in guests:
+                    if rng.random() < rate:
+                        yield (guest, *date_columns(day), f"{table} {guest} {day}: evento registrato",
+                               "Intervento dell'operatore, situazione rientrata", signed(), semester)
+        for table, rate in (('diario', 0.3), ('attivita_mirata', 0.15)):
+            counts[table] = _insert(cursor, table, (
+                'id_persona', 'giorno', 'mese_int', 'anno', 'evento', 'intervento', 'firma', 'id_semestre'
+            ), notes(table, rate))
+
+        def toilet():
+            for day, semester in weekdays:
+                for guest in guests:
+                    for morning in (1, 0):
+                        yield (guest, *date_columns(day), morning, int(rng.random() < 0.8),
+                               int(rng.random() < 0.3), rng.choice((0, 1, None)), int(rng.random() < 0.05),
+                               int(guest % 2 == 0 and day.day <= 5), int(guest % 7 == 0), signed(), semester)
+        counts['bagno'] = _insert(cursor, 'bagno', (
+            'id_persona', 'giorno', 'mese_int', 'anno', 'mattino', 'urina', 'feci', 'pannolone',
+            'arrossamento', 'ciclo', 'cintura', 'firma', 'id_semestre'
+        ), toilet())
+
+        def care(weekday, rate):
+            for day, semester in weekdays:
+                for guest in guests:
+                    if (weekday is None or day.weekday() == weekday) and rng.random() < rate:
+                        yield (guest, *date_columns(day), int(rng.random() < 0.95), None, signed(), semester)
+        for table, weekday, rate in (('doccia', 2, 0.9), ('idratazione', None, 0.7)):
+            counts[table] = _insert(cursor, table, (
+                'id_persona', 'giorno', 'mese_int', 'anno', 'fatto', 'note', 'firma', 'id_semestre'
+            ), care(weekday, rate))
+
+        def vitals():
+            for day, semester in weekdays:
+                if day.weekday() != 0:
+                    continue
+                for guest in guests:
+                    high = rng.gauss(125, 10)
+                    yield (guest, *date_columns(day), round(high - rng.gauss(45, 5), 1), round(high, 1),
+                           round(rng.gauss(36.5, 0.3), 1), rng.randint(55, 95), rng.randint(93, 100), semester)
+        counts['pressione'] = _insert(cursor, 'pressione', (
+            'id_persona', 'giorno', 'mese_int', 'anno', 'minima', 'massima', 'temperatura',
+            'frequenza', 'saturazione', 'id_semestre'
+        ), vitals())
+
+        def weights():
+            base = {guest: rng.uniform(50, 95) for guest in guests}
+            for day, semester in days:
+                if day.day != 1:
+                    continue
+                for guest in guests:
+                    base[guest] += rng.gauss(0, 0.8)
+                    yield (guest, *date_columns(day), round(base[guest], 1), semester)
+        counts['peso'] = _insert(cursor, 'peso', (
+            'id_persona', 'giorno', 'mese_int', 'anno', 'peso', 'id_semestre'
+        ), weights())
+
+        def seizures():
+            epileptic = [guest for guest in guests if guest % 5 == 1]
+            for day, semester in days:
+                for guest in epileptic:
+                    if rng.random() < 0.02:
+                        yield (guest, *date_columns(day), f"{rng.randint(8, 17):02d}:{rng.randint(0, 59):02d}:00",
+                               rng.randint(1, 10), None, signed(), semester)
+        counts['crisi_epilettica'] = _insert(cursor, 'crisi_epilettica', (
+            'id_persona', 'giorno', 'mese_int', 'anno', 'ora', 'durata', 'note', 'firma', 'id_semestre'
+        ), seizures())
+
+        behaviors = [
+            (guest, *date_columns(day), rng.randint(1, 4), rng.randint(1, 60), 'Frustrazione',
+             'Contenimento verbale', signed(), semester)
+            for day, semester in weekdays for guest in guests if rng.random() < 0.05
+        ]
+        counts['comportamento_problema'] = _insert(cursor, 'comportamento_problema', (
+            'id_persona', 'giorno', 'mese_int', 'anno', 'intensita', 'durata', 'causa',
+            'contenimento', 'firma', 'id_semestre'
+        ), behaviors)
+        # Rows were inserted into an empty table: their ids are 1..n
+        counts['evento_comportamento'] = _insert(cursor, 'evento_comportamento', ('id_evento', 'id_comportamento'), (
+            (event_id, problem_id)
+            for event_id in range(1, len(behaviors) + 1)
+            for problem_id in rng.sample(range(1, len(PROBLEMS) + 1), rng.randint(1, 3))
+        ))
+
+        connection.commit()
+
+    except Exception as e:
+        connection.rollback()
+        raise e
+
+    finally:
+        cursor.close()
+        connection.close()
+
+    counts['riepilogo_gradimento'] = appreciations_summary_dao.rebuild()
+    if migrate:
+        migrations.apply()
+    query_cache.invalidate_all()
+    return counts
+
+def add_scale_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = Scale()
+    parser.add_argument('--guests', type=int, default=defaults.guests)
+    parser.add_argument('--semesters', type=int, default=defaults.semesters,
+                        help='closed semesters before the live one')
+    parser.add_argument('--days', type=int, default=defaults.days, help='calendar days per semester')
+    parser.add_argument('--operators', type=int, default=defaults.operators)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+
+def scale_from_args(args) -> Scale:
+    return Scale(guests=args.guests, semesters=args.semesters, days=args.days,
+                 operators=args.operators, seed=args.seed)
+
+def use_scratch_database(args) -> None:
+    """Point db_config at a scratch database, creating it if needed"""
+    db_config.host = args.host
+    db_config.user = args.user
+    db_config.password = args.password
+    db_config.database = ''
+    db_config.reset_pool()
+    connection = db_config.get_connection()
+    cursor = connection.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{args.database}`")
+    cursor.close()
+    connection.close()
+    db_config.database = args.database
+    db_config.reset_pool()
+
+def add_connection_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--host', default=db_config.host)
+    parser.add_argument('--user', default=db_config.user)
+    parser.add_argument('--password', default=db_config.password)
+    parser.add_argument('--database', default='cdd_legrigne_bench',
+                        help='scratch database, dropped and recreated table by table')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_connection_arguments(parser)
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+
+    use_scratch_database(args)
+    scale = scale_from_args(args)
+    print(json.dumps({'scale': asdict(scale), 'rows': generate(scale)}))
+
+if __name__ == '__main__':
+    main()
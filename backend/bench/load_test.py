@@ -0,0 +1,308 @@
+"""
+Load test replaying the shift rush against a local server and a stand-in database
+
+Generates a stand-in database with bench.generator (unless --reuse), starts
+the Flask dev server or gunicorn with gunicorn.conf.py pointed at it, and
+the job worker that renders the graphs (or uses --url), then runs one thread per operator tablet: log in, open /home,
+then replay a weighted mix of /home, /activities, /new_activity_entry and
+/appreciations (whose graph stream is read to the end, like the browser's
+EventSource) with exponential think times. By default every tablet starts
+at once, like at 9:00 and 14:00. Prints throughput, latency percentiles and
+error rate per route as JSON. Usage (from the backend directory):
+
+    python -m bench.load_test --server gunicorn --tablets 12 --duration 60 --think 2
+"""
+import argparse
+import datetime
+import http.cookiejar
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from dataclasses import asdict
+
+from bench.generator import (
+    ACTIVITIES, OPERATOR_PASSWORD, add_connection_arguments, add_scale_arguments,
+    generate, scale_from_args, use_scratch_database
+)
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTES = ('home', 'activities', 'new_activity_entry', 'appreciations')
+DEFAULT_MIX = 'home=4,activities=4,new_activity_entry=2,appreciations=1'
+SERVER_START_TIMEOUT = 30
+REQUEST_TIMEOUT = 60
+
+class Recorder:
+    """Latencies and statuses per route, shared by the tablet threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, route: str, ms: float, ok: bool, error: str = None) -> None:
+        with self._lock:
+            self.samples.setdefault(route, []).append((ms, ok))
+            if error:
+                errors = self.errors.setdefault(route, {})
+                errors[error] = errors.get(error, 0) + 1
+
+    def report(self, seconds: float) -> dict:
+        def summary(samples):
+            latencies = sorted(ms for ms, _ in samples)
+            failed = sum(1 for _, ok in samples if not ok)
+
+            def percentile(p):
+                return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 1)
+            return {
+                'requests': len(samples),
+                'rps': round(len(samples) / seconds, 2),
+                'error_rate': round(failed / len(samples), 4),
+                'p50_ms': round(statistics.median(latencies), 1),
+                'p95_ms': percentile(0.95),
+                'p99_ms': percentile(0.99),
+                'max_ms': round(latencies[-1], 1),
+            }
+
+        with self._lock:
+            routes = {route: summary(samples) for route, samples in sorted(self.samples.items())}
+            for route, errors in self.errors.items():
+                routes[route]['errors'] = errors
+            everything = [sample for samples in self.samples.values() for sample in samples]
+        return {'total': summary(everything) if everything else None, 'routes': routes}
+
+class Tablet:
+    """One operator's browser: a cookie jar and the requests it sends"""
+
+    def __init__(self, base_url: str, operator: int, guests: int, recorder: Recorder, rng: random.Random):
+        self.base_url = base_url
+        self.operator = operator
+        self.guests = guests
+        self.recorder = recorder
+        self.rng = rng
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def request(self, route: str, path: str, body: dict = None, stream: bool = False):
+        """Send a request, record it under route, return the parsed JSON body (None on failure)"""
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data,
+                                         headers={'Content-Type': 'application/json'} if data else {})
+        started = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=REQUEST_TIMEOUT) as response:
+                payload = response.read()
+            ok, error = True, None
+        except urllib.error.HTTPError as e:
+            payload, ok, error = e.read(), False, str(e.code)
+        except (urllib.error.URLError, OSError) as e:
+            payload, ok, error = b'', False, type(getattr(e, 'reason', e)).__name__
+        self.recorder.add(route, (time.perf_counter() - started) * 1000, ok, error)
+        if not ok or stream:
+            return payload.decode(errors='replace') if ok else None
+        try:
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def login(self) -> bool:
+        return self.request('login', '/login', {
+            'name': f"Operatore{self.operator}",
+            'surname': f"Bench{self.operator}",
+            'password': OPERATOR_PASSWORD,
+        }) is not None
+
+    def guest(self) -> int:
+        return self.rng.randint(1, self.guests)
+
+    def home(self) -> None:
+        self.request('home', '/home')
+
+    def activities(self) -> None:
+        self.request('activities', f"/activities?person_id={self.guest()}")
+
+    def new_activity_entry(self) -> None:
+        self.request('new_activity_entry', '/new_activity_entry', {
+            'person_id': self.guest(),
+            'date': datetime.date.today().isoformat(),
+            'morning': self.rng.choice(('yes', 'no')),
+            'activity': self.rng.randint(1, len(ACTIVITIES)),
+            'adesion': self.rng.randint(1, 4),
+            'participation': self.rng.randint(1, 4),
+            'mood': self.rng.randint(1, 8),
+            'communication': self.rng.randint(1, 8),
+        })
+
+    def appreciations(self) -> None:
+        page = self.request('appreciations', '/appreciations')
+        if not page:
+            return
+        # The page then follows the graph stream until every graph has arrived
+        while True:
+            events = self.request('appreciations/stream', f"/appreciations/stream/{page['session_id']}", stream=True)
+            if events is None or 'event: done' in events:
+                return
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in text.split(','):
+        route, _, weight = item.partition('=')
+        if route.strip() not in ROUTES:
+            raise argparse.ArgumentTypeError(f"unknown route in mix: {route} (routes: {', '.join(ROUTES)})")
+        mix[route.strip()] = float(weight or 1)
+    return mix
+
+def run_tablet(tablet: Tablet, mix: dict, think: float, deadline: float, start_delay: float) -> None:
+    time.sleep(start_delay)
+    if not tablet.login():
+        return
+    tablet.home()  # every shift starts on the home page
+    routes, weights = list(mix), list(mix.values())
+    while time.monotonic() < deadline:
+        if think > 0:
+            time.sleep(min(tablet.rng.expovariate(1 / think), max(0, deadline - time.monotonic())))
+        if time.monotonic() >= deadline:
+            return
+        getattr(tablet, tablet.rng.choices(routes, weights)[0])()
+
+def server_env(args) -> dict:
+    return dict(os.environ, DB_HOST=args.host, DB_USER=args.user, DB_PASSWORD=args.password,
+                DB_NAME=args.database, REQUEST_TIMING_LOG='0')
+
+def start_worker(args, log_dir: str) -> subprocess.Popen:
+    """Start the job worker (worker.py) on the stand-in database"""
+    with open(os.path.join(log_dir, 'worker.log'), 'wb') as log:
+        return subprocess.Popen([sys.executable, '-u', 'worker.py'], cwd=BACKEND_DIR, env=server_env(args),
+                                stdout=log, stderr=subprocess.STDOUT)
+
+def start_server(kind: str, port: int, args, log_dir: str) -> subprocess.Popen:
+    """Start the Flask dev server or gunicorn (gunicorn.conf.py) on the stand-in database"""
+    env = server_env(args)
+    if kind == 'flask':
+        command = [sys.executable, '-m', 'flask', '--app', 'main', 'run',
+                   '--port', str(port), '--no-reload', '--no-debugger']
+    else:
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                   '--bind', f"127.0.0.1:{port}",
+                   # gunicorn.conf.py is for the Pi's service account and paths
+                   '--user', str(os.getuid()), '--group', str(os.getgid()),
+                   '--pid', os.path.join(log_dir, 'gunicorn.pid'),
+                   '--access-logfile', os.path.join(log_dir, 'access.log'),
+                   '--error-logfile', os.path.join(log_dir, 'error.log')]
+    with open(os.path.join(log_dir, 'server.log'), 'wb') as log:
+        process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"{kind} exited with status {process.returncode}, see {log_dir}/server.log")
+        try:
+            # Any answer (/ping without a session is a 500) means it is accepting requests
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/ping", timeout=2)
+            return process
+        except urllib.error.HTTPError:
+            return process
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    stop_server(process)
+    raise Exception(f"{kind} did not answer within {SERVER_START_TIMEOUT}s, see {log_dir}/server.log")
+
+def stop_server(process: subprocess.Popen) -> None:
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=SERVER_START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_connection_arguments(parser)
+    add_scale_arguments(parser)
+    parser.add_argument('--reuse', action='store_true', help='keep the data already in the stand-in database')
+    parser.add_argument('--server', choices=('flask', 'gunicorn', 'none'), default='gunicorn')
+    parser.add_argument('--url', default=None, help='with --server none: base URL of a running server')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--tablets', type=int, default=8, help='operator sessions (at most --operators)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of load')
+    parser.add_argument('--think', type=float, default=2, help='mean think time between requests, in seconds')
+    parser.add_argument('--ramp', type=float, default=0, help='seconds over which tablets start (0: all at once)')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='route=weight,...')
+    parser.add_argument('--output', help='also write the report to this file')
+    args = parser.parse_args()
+
+    scale = scale_from_args(args)
+    if args.tablets > scale.operators:
+        parser.error('--tablets cannot exceed --operators: each tablet logs in as its own operator')
+    if args.server == 'none' and not args.url:
+        parser.error('--server none needs --url')
+
+    rows = None
+    if not args.reuse:
+        use_scratch_database(args)
+        rows = generate(scale)
+
+    log_dir = tempfile.mkdtemp(prefix='cdd_load_test_')
+    process = None
+    worker = None
+    base_url = args.url
+    if args.server != 'none':
+        worker = start_worker(args, log_dir)
+        try:
+            process = start_server(args.server, args.port, args, log_dir)
+        except Exception:
+            stop_server(worker)
+            raise
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    recorder = Recorder()
+    rng = random.Random(scale.seed)
+    started = time.monotonic()
+    deadline = started + args.ramp + args.duration
+    threads = [
+        threading.Thread(target=run_tablet, args=(
+            Tablet(base_url.rstrip('/'), operator, scale.guests, recorder, random.Random(rng.random())),
+            args.mix, args.think, deadline, args.ramp * i / args.tablets
+        ))
+        for i, operator in enumerate(range(1, args.tablets + 1))
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if process is not None:
+            stop_server(process)
+        if worker is not None:
+            stop_server(worker)
+
+    report = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'server': args.server,
+        'url': base_url,
+        'scale': asdict(scale),
+        'rows': rows,
+        'tablets': args.tablets,
+        'duration_s': args.duration,
+        'think_s': args.think,
+        'ramp_s': args.ramp,
+        'mix': args.mix,
+        'logs': log_dir,
+        **recorder.report(time.monotonic() - started),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report))
+
+if __name__ == '__main__':
+    main()
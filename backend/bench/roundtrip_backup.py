@@ -0,0 +1,177 @@
+"""
+Round-trip check of backup and restore against a local MySQL/MariaDB server
+
+Seeds a scratch database, backs it up in every format (parallel archive as
+a directory and as a tar, the Python engine's .sql.gz and, when installed,
+mysqldump's), restores each backup into a second scratch database with
+config.restore and compares the two: structure, row count and CHECKSUM
+TABLE of every table, the views and the triggers (those of the migrations
+and of the incremental backups), which the backup itself must bring back.
+Prints one JSON line per backup and exits with status 1 on any difference. Usage (from the backend directory):
+
+    python -m bench.roundtrip_backup --guests 200 --user root --password secret
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+import tarfile
+import tempfile
+
+from bench.bench_home import seed
+from bench.generator import add_connection_arguments, use_scratch_database
+from config.backup import backup_engine, mysqldump_chunks
+from config.backup_archive import ParallelDumper
+from config.backup_incremental import install
+from config.database import db_config
+from config.restore import Restorer
+from config.sql_dump import NOT_DUMPED, SqlDumper
+
+VIEW = "CREATE OR REPLACE VIEW persone_visibili AS SELECT id, nome, cognome FROM persona WHERE visibile = 1"
+
+def recreate_database(args, database: str) -> None:
+    """Point db_config at an empty scratch database"""
+    use_scratch_database(argparse.Namespace(**{**vars(args), 'database': database}))
+    connection = db_config.get_connection()
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"DROP DATABASE `{database}`")
+        cursor.execute(f"CREATE DATABASE `{database}`")
+    finally:
+        cursor.close()
+        connection.close()
+    db_config.reset_pool()
+
+def write_backups(directory: str) -> dict:
+    """Back up the current database in every format, return {format: path}"""
+    archive = os.path.join(directory, 'archive')
+    ParallelDumper().dump(archive)
+    tar_path = os.path.join(directory, 'backup.tar')
+    with tarfile.open(tar_path, 'w') as tar:
+        for name in sorted(os.listdir(archive)):
+            tar.add(os.path.join(archive, name), arcname=name)
+    backups = {'archive': archive, 'tar': tar_path}
+
+    python_path = os.path.join(directory, 'python.sql.gz')
+    connection = db_config.get_dedicated_connection()
+    try:
+        dumper = SqlDumper(connection, db_config.database)
+        with gzip.open(python_path, 'wb') as f:
+            for chunk, _ in dumper.chunks(dumper.plan(), {'part': 0}):
+                f.write(chunk)
+    finally:
+        connection.close()
+    backups['python'] = python_path
+
+    if backup_engine() == 'mysqldump':
+        mysqldump_path = os.path.join(directory, 'mysqldump.sql.gz')
+        with gzip.open(mysqldump_path, 'wb') as f:
+            for chunk in mysqldump_chunks(db_config.database):
+                f.write(chunk)
+        backups['mysqldump'] = mysqldump_path
+    return backups
+
+def fingerprint() -> dict:
+    """Structure, row count and checksum of every table, the views and the triggers of the current database"""
+    connection = db_config.get_connection()
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SHOW FULL TABLES WHERE Table_type = 'VIEW'")
+        tables = {'views': sorted(row[0] for row in cursor.fetchall())}
+        cursor.execute("""
+            SELECT TRIGGER_NAME, EVENT_OBJECT_TABLE, ACTION_TIMING, EVENT_MANIPULATION, ACTION_STATEMENT
+            FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = %s ORDER BY TRIGGER_NAME
+        """, (db_config.database,))
+        tables['triggers'] = [list(row) for row in cursor.fetchall()]
+        cursor.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
+        for (table,) in cursor.fetchall():
+            if table in NOT_DUMPED:
+                continue
+            cursor.execute(f"SHOW CREATE TABLE `{table}`")
+            create_table = re.sub(r' AUTO_INCREMENT=\d+', '', cursor.fetchone()[1])
+            cursor.execute(f"SELECT COUNT(*) FROM `{table}`")
+            rows = cursor.fetchone()[0]
+            cursor.execute(f"CHECKSUM TABLE `{table}`")
+            tables[table] = {
+                # Rebuilt indexes come after the ones that were kept
+                'structure': sorted(line.strip().rstrip(',') for line in create_table.splitlines()),
+                'rows': rows,
+                'checksum': cursor.fetchone()[1],
+            }
+        return tables
+    finally:
+        cursor.close()
+        connection.close()
+
+def differences(expected: dict, actual: dict) -> list:
+    found = []
+    for table in sorted(set(expected) | set(actual)):
+        if table not in actual:
+            found.append(f"{table}: missing")
+        elif table not in expected:
+            found.append(f"{table}: unexpected")
+        elif table == 'views':
+            if expected[table] != actual[table]:
+                found.append(f"views: {actual[table]} instead of {expected[table]}")
+        elif table == 'triggers':
+            expected_triggers = {trigger[0]: trigger for trigger in expected[table]}
+            actual_triggers = {trigger[0]: trigger for trigger in actual[table]}
+            for name in sorted(set(expected_triggers) | set(actual_triggers)):
+                if name not in actual_triggers:
+                    found.append(f"trigger {name}: missing")
+                elif name not in expected_triggers:
+                    found.append(f"trigger {name}: unexpected")
+                elif expected_triggers[name] != actual_triggers[name]:
+                    found.append(f"trigger {name}: different")
+        else:
+            for key in ('structure', 'rows', 'checksum'):
+                if expected[table][key] != actual[table][key]:
+                    found.append(f"{table}: different {key}")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_connection_arguments(parser)
+    parser.add_argument('--guests', type=int, default=200)
+    parser.add_argument('--jobs', type=int, default=3)
+    args = parser.parse_args()
+    restore_database = f"{args.database}_restore"
+
+    use_scratch_database(args)
+    seed(args.guests)
+    connection = db_config.get_connection()
+    cursor = connection.cursor()
+    cursor.execute(VIEW)
+    cursor.close()
+    connection.close()
+    install()
+    expected = fingerprint()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        backups = write_backups(directory)
+        for backup_format, path in backups.items():
+            recreate_database(args, restore_database)
+            report = Restorer(args.jobs).restore(path)
+            found = differences(expected, fingerprint())
+            # Recreated by the restore rather than brought back by the backup
+            found += [f"trigger {name}: not in the backup" for name in report['triggers_recreated']]
+            failed = failed or bool(found)
+            print(json.dumps({
+                'format': backup_format,
+                'ok': not found,
+                'differences': found,
+                'rows': report['rows'],
+                'rows_per_s': report['rows_per_s'],
+                'mb_per_s': report['mb_per_s'],
+                'phases': report['phases'],
+                'indexes_rebuilt': report['indexes_rebuilt'],
+            }))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Largest-Triangle-Three-Buckets downsampling of long time series
+
+Charts and ?format=series responses keep at most max_points() points, so
+render cost and payload size stay bounded however long a guest's history is.
+The default comes from CHART_MAX_POINTS; clients may ask for another target
+with ?max_points=N (0 disables downsampling).
+"""
+import os
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+from flask import request
+
+CHART_MAX_POINTS = int(os.environ.get('CHART_MAX_POINTS', 500))
+MIN_POINTS = 3  # first, last and at least one bucket
+
+def max_points() -> int:
+    """Target number of points for this request, 0 for no downsampling"""
+    requested = request.args.get('max_points', type=int)
+    if requested is None:
+        return CHART_MAX_POINTS
+    return 0 if requested <= 0 else max(requested, MIN_POINTS)
+
+def lttb_indices(x: np.ndarray, ys: np.ndarray, target: int) -> np.ndarray:
+    """Indices of the points kept by LTTB, sorted.
+
+    x has shape (n,), ys shape (n,) or (n, k) for k series sharing the x
+    axis; with several series the triangle areas are summed after scaling
+    every series to [0, 1]. Each bucket is anchored to the mean of the
+    previous bucket rather than to its selected point, so all buckets are
+    solved at once; peaks and troughs are kept like in sequential LTTB,
+    only the choice between near-equal points may differ. Points with a
+    NaN or infinite value are dropped when downsampling: a single one
+    would make every area NaN.
+    """
+    n = len(x)
+    if target <= 0:
+        return np.arange(n)
+    target = max(target, MIN_POINTS)
+    if n <= target:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64).reshape(n, -1)
+    finite = np.isfinite(x) & np.isfinite(ys).all(axis=1)
+    if not finite.all():
+        kept = np.flatnonzero(finite)
+        return kept[lttb_indices(x[kept], ys[kept], target)]
+    spans = np.ptp(ys, axis=0)
+    ys = (ys - ys.min(axis=0)) / np.where(spans > 0, spans, 1)
+
+    # Interior points 1..n-2 split into target-2 contiguous buckets
+    edges = np.linspace(1, n - 1, target - 1).astype(np.int64)
+    starts = edges[:-1]
+    counts = np.diff(edges)
+    bucket = np.repeat(np.arange(len(counts)), counts)
+
+    mean_x = np.add.reduceat(x[1:n - 1], starts - 1) / counts
+    mean_y = np.add.reduceat(ys[1:n - 1], starts - 1, axis=0) / counts[:, None]
+
+    # Anchors: previous bucket (first point for the first one), next bucket (last point)
+    ax = np.concatenate(([x[0]], mean_x[:-1]))[bucket]
+    ay = np.concatenate((ys[:1], mean_y[:-1]))[bucket]
+    cx = np.concatenate((mean_x[1:], [x[-1]]))[bucket]
+    cy = np.concatenate((mean_y[1:], ys[-1:]))[bucket]
+
+    px = x[1:n - 1]
+    py = ys[1:n - 1]
+    areas = np.abs(
+        (ax - cx)[:, None] * (py - ay) - (ax - px)[:, None] * (cy - ay)
+    ).sum(axis=1)
+
+    # First point reaching its bucket's maximum area
+    best = np.maximum.reduceat(areas, starts - 1)
+    candidates = np.flatnonzero(areas == best[bucket])
+    _, first = np.unique(bucket[candidates], return_index=True)
+    chosen = candidates[first] + 1
+
+    return np.concatenate(([0], chosen, [n - 1]))
+
+def downsample_points(dates: list, *series: list, target: Optional[int] = None):
+    """Downsample chart inputs (datetimes in either order plus parallel value lists), return lists again"""
+    target = max_points() if target is None else target
+    if target <= 0 or len(dates) <= target:
+        return (dates, *series)
+    x = np.array(dates, dtype='datetime64[s]').astype(np.float64)
+    keep = lttb_indices(x, np.column_stack(series), target)
+    return tuple([values[i] for i in keep] for values in (dates, *series))
+
+def downsample_columns(columns: Dict[str, np.ndarray], target: Optional[int] = None,
+                       x: str = 'date', y: Optional[Iterable[str]] = None) -> Dict[str, np.ndarray]:
+    """Downsample series columns; y names the plotted columns (all but x by default)"""
+    target = max_points() if target is None else target
+    length = len(columns[x])
+    if target <= 0 or length <= target:
+        return columns
+    y = [name for name in columns if name != x] if y is None else list(y)
+    keep = lttb_indices(columns[x], np.column_stack([columns[name] for name in y]), target)
+    return {name: values[keep] for name, values in columns.items()}
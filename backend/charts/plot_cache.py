@@ -0,0 +1,112 @@
+"""
+Content-addressed cache of rendered chart PNGs, shared by all gunicorn workers
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Callable, Tuple
+
+from config.metrics import metrics
+
+# Bump when the look of the charts changes so old images are not served
+CACHE_VERSION = 2
+
+class PlotCache:
+    """Size-bounded on-disk LRU of PNG images keyed by a hash of what they plot.
+
+    Every worker process uses the same directory, so a chart rendered by one
+    worker is a file read for all the others. Recency is tracked through the
+    files' modification time, which is refreshed on every hit.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def make_key(kind: str, data) -> str:
+        """Hash of the chart kind, its parameters and plotted series"""
+        payload = json.dumps([CACHE_VERSION, kind, data], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get_or_render(self, kind: str, data, render: Callable[[], bytes]) -> Tuple[str, bytes]:
+        """Return (key, png) for a chart, calling render() only on a cache miss"""
+        key = self.make_key(kind, data)
+        return key, self.get(key, render)
+
+    def get(self, key: str, render: Callable[[], bytes]) -> bytes:
+        """Return the PNG stored under key, rendering and storing it on a miss"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                png = f.read()
+            os.utime(path)
+            self._count('hits')
+            return png
+        except FileNotFoundError:
+            pass
+
+        self._count('misses')
+        png = render()
+        self._store(path, png)
+        return png
+
+    def _store(self, path: str, png: bytes) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, path)
+            self._evict()
+        except OSError as e:
+            print(f"Error storing plot in cache: {e}")
+
+    def _evict(self) -> None:
+        """Remove least recently used images until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.png'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # evicted concurrently by another worker
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self._count('evictions')
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+        metrics.inc('cdd_plot_cache_events_total', event=name)
+
+    def stats(self) -> dict:
+        """Hit/miss counters of this process"""
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else None
+        return stats
+
+plot_cache = PlotCache(os.path.join(tempfile.gettempdir(), 'cdd_plot_cache'))
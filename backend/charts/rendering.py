@@ -0,0 +1,164 @@
+"""
+Thread-safe chart rendering without matplotlib.pyplot
+
+Each chart kind has a template (Figure + FigureCanvasAgg with axes, labels,
+grid, legend and formatters already set up). Rendering only swaps the data
+of the template's artists and prints the canvas, so no global pyplot state
+is touched and nothing is rebuilt per call. Templates are per thread.
+"""
+import io
+import threading
+import time
+from contextlib import contextmanager
+
+import matplotlib.dates as mdates
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator
+
+from config import request_timing
+from config.metrics import RENDER_BUCKETS, metrics
+
+PRIMARY_COLOR = '#005073'
+SECONDARY_COLOR = '#60A5FA'
+FIGSIZE = (10, 6)
+DPI = 100
+BAR_WIDTH = 0.35
+
+_local = threading.local()
+
+def _new_figure():
+    figure = Figure(figsize=FIGSIZE, dpi=DPI)
+    FigureCanvasAgg(figure)
+    return figure, figure.add_subplot()
+
+def _setup_date_axis(figure, ax) -> None:
+    ax.grid(True, alpha=0.3)
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    ax.tick_params(axis='x', labelrotation=45)
+    # Fixed margins leave room for the rotated dates without a per-call tight_layout
+    figure.subplots_adjust(left=0.08, right=0.98, top=0.96, bottom=0.2)
+
+@contextmanager
+def _rendering(kind: str):
+    """Time a render into the request's "render" span and the render histogram"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        request_timing.add('render', elapsed)
+        metrics.observe('cdd_chart_render_seconds', elapsed, RENDER_BUCKETS, kind=kind)
+
+def _to_png(figure) -> bytes:
+    buffer = io.BytesIO()
+    figure.canvas.print_png(buffer)
+    return buffer.getvalue()
+
+class LineTemplate:
+    """Date-based line chart with a fixed set of series"""
+
+    def __init__(self, kind, series, ylabel, ylim=None, integer_y=False):
+        self.kind = kind
+        self.figure, self.ax = _new_figure()
+        self.lines = [
+            self.ax.plot([], [], marker=marker, label=label, linewidth=2, color=color)[0]
+            for label, marker, color in series
+        ]
+        self.ax.set_xlabel('Data')
+        self.ax.set_ylabel(ylabel)
+        self.ax.legend()
+        if integer_y:
+            self.ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+        self.ylim = ylim
+        if ylim is not None:
+            self.ax.set_ylim(*ylim)
+        _setup_date_axis(self.figure, self.ax)
+
+    def render(self, dates, *values) -> bytes:
+        with _rendering(self.kind):
+            x = mdates.date2num(dates) if len(dates) else []
+            for line, y in zip(self.lines, values):
+                line.set_data(x, y)
+            self.ax.relim()
+            self.ax.autoscale_view(scalex=True, scaley=self.ylim is None)
+            return _to_png(self.figure)
+
+class BarPairTemplate:
+    """Two bar series side by side per category, with a title"""
+
+    def __init__(self, kind, labels, ylabel, ylim):
+        self.kind = kind
+        self.figure, self.ax = _new_figure()
+        self.labels = labels
+        self.containers = []
+        self.ax.set_xlabel('Attività')
+        self.ax.set_ylabel(ylabel)
+        self.ax.grid(True, alpha=0.3)
+        self.ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+        self.ax.set_ylim(*ylim)
+        self.title = self.ax.set_title('')
+        self.figure.subplots_adjust(left=0.08, right=0.98, top=0.93, bottom=0.1)
+
+    def _rebuild_bars(self, count: int) -> None:
+        """Recreate the bar artists only when the number of categories changes"""
+        for container in self.containers:
+            container.remove()
+        x = range(count)
+        self.containers = [
+            self.ax.bar([i - BAR_WIDTH / 2 for i in x], [0] * count, BAR_WIDTH,
+                        label=self.labels[0], color=PRIMARY_COLOR),
+            self.ax.bar([i + BAR_WIDTH / 2 for i in x], [0] * count, BAR_WIDTH,
+                        label=self.labels[1], color=SECONDARY_COLOR),
+        ]
+        self.ax.legend()
+
+    def render(self, categories, first_values, second_values, title) -> bytes:
+        with _rendering(self.kind):
+            if not self.containers or len(self.containers[0]) != len(categories):
+                self._rebuild_bars(len(categories))
+            for container, values in zip(self.containers, (first_values, second_values)):
+                for bar, value in zip(container, values):
+                    bar.set_height(value)
+            self.ax.set_xticks(range(len(categories)), categories)
+            self.ax.relim()
+            self.ax.autoscale_view(scalex=True, scaley=False)
+            self.title.set_text(title)
+            return _to_png(self.figure)
+
+TEMPLATES = {
+    'weight': lambda: LineTemplate(
+        'weight', [('Peso', 'o', PRIMARY_COLOR)], 'Peso (kg)'),
+    'vitals': lambda: LineTemplate(
+        'vitals', [('Massima', 's', SECONDARY_COLOR), ('Minima', 'o', PRIMARY_COLOR)], 'Valore (mmHg)'),
+    'activities': lambda: LineTemplate(
+        'activities', [('Umore', 'o', PRIMARY_COLOR), ('Comunicazione', 's', SECONDARY_COLOR)], 'Indice',
+        ylim=(0.5, 8.5), integer_y=True),
+    'appreciation': lambda: BarPairTemplate('appreciation', ('Adesione', 'Partecipazione'), '%', ylim=(0, 104)),
+}
+
+def get_template(kind: str):
+    """This thread's template for a chart kind, built on first use"""
+    templates = getattr(_local, 'templates', None)
+    if templates is None:
+        templates = _local.templates = {}
+    if kind not in templates:
+        templates[kind] = TEMPLATES[kind]()
+    return templates[kind]
+
+def render_weight(dates, measurements) -> bytes:
+    """Weight line chart as PNG bytes"""
+    return get_template('weight').render(dates, measurements)
+
+def render_vitals(dates, min_pressures, max_pressures) -> bytes:
+    """Blood pressure (max and min) line chart as PNG bytes"""
+    return get_template('vitals').render(dates, max_pressures, min_pressures)
+
+def render_activities(dates, moods, communications) -> bytes:
+    """Mood/communication line chart as PNG bytes"""
+    return get_template('activities').render(dates, moods, communications)
+
+def render_appreciation(labels, adesione_values, partecipazione_values, title) -> bytes:
+    """Adhesion/participation bar chart of one person as PNG bytes"""
+    return get_template('appreciation').render(labels, adesione_values, partecipazione_values, title)
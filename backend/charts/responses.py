@@ -0,0 +1,47 @@
+"""
+HTTP helpers for serving charts
+"""
+import base64
+from typing import Callable
+
+from flask import Response, request, url_for
+
+from charts.plot_cache import plot_cache
+from config import request_timing
+
+class Chart:
+    """A chart whose content is identified by the hash of what it plots"""
+
+    def __init__(self, kind: str, data, render: Callable[[], bytes]):
+        self.key = plot_cache.make_key(kind, data)
+        self._render = render
+
+    def png(self) -> bytes:
+        return plot_cache.get(self.key, self._render)
+
+    def base64(self) -> str:
+        png = self.png()
+        with request_timing.span('encode'):
+            return base64.b64encode(png).decode()
+
+def wants_embedded_plot() -> bool:
+    """Old clients ask for the PNG inside the JSON body with ?plot=base64"""
+    return request.args.get('plot') == 'base64'
+
+def plot_url(endpoint: str, chart: Chart, **params) -> str:
+    """URL of a chart image; the version parameter changes whenever the data does"""
+    # The image must be downsampled like the data it was versioned with
+    params.setdefault('max_points', request.args.get('max_points', type=int))
+    return url_for(endpoint, v=chart.key[:16], **params)
+
+def png_response(chart: Chart) -> Response:
+    """Serve a chart as image/png with a strong ETag, answering 304 without rendering"""
+    if chart.key in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(chart.png(), mimetype='image/png')
+    response.set_etag(chart.key)
+    # Per-user data: browsers may keep it but must revalidate every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,59 @@
+"""
+Compact columnar chart series (?format=series) for client-side rendering
+"""
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from flask import request
+
+def wants_series() -> bool:
+    """Capable clients ask for raw series instead of a rendered chart"""
+    return request.args.get('format') == 'series'
+
+def rows_to_columns(rows, spec: Dict[str, Tuple[int, str]],
+                    fill_null: Optional[Dict[str, object]] = None) -> Dict[str, np.ndarray]:
+    """Turn cursor rows into typed NumPy columns.
+
+    spec maps a column name to (row index, dtype). Rows with a NULL in a
+    column are dropped unless fill_null gives a replacement value for it.
+    """
+    fill_null = fill_null or {}
+    if not rows:
+        return {name: np.empty(0, dtype=dtype) for name, (_, dtype) in spec.items()}
+
+    table = np.array(rows, dtype=object)
+    picked = {name: table[:, index] for name, (index, _) in spec.items()}
+    valid = np.ones(len(table), dtype=bool)
+    for name, values in picked.items():
+        nulls = np.equal(values, None)
+        if name in fill_null:
+            values[nulls] = fill_null[name]
+        else:
+            valid &= ~nulls
+    return {name: picked[name][valid].astype(dtype) for name, (_, dtype) in spec.items()}
+
+def epoch_days(years: np.ndarray, months: np.ndarray, days: np.ndarray) -> np.ndarray:
+    """Vectorized (year, month, day) -> days since 1970-01-01"""
+    dates = (years.astype(np.int64) - 1970).astype('datetime64[Y]').astype('datetime64[M]')
+    dates = dates + (months.astype(np.int64) - 1).astype('timedelta64[M]')
+    dates = dates.astype('datetime64[D]') + (days.astype(np.int64) - 1).astype('timedelta64[D]')
+    return dates.astype(np.int64).astype(np.int32)
+
+def with_epoch_days(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Replace the year/month/day columns with a single 'date' column"""
+    date = epoch_days(columns.pop('year'), columns.pop('month'), columns.pop('day'))
+    return {'date': date, **columns}
+
+def series_payload(columns: Dict[str, np.ndarray], **extra) -> dict:
+    """JSON body of a series response: one typed array per column"""
+    length = len(next(iter(columns.values()))) if columns else 0
+    payload = {
+        'format': 'series',
+        'length': length,
+        'columns': {
+            name: {'dtype': str(values.dtype), 'data': values.tolist()}
+            for name, values in columns.items()
+        }
+    }
+    payload.update(extra)
+    return payload
@@ -0,0 +1,403 @@
+"""
+Streaming, resumable database backups
+
+Two engines produce the dump as a sequence of bounded SQL chunks:
+mysqldump, whose stdout is read line by line (uncommenting the view
+definitions), and, only when the binary is not installed, SqlDumper
+(structure, one multi-row INSERT per batch of rows read through a
+server-side cursor, views). Every chunk is compressed as its own gzip
+member and appended to a spool file on disk, together with a checkpoint of
+where the dump stands. Concatenated gzip members form a valid .gz file.
+The 'archive' engine instead writes the tar of a parallel multi-file dump
+(see config.backup_archive).
+
+Memory stays bounded by one chunk whatever the size of the database, and a
+download that breaks (or is cut by the gunicorn timeout) resumes from the
+number of bytes the client already has: the spool is replayed. The dump
+itself is a background job (config.jobs) that carries on from the
+checkpoint if its worker is restarted: the Python engine from the row it
+stopped at, mysqldump from the table it stopped in (mysqldump cannot start
+halfway through a table), the archive engine not at all. A resumed dump
+is consistent table by table, but the tables dumped after the interruption
+come from a later snapshot than those before it.
+"""
+import datetime
+import fcntl
+import gzip
+import json
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+import uuid
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from config.backup_archive import ParallelDumper
+from config.database import db_config
+from config.jobs import JOB_CANCELLED, JOB_FAILED, JobInterrupted, enqueue, get_job, job_kind
+from config.sql_dump import MAX_INSERT_BYTES, NOT_DUMPED, SqlDumper
+
+BACKUPS_DIR = os.path.join(tempfile.gettempdir(), 'cdd_backups')
+MIMETYPES = {'archive': 'application/x-tar'}  # the other engines write .sql.gz
+BACKUP_MAX_AGE = 3600  # seconds a finished or abandoned backup can still be downloaded
+
+GZIP_LEVEL = 6
+READ_BLOCK = 64 * 1024
+FOLLOW_POLL_INTERVAL = 0.2        # seconds between checks of a spool another request is writing
+FOLLOW_MAX_DURATION = 10          # a response ends after this long; the client resumes from its offset
+
+MYSQLDUMP_TABLE = re.compile(rb'^-- Table structure for table `((?:[^`]|``)+)`$', re.MULTILINE)
+
+def write_json_atomic(path: str, content: dict) -> None:
+    """Write a JSON file so that readers never see it half written"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(content, f, default=str)
+    os.replace(temp_path, path)
+
+def read_json(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+def rewrite_version_comments(line: bytes) -> bytes:
+    """Uncomment the version-specific view definitions mysqldump writes as /*!50001 ... */"""
+    body = line.rstrip(b'\r\n')
+    if (body.startswith(b'/*!50001 ') or body.startswith(b'/*!50013 ')) and body.endswith(b' */'):
+        return body[9:-3] + line[len(body):]
+    return line
+
+def mysqldump_command(defaults_file: str, database: str, ignore: Iterable[str] = ()) -> list:
+    return [
+        'mysqldump',
+        f'--defaults-extra-file={defaults_file}',  # keeps the password out of the process list
+        '--single-transaction',  # Ensures consistency
+        '--routines',            # Include stored procedures and functions
+        '--triggers',            # Include triggers
+        '--events',              # Include events
+        '--add-drop-table',      # Add DROP TABLE statements
+        '--create-options',      # Include table creation options
+        '--extended-insert',     # Use extended INSERT syntax for efficiency
+        '--set-charset',         # Add charset information
+        '--skip-dump-date',      # Same data, same bytes
+        *(f'--ignore-table={database}.{table}' for table in (*NOT_DUMPED, *ignore)),
+        database
+    ]
+
+def mysqldump_chunks(database: str, ignore: Iterable[str] = ()) -> Iterator[bytes]:
+    """Run mysqldump and yield its rewritten output in chunks of about MAX_INSERT_BYTES.
+
+    A chunk only ends between two statements, outside any DELIMITER block,
+    so another mysqldump run can carry on a dump cut after any chunk.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.cnf') as defaults, tempfile.TemporaryFile() as stderr:
+        os.chmod(defaults.name, 0o600)
+        defaults.write(f"[client]\nhost={db_config.host}\nuser={db_config.user}\npassword={db_config.password}\n")
+        defaults.flush()
+
+        process = subprocess.Popen(mysqldump_command(defaults.name, database, ignore),
+                                   stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            chunk = []
+            size = 0
+            delimiter = b';'
+            in_statement = False
+            for line in process.stdout:
+                line = rewrite_version_comments(line)
+                chunk.append(line)
+                size += len(line)
+                # Statements end as config.restore.read_statements reads them
+                stripped = line.strip()
+                if not in_statement:
+                    if stripped[:10].upper() == b'DELIMITER ':
+                        delimiter = stripped[10:].strip()
+                        continue
+                    in_statement = bool(stripped) and not stripped.startswith(b'--')
+                if in_statement and stripped.endswith(delimiter):
+                    in_statement = False
+                if size >= MAX_INSERT_BYTES and not in_statement and delimiter == b';':
+                    yield b''.join(chunk)
+                    chunk = []
+                    size = 0
+            if chunk:
+                yield b''.join(chunk)
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+
+        if returncode != 0:
+            stderr.seek(0)
+            raise Exception(f"mysqldump failed: {stderr.read().decode(errors='replace').strip()}")
+
+def backup_engine() -> str:
+    """mysqldump when the binary is installed, the Python dumper otherwise"""
+    return 'mysqldump' if shutil.which('mysqldump') else 'python'
+
+class Backup:
+    """A backup download spooled on disk: the gzip file, its checkpoint and its owner.
+
+    The dump is written by a 'backup' job in the job worker; downloads only
+    follow the spool, so a slow client never slows the dump down and a dump
+    never waits for a client.
+    """
+
+    def __init__(self, backup_id: str):
+        self.id = backup_id
+        self.directory = os.path.join(BACKUPS_DIR, backup_id)
+        self.spool_path = os.path.join(self.directory, 'backup.sql.gz')
+        self.checkpoint_path = os.path.join(self.directory, 'checkpoint.json')
+        self.meta_path = os.path.join(self.directory, 'meta.json')
+        self.lock_path = os.path.join(self.directory, 'lock')
+        self.on_progress = None
+
+    @classmethod
+    def create(cls, owner: int, engine: Optional[str] = None) -> 'Backup':
+        """Register a new backup and queue the job that dumps it"""
+        cleanup_old_backups()
+        backup = cls(str(uuid.uuid4()))
+        os.makedirs(backup.directory, mode=0o700)
+        engine = engine or backup_engine()
+        extension = 'tar' if engine == 'archive' else 'sql.gz'
+        now = datetime.datetime.now()
+        write_json_atomic(backup.meta_path, {
+            'owner': owner,
+            'database': db_config.database,
+            'engine': engine,
+            'filename': f'cdd_legrigne_backup_{now.strftime("%Y%m%d_%H%M%S")}.{extension}',
+        })
+        write_json_atomic(backup.checkpoint_path, {
+            'offset': 0,
+            'position': {'part': 0},
+            'plan': None,
+            'complete': False,
+            'error': None,
+            'sql_bytes': 0,
+            'elapsed': 0.0,
+        })
+        open(backup.spool_path, 'wb').close()
+        job_id = enqueue('backup', {'backup_id': backup.id}, owner)
+        write_json_atomic(backup.meta_path, {**backup.meta, 'job_id': job_id})
+        return backup
+
+    @classmethod
+    def open(cls, backup_id: str) -> Optional['Backup']:
+        """Find an existing backup, None if the id is unknown or not a valid backup id"""
+        try:
+            backup = cls(str(uuid.UUID(backup_id)))
+        except ValueError:
+            return None
+        return backup if os.path.exists(backup.meta_path) else None
+
+    @property
+    def meta(self) -> dict:
+        return read_json(self.meta_path)
+
+    @property
+    def mimetype(self) -> str:
+        return MIMETYPES.get(self.meta['engine'], 'application/gzip')
+
+    def checkpoint(self) -> dict:
+        return read_json(self.checkpoint_path)
+
+    def status(self) -> dict:
+        """Bytes available so far, whether the dump is finished, and how fast it went"""
+        meta = self.meta
+        checkpoint = self.checkpoint()
+        elapsed = checkpoint['elapsed']
+        error = checkpoint['error']
+        if not checkpoint['complete'] and not error and meta.get('job_id'):
+            # Cancelled before it started, or failed outside the dump
+            job = get_job(meta['job_id'])
+            if job is None:
+                error = "Database backup job not found"
+            elif job['state'] in (JOB_FAILED, JOB_CANCELLED):
+                error = job['error'] or f"Database backup {job['state']}"
+        return {
+            'backup_id': self.id,
+            'job_id': meta.get('job_id'),
+            'filename': meta['filename'],
+            'engine': meta['engine'],
+            'size': checkpoint['offset'],
+            'complete': checkpoint['complete'],
+            'error': error,
+            'sql_bytes': checkpoint['sql_bytes'],
+            'seconds': round(elapsed, 2),
+            'mb_per_s': round(checkpoint['sql_bytes'] / elapsed / 1e6, 2) if elapsed else None,
+        }
+
+    def stream(self, offset: int = 0) -> Iterator[bytes]:
+        """The gzip file from offset on, as it is written, for at most FOLLOW_MAX_DURATION seconds.
+
+        Stopping early keeps a gunicorn thread from following a long
+        dump: the client asks again with ?offset= for the rest.
+        """
+        deadline = time.monotonic() + FOLLOW_MAX_DURATION
+        while time.monotonic() < deadline:
+            checkpoint = self.checkpoint()
+            if offset < checkpoint['offset']:
+                for block in self._read(offset, checkpoint['offset']):
+                    offset += len(block)
+                    yield block
+                    if time.monotonic() >= deadline:
+                        return
+            elif checkpoint['complete']:
+                return
+            elif checkpoint['error']:
+                raise Exception(checkpoint['error'])
+            else:
+                time.sleep(FOLLOW_POLL_INTERVAL)
+
+    def generate(self, on_progress: Optional[Callable[[dict], None]] = None) -> None:
+        """Dump in this thread from the checkpoint on, calling on_progress(checkpoint) after each write.
+
+        Only one thread dumps at a time: it holds an flock on the lock file,
+        which the kernel releases if its process is killed.
+        """
+        lock = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.on_progress = on_progress
+            checkpoint = self.checkpoint()
+            if checkpoint['complete'] or checkpoint['error']:
+                return
+            engine = self.meta['engine']
+            started = time.monotonic()
+            try:
+                if engine == 'archive':
+                    self._write_archive(checkpoint, started)
+                elif engine == 'mysqldump':
+                    self._write(checkpoint, self._mysqldump_chunks(checkpoint), started)
+                else:
+                    self._write(checkpoint, self._python_chunks(checkpoint), started)
+                checkpoint['complete'] = True
+            except JobInterrupted:
+                raise  # carried on from the checkpoint when the job runs again
+            except Exception as e:
+                checkpoint['error'] = f"Database backup failed ({engine}): {str(e)}"
+            checkpoint['elapsed'] += time.monotonic() - started
+            write_json_atomic(self.checkpoint_path, checkpoint)
+            if checkpoint['complete']:
+                print(f"Backup {self.id}: {engine}, {checkpoint['sql_bytes'] / 1e6:.1f} MB of SQL "
+                      f"in {checkpoint['elapsed']:.1f}s ({self.status()['mb_per_s']} MB/s)")
+        finally:
+            lock.close()
+
+    def _python_chunks(self, checkpoint: dict) -> Iterator[Tuple[bytes, dict]]:
+        """SqlDumper output from the checkpoint position"""
+        connection = db_config.get_dedicated_connection()
+        try:
+            dumper = SqlDumper(connection, self.meta['database'])
+            if checkpoint['plan'] is None:
+                checkpoint['plan'] = dumper.plan()
+            yield from dumper.chunks(checkpoint['plan'], checkpoint['position'])
+        finally:
+            connection.close()
+
+    def _mysqldump_chunks(self, checkpoint: dict) -> Iterator[Tuple[bytes, dict]]:
+        """mysqldump output after the spooled members, positioned by the tables it has started.
+
+        A resumed dump leaves out the tables the spool holds in full and
+        starts again from the one it was cut in, whose DROP TABLE discards
+        the rows already spooled for it.
+        """
+        tables = checkpoint['position'].get('tables', [])
+        done = tables[:-1]
+        if checkpoint['offset'] > 0:
+            # The spool may stop inside the LOCK TABLES of the table cut short
+            yield b'UNLOCK TABLES;\n', {'tables': tables}
+        tables = list(done)
+        for chunk in mysqldump_chunks(self.meta['database'], ignore=done):
+            tables.extend(name.replace(b'``', b'`').decode() for name in MYSQLDUMP_TABLE.findall(chunk))
+            yield chunk, {'tables': list(tables)}
+
+    def _write(self, checkpoint: dict, chunks: Iterator[Tuple[bytes, dict]], started: float) -> None:
+        """Compress chunks after the spooled members, checkpointing after each gzip member"""
+        with open(self.spool_path, 'r+b') as spool:
+            # Drop a member left half written by a generator that was killed
+            spool.truncate(checkpoint['offset'])
+            spool.seek(checkpoint['offset'])
+            for chunk, position in chunks:
+                member = gzip.compress(chunk, compresslevel=GZIP_LEVEL, mtime=0)
+                spool.write(member)
+                spool.flush()
+                checkpoint['offset'] += len(member)
+                checkpoint['position'] = position
+                checkpoint['sql_bytes'] += len(chunk)
+                write_json_atomic(self.checkpoint_path, {
+                    **checkpoint, 'elapsed': checkpoint['elapsed'] + time.monotonic() - started
+                })
+                if self.on_progress:
+                    self.on_progress(checkpoint)
+
+    def _write_archive(self, checkpoint: dict, started: float) -> None:
+        """Tar a parallel dump into the spool, file by file as the dump finishes them"""
+        if checkpoint['offset'] > 0:
+            # Another snapshot would not match the files already sent
+            raise Exception("an interrupted archive cannot be resumed, start a new backup")
+        directory = os.path.join(self.directory, 'archive')
+
+        with tarfile.open(self.spool_path, 'w') as tar:
+            def add(relative_path):
+                tar.add(os.path.join(directory, relative_path), arcname=relative_path)
+                tar.fileobj.flush()
+                checkpoint['offset'] = tar.offset
+                write_json_atomic(self.checkpoint_path, {
+                    **checkpoint, 'elapsed': checkpoint['elapsed'] + time.monotonic() - started
+                })
+                if self.on_progress:
+                    self.on_progress(checkpoint)
+            manifest = ParallelDumper().dump(directory, on_file=add)
+
+        checkpoint['offset'] = os.path.getsize(self.spool_path)
+        checkpoint['sql_bytes'] = manifest['sql_bytes']
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def _read(self, start: int, end: int) -> Iterator[bytes]:
+        with open(self.spool_path, 'rb') as spool:
+            spool.seek(start)
+            while start < end:
+                block = spool.read(min(READ_BLOCK, end - start))
+                if not block:
+                    break
+                start += len(block)
+                yield block
+
+@job_kind('backup')
+def run_backup(context, params: dict) -> dict:
+    """Job: dump a backup registered by Backup.create, and link the file among the job's results"""
+    backup = Backup.open(params['backup_id'])
+    if backup is None:
+        raise Exception(f"backup {params['backup_id']} not found")
+
+    def progress(checkpoint):
+        context.progress({'bytes': checkpoint['offset'], 'sql_bytes': checkpoint['sql_bytes']})
+        context.check()
+    backup.generate(progress)
+
+    status = backup.status()
+    if status['error']:
+        context.check()  # a cancelled job is recorded as such, not as failed
+        raise Exception(status['error'])
+    try:
+        # Same file system: a second name for the file, not a copy
+        os.link(backup.spool_path, context.artifact_path(status['filename']))
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(backup.spool_path, context.artifact_path(status['filename']))
+    return status
+
+def cleanup_old_backups() -> None:
+    """Remove backups older than BACKUP_MAX_AGE"""
+    try:
+        if not os.path.exists(BACKUPS_DIR):
+            os.makedirs(BACKUPS_DIR, mode=0o700, exist_ok=True)
+            return
+        current_time = time.time()
+        for entry in os.scandir(BACKUPS_DIR):
+            if entry.is_dir() and current_time - entry.stat().st_mtime > BACKUP_MAX_AGE:
+                shutil.rmtree(entry.path, ignore_errors=True)
+    except Exception as e:
+        print(f"Error cleaning up old backups: {e}")
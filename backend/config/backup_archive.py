@@ -0,0 +1,257 @@
+"""
+Parallel archive backups on a consistent snapshot
+
+ParallelDumper opens N pooled connections and starts a consistent snapshot
+on each of them while writes are briefly blocked, so that they all see the
+same data. It then dumps the tables concurrently from a thread pool,
+splitting large tables with an integer primary key into key ranges. The
+result is a directory (served as a tar by the backup download):
+
+    manifest.json              tables, parts, row counts and timings
+    schema.sql.gz              header and table structures
+    data/<table>.<n>.sql.gz    multi-row INSERTs of a table or key range
+    views.sql.gz               triggers, views and footer
+
+Write an archive from the command line with:
+
+    python -m config.backup_archive <directory> [--jobs 3]
+"""
+import argparse
+import gzip
+import json
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Optional
+
+import MySQLdb
+
+from config.database import db_config
+from config.sql_dump import SqlDumper
+
+ARCHIVE_FORMAT = 'cdd-backup-archive'
+ARCHIVE_VERSION = 1
+MANIFEST = 'manifest.json'
+
+ARCHIVE_JOBS = 3       # the pool holds 5 connections per worker: leave some for requests
+RANGE_ROWS = 50000     # estimated rows per part when a table is split
+GZIP_LEVEL = 6
+
+class ParallelDumper:
+    """Dump every table concurrently on connections sharing one consistent snapshot"""
+
+    def __init__(self, jobs: int = ARCHIVE_JOBS, range_rows: int = RANGE_ROWS):
+        # One more connection coordinates the snapshot
+        self.jobs = max(1, min(jobs, db_config.pool.max_size - 1))
+        self.range_rows = range_rows
+
+    def dump(self, directory: str, on_file: Optional[Callable[[str], None]] = None,
+             on_snapshot: Optional[Callable[[object, str], dict]] = None) -> dict:
+        """Write the archive into directory and return its manifest.
+
+        on_file(relative path) is called from the calling thread as soon as
+        each file is complete, the manifest last. on_snapshot(connection,
+        snapshot method) may read more from the snapshot before the dump
+        starts; the dict it returns is added to the manifest.
+        """
+        started = time.monotonic()
+        os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+        coordinator = db_config.get_dedicated_connection()
+        connections = []
+
+        try:
+            plan = SqlDumper(coordinator, db_config.database).plan()
+            ranges = self._split(coordinator, plan)
+            snapshot = self._start_snapshots(coordinator, plan, connections)
+            extra = on_snapshot(connections[0], snapshot) if on_snapshot else {}
+            jobs = [(self._dump_schema, plan)]
+            for table in plan['tables']:
+                for index, bounds in enumerate(ranges[table['name']]):
+                    jobs.append((self._dump_part, table, index, bounds))
+            jobs.append((self._dump_views, plan))
+            parts = self._run_jobs(connections, directory, jobs, on_file)
+        finally:
+            for connection in connections:
+                connection.close()
+            coordinator.close()
+
+        manifest = self._manifest(plan, parts, snapshot, time.monotonic() - started)
+        manifest.update(extra)
+        with open(os.path.join(directory, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1, default=str)
+        if on_file:
+            on_file(MANIFEST)
+        return manifest
+
+    def _run_jobs(self, connections: list, directory: str, jobs: list,
+                  on_file: Optional[Callable[[str], None]] = None) -> list:
+        """Run (job, *args) on the thread pool, each borrowing a snapshot connection for one file"""
+        idle = queue.Queue()
+        for connection in connections:
+            idle.put(connection)
+
+        def run(job, *args):
+            connection = idle.get()
+            try:
+                return job(SqlDumper(connection, db_config.database), directory, *args)
+            finally:
+                idle.put(connection)
+
+        parts = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(run, *job) for job in jobs]
+            for future in as_completed(futures):
+                part = future.result()
+                parts.append(part)
+                if on_file:
+                    on_file(part['file'])
+        return parts
+
+    def _split(self, connection, plan: dict) -> dict:
+        """Key ranges per table: [(None, None)] unless it is big and has an integer key"""
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s",
+                (db_config.database,)
+            )
+            estimates = {row[0]: row[1] or 0 for row in cursor.fetchall()}
+
+            ranges = {}
+            for table in plan['tables']:
+                name = table['name']
+                parts = -(-estimates.get(name, 0) // self.range_rows)
+                if not table.get('integer_key') or parts < 2:
+                    ranges[name] = [(None, None)]
+                    continue
+                key = table['key'][0]
+                cursor.execute(f"SELECT MIN(`{key}`), MAX(`{key}`) FROM `{name}`")
+                low, high = cursor.fetchone()
+                step = max(1, (high - low + 1) // parts)
+                # Open ends: rows outside [low, high] at snapshot time still land in a part
+                bounds = [None] + [low + step * i for i in range(1, parts)] + [None]
+                ranges[name] = list(zip(bounds, bounds[1:]))
+            return ranges
+        finally:
+            cursor.close()
+
+    def _start_snapshots(self, coordinator, plan: dict, connections: list) -> str:
+        """Open the job connections with consistent snapshots taken while writes are blocked.
+
+        Returns how writes were blocked: a global read lock if the account may
+        take one, read locks on every table otherwise, or 'unsynchronized'
+        when neither is allowed (the snapshots may then differ by the
+        transactions that commit while they are being started).
+        """
+        cursor = coordinator.cursor()
+        method = None
+        try:
+            table_locks = ", ".join(f"`{table['name']}` READ" for table in plan['tables'])
+            for statement, name in (("FLUSH TABLES WITH READ LOCK", 'global_read_lock'),
+                                    (f"LOCK TABLES {table_locks}", 'table_locks')):
+                try:
+                    cursor.execute(statement)
+                    method = name
+                    break
+                except MySQLdb.Error:
+                    continue
+
+            for _ in range(self.jobs):
+                connection = db_config.get_dedicated_connection()
+                connections.append(connection)
+                snapshot_cursor = connection.cursor()
+                snapshot_cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+                snapshot_cursor.close()
+        finally:
+            if method:
+                cursor.execute("UNLOCK TABLES")
+            cursor.close()
+        return method or 'unsynchronized'
+
+    @staticmethod
+    def _write(directory: str, relative_path: str, chunks) -> dict:
+        """Write SQL chunks to a gzip file, return its manifest entry"""
+        started = time.monotonic()
+        sql_bytes = 0
+        rows = 0
+        with gzip.open(os.path.join(directory, relative_path), 'wb', compresslevel=GZIP_LEVEL) as f:
+            for chunk, position in chunks:
+                f.write(chunk)
+                sql_bytes += len(chunk)
+                rows = (position or {}).get('rows') or rows
+        return {
+            'file': relative_path,
+            'rows': rows,
+            'sql_bytes': sql_bytes,
+            'seconds': round(time.monotonic() - started, 3),
+        }
+
+    def _dump_schema(self, dumper: SqlDumper, directory: str, plan: dict) -> dict:
+        chunks = [(dumper.header(plan), None)]
+        chunks += [(dumper.structure(table['name']), None) for table in plan['tables']]
+        return self._write(directory, 'schema.sql.gz', chunks)
+
+    def _dump_part(self, dumper: SqlDumper, directory: str, table: dict, index: int, bounds) -> dict:
+        position = {'part': 0, 'rows': 0, 'after': None}
+        chunks = dumper.rows(0, table, position, bounds=None if bounds == (None, None) else bounds)
+        part = self._write(directory, f"data/{table['name']}.{index:04d}.sql.gz", chunks)
+        part.update({'table': table['name'], 'index': index, 'range': list(bounds)})
+        return part
+
+    def _dump_views(self, dumper: SqlDumper, directory: str, plan: dict) -> dict:
+        return self._write(directory, 'views.sql.gz',
+                           [(dumper.triggers(plan['triggers']) + dumper.views(plan['views']), None)])
+
+    def _manifest(self, plan: dict, parts: list, snapshot: str, seconds: float) -> dict:
+        files = {part['file']: part for part in parts}
+        tables = self._tables(plan['tables'], parts)
+        sql_bytes = sum(part['sql_bytes'] for part in parts)
+        return {
+            'format': ARCHIVE_FORMAT,
+            'version': ARCHIVE_VERSION,
+            'database': db_config.database,
+            'created_at': plan['created_at'],
+            'snapshot': snapshot,
+            'jobs': self.jobs,
+            'schema': files['schema.sql.gz']['file'],
+            'views': files['views.sql.gz']['file'],
+            'view_names': plan['views'],
+            'trigger_names': plan['triggers'],
+            'tables': tables,
+            'rows': sum(table['rows'] for table in tables),
+            'sql_bytes': sql_bytes,
+            'seconds': round(seconds, 3),
+            # Time the parts would have taken one after another
+            'sequential_seconds': round(sum(part['seconds'] for part in parts), 3),
+            'mb_per_s': round(sql_bytes / seconds / 1e6, 2) if seconds else None,
+        }
+
+    @staticmethod
+    def _tables(plan_tables: list, parts: list) -> list:
+        """Manifest entries of the tables, with their parts in key order"""
+        tables = []
+        for table in plan_tables:
+            table_parts = sorted((part for part in parts if part.get('table') == table['name']),
+                                 key=lambda part: part['index'])
+            tables.append({
+                'name': table['name'],
+                'columns': table['columns'],
+                'key': table['key'],
+                'rows': sum(part['rows'] for part in table_parts),
+                'parts': [{key: part[key] for key in ('file', 'range', 'rows', 'sql_bytes', 'seconds')}
+                          for part in table_parts],
+            })
+        return tables
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a parallel backup archive of the database")
+    parser.add_argument('directory')
+    parser.add_argument('--jobs', type=int, default=ARCHIVE_JOBS)
+    parser.add_argument('--range-rows', type=int, default=RANGE_ROWS)
+    args = parser.parse_args()
+
+    manifest = ParallelDumper(args.jobs, args.range_rows).dump(args.directory)
+    print(f"{manifest['rows']} rows, {manifest['sql_bytes'] / 1e6:.1f} MB of SQL in {manifest['seconds']}s "
+          f"({manifest['sequential_seconds']}s sequential, {manifest['mb_per_s']} MB/s, "
+          f"snapshot: {manifest['snapshot']})")
@@ -0,0 +1,442 @@
+"""
+Incremental backups of the append-mostly tables
+
+diario, bagno, idratazione, pressione and peso only grow, apart from the
+occasional delete and the semester rollover, which fills in id_semestre.
+Triggers log the id of every row deleted or updated in these tables to
+registro_modifiche, and every backup records in registro_backup its marks:
+the highest id of each table and the last position in registro_modifiche.
+An incremental backup then holds, compared with the previous backup:
+
+- the rows with an id above the previous high-water mark;
+- the current version of the rows updated since;
+- the tombstones: ids whose previous version is gone (in the manifest);
+- a whole copy of every other table.
+
+Marks and data are read on snapshots started under a read lock (see
+ParallelDumper._start_snapshots): no transaction is committing at that
+moment, so no row can appear later with an id below the mark.
+
+merge turns a full backup and its incrementals into a full archive that
+config.restore loads like any other:
+
+    python -m config.backup_incremental install           # once: changelog table and triggers
+    python -m config.backup_incremental full <directory>
+    python -m config.backup_incremental incremental <directory>
+    python -m config.backup_incremental merge <full> <incremental>... --output <directory>
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import time
+from typing import Optional
+
+from config.backup import read_json
+from config.backup_archive import (ARCHIVE_FORMAT, ARCHIVE_JOBS, ARCHIVE_VERSION, GZIP_LEVEL,
+                                   MANIFEST, ParallelDumper)
+from config.database import db_config
+from config.restore import open_sql
+from config.sql_dump import MAX_INSERT_BYTES, ROWS_PER_INSERT, SqlDumper
+
+INCREMENTAL_TABLES = ('diario', 'bagno', 'idratazione', 'pressione', 'peso')
+CHANGES_TABLE = 'registro_modifiche'
+BACKUPS_TABLE = 'registro_backup'
+
+CREATE_TABLES = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {CHANGES_TABLE} (
+        seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+        tabella VARCHAR(64) NOT NULL,
+        id_riga BIGINT NOT NULL,
+        operazione CHAR(1) NOT NULL,
+        creato_il TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {BACKUPS_TABLE} (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        tipo VARCHAR(16) NOT NULL,
+        id_padre INT NULL,
+        creato_il TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        punti MEDIUMTEXT NOT NULL
+    )
+    """,
+]
+
+TRIGGERS = {'delete': ('DELETE', 'D'), 'update': ('UPDATE', 'U')}
+
+def trigger_name(table: str, event: str) -> str:
+    return f"{table}_backup_{event}"
+
+def incremental_tables(plan: dict) -> list:
+    """Plan entries of the incremental tables: present, with an integer id as first column and key"""
+    return [
+        table for table in plan['tables']
+        if table['name'] in INCREMENTAL_TABLES
+        and table['integer_key'] and table['key'][0] == table['columns'][0]
+    ]
+
+def install() -> list:
+    """Create the bookkeeping tables and the triggers, return the incremental tables"""
+    connection = None
+    cursor = None
+    try:
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        for statement in CREATE_TABLES:
+            cursor.execute(statement)
+        tables = incremental_tables(SqlDumper(connection, db_config.database).plan())
+        for table in tables:
+            name = table['name']
+            for event, (operation, code) in TRIGGERS.items():
+                cursor.execute(f"DROP TRIGGER IF EXISTS `{trigger_name(name, event)}`")
+                cursor.execute(f"""
+                    CREATE TRIGGER `{trigger_name(name, event)}` AFTER {operation} ON `{name}`
+                    FOR EACH ROW INSERT INTO {CHANGES_TABLE} (tabella, id_riga, operazione)
+                    VALUES ('{name}', OLD.`{table['key'][0]}`, '{code}')
+                """)
+        connection.commit()
+        return [table['name'] for table in tables]
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise Exception(f"Error installing the incremental backup triggers: {str(e)}")
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+def check_triggers(connection, tables: list) -> None:
+    """Refuse to rely on a changelog that is not being written (e.g. after a restore)"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT TRIGGER_NAME FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = %s",
+                       (db_config.database,))
+        installed = {row[0] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+    missing = [trigger_name(table['name'], event) for table in tables for event in TRIGGERS
+               if trigger_name(table['name'], event) not in installed]
+    if missing:
+        raise Exception(f"missing triggers {', '.join(missing)}: run "
+                        "python -m config.backup_incremental install, then take a full backup")
+
+def require_lock(snapshot: str) -> None:
+    if snapshot == 'unsynchronized':
+        raise Exception("incremental backups need a consistent snapshot: grant the backup account "
+                        "RELOAD or LOCK TABLES")
+
+def read_marks(connection, tables: list) -> dict:
+    """High-water marks of the incremental tables and of the changelog"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {CHANGES_TABLE}")
+        marks = {'changes': cursor.fetchone()[0], 'tables': {}}
+        for table in tables:
+            cursor.execute(f"SELECT COALESCE(MAX(`{table['key'][0]}`), 0) FROM `{table['name']}`")
+            marks['tables'][table['name']] = {'high': cursor.fetchone()[0], 'columns': table['columns']}
+        return marks
+    finally:
+        cursor.close()
+
+def latest_backup(connection) -> dict:
+    """The last backup of the chain with its marks"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"SELECT id, punti FROM {BACKUPS_TABLE} ORDER BY id DESC LIMIT 1")
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    if row is None:
+        raise Exception("no previous backup: take one with python -m config.backup_incremental full")
+    return {'id': row[0], 'marks': json.loads(row[1])}
+
+def register(connection, kind: str, parent: Optional[dict], marks: dict) -> int:
+    """Record a finished backup and forget the changes the previous one already covered"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"INSERT INTO {BACKUPS_TABLE} (tipo, id_padre, punti) VALUES (%s, %s, %s)",
+                       (kind, parent and parent['id'], json.dumps(marks)))
+        backup_id = cursor.lastrowid
+        if parent:
+            # Changes up to the parent's mark are already covered by two backups
+            cursor.execute(f"DELETE FROM {CHANGES_TABLE} WHERE seq <= %s", (parent['marks']['changes'],))
+        connection.commit()
+        return backup_id
+    except Exception as e:
+        connection.rollback()
+        raise e
+    finally:
+        cursor.close()
+
+def write_manifest(directory: str, manifest: dict) -> None:
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, default=str)
+
+def full_backup(directory: str, jobs: int = ARCHIVE_JOBS) -> dict:
+    """A parallel archive that records the marks incrementals start from"""
+    connection = db_config.get_dedicated_connection()
+    try:
+        plan = SqlDumper(connection, db_config.database).plan()
+        check_triggers(connection, incremental_tables(plan))
+        try:
+            parent = latest_backup(connection)
+        except Exception:
+            parent = None
+    finally:
+        connection.close()
+
+    def on_snapshot(snapshot_connection, snapshot):
+        require_lock(snapshot)
+        return {'marks': read_marks(snapshot_connection, incremental_tables(plan))}
+
+    manifest = ParallelDumper(jobs).dump(directory, on_snapshot=on_snapshot)
+    connection = db_config.get_dedicated_connection()
+    try:
+        manifest['backup_id'] = register(connection, 'full', parent, manifest['marks'])
+    finally:
+        connection.close()
+    manifest.update({'kind': 'full', 'parent': None})
+    write_manifest(directory, manifest)
+    return manifest
+
+class IncrementalDumper(ParallelDumper):
+    """Dump what changed since the previous backup of the chain"""
+
+    def dump(self, directory: str, on_file=None, on_snapshot=None) -> dict:
+        started = time.monotonic()
+        os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+        coordinator = db_config.get_dedicated_connection()
+        connections = []
+
+        try:
+            parent = latest_backup(coordinator)
+            plan = SqlDumper(coordinator, db_config.database).plan()
+            incremental = incremental_tables(plan)
+            check_triggers(coordinator, incremental)
+            for table in incremental:
+                if parent['marks']['tables'].get(table['name'], {}).get('columns') != table['columns']:
+                    raise Exception(f"the columns of {table['name']} changed since the previous backup: "
+                                    "take a full backup")
+            names = [table['name'] for table in incremental]
+            whole = [table for table in plan['tables']
+                     if table['name'] not in names and table['name'] not in (CHANGES_TABLE, BACKUPS_TABLE)]
+            ranges = self._split(coordinator, {'tables': whole})
+
+            snapshot = self._start_snapshots(coordinator, plan, connections)
+            require_lock(snapshot)
+            marks = read_marks(connections[0], incremental)
+            removed = self._removed(connections[0], parent['marks']['changes'], marks['changes'])
+
+            jobs = []
+            for table in incremental:
+                low = parent['marks']['tables'][table['name']]['high']
+                high = marks['tables'][table['name']]['high']
+                # Rows above low are in the range anyway, deleted ones are simply not found
+                updated = sorted(key for key in removed.get(table['name'], ()) if key <= low)
+                jobs.append((self._dump_changes, table, low, high, updated))
+            for table in whole:
+                for index, bounds in enumerate(ranges[table['name']]):
+                    jobs.append((self._dump_part, table, index, bounds))
+            parts = self._run_jobs(connections, directory, jobs, on_file)
+        finally:
+            for connection in connections:
+                connection.close()
+
+        try:
+            backup_id = register(coordinator, 'incremental', parent, marks)
+        finally:
+            coordinator.close()
+
+        tables = self._tables(incremental + whole, parts)
+        for table in tables:
+            table['incremental'] = table['name'] in names
+            if table['incremental']:
+                table['removed'] = sorted(removed.get(table['name'], ()))
+        sql_bytes = sum(part['sql_bytes'] for part in parts)
+        manifest = {
+            'format': ARCHIVE_FORMAT,
+            'version': ARCHIVE_VERSION,
+            'kind': 'incremental',
+            'backup_id': backup_id,
+            'parent': parent['id'],
+            'database': db_config.database,
+            'created_at': plan['created_at'],
+            'snapshot': snapshot,
+            'jobs': self.jobs,
+            'marks': marks,
+            'tables': tables,
+            'rows': sum(table['rows'] for table in tables),
+            'removed': sum(len(table.get('removed', ())) for table in tables),
+            'sql_bytes': sql_bytes,
+            'seconds': round(time.monotonic() - started, 3),
+        }
+        write_manifest(directory, manifest)
+        if on_file:
+            on_file(MANIFEST)
+        return manifest
+
+    @staticmethod
+    def _removed(connection, after: int, until: int) -> dict:
+        """Ids deleted or updated per table between two changelog positions"""
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"SELECT tabella, id_riga FROM {CHANGES_TABLE} WHERE seq > %s AND seq <= %s",
+                           (after, until))
+            removed = {}
+            for table, key in cursor.fetchall():
+                removed.setdefault(table, set()).add(key)
+            return removed
+        finally:
+            cursor.close()
+
+    def _dump_changes(self, dumper: SqlDumper, directory: str, table: dict,
+                      low: int, high: int, updated: list) -> dict:
+        def chunks():
+            rows = 0
+            position = {'part': 0, 'rows': 0, 'after': None}
+            for chunk, position in dumper.rows(0, table, position, bounds=(low + 1, high + 1)):
+                rows = position['rows']
+                yield chunk, {'rows': rows}
+            for chunk, position in dumper.rows_with_keys(table, updated):
+                yield chunk, {'rows': rows + position['rows']}
+
+        part = self._write(directory, f"data/{table['name']}.0000.sql.gz", chunks())
+        part.update({'table': table['name'], 'index': 0, 'range': [low + 1, high + 1]})
+        return part
+
+def filter_rows(source: str, target: str, removed: set) -> dict:
+    """Copy the INSERTs of an archive part without the rows whose id (first column) is in removed"""
+    rows = 0
+    sql_bytes = 0
+    with open_sql(source) as f, gzip.open(target, 'wb', compresslevel=GZIP_LEVEL) as out:
+        insert = None
+        values = []
+        size = 0
+
+        def flush():
+            nonlocal values, size, sql_bytes
+            if values:
+                statement = insert + b",\n".join(values) + b";\n\n"
+                out.write(statement)
+                sql_bytes += len(statement)
+            values = []
+            size = 0
+
+        for line in f:
+            # SqlDumper writes one row per line: literals escape line breaks
+            if line.startswith(b'INSERT INTO'):
+                flush()
+                insert = line
+                continue
+            if not line.startswith(b'('):
+                continue
+            row = line.rstrip(b'\r\n')[:-1]
+            if removed and int(row[1:row.index(b',')]) in removed:
+                continue
+            values.append(row)
+            size += len(row) + 2
+            rows += 1
+            if len(values) >= ROWS_PER_INSERT or size >= MAX_INSERT_BYTES:
+                flush()
+        flush()
+    return {'rows': rows, 'sql_bytes': sql_bytes}
+
+def merge(full: str, incrementals: list, output: str) -> dict:
+    """Combine a full backup and its incrementals, in order, into a full archive in output"""
+    started = time.monotonic()
+    directories = [full] + list(incrementals)
+    manifests = [read_json(os.path.join(directory, MANIFEST)) for directory in directories]
+    base = manifests[0]
+    if base.get('kind') != 'full':
+        raise Exception(f"{full} is not a full backup taken with python -m config.backup_incremental full")
+    for previous, manifest, directory in zip(manifests, manifests[1:], directories[1:]):
+        if manifest.get('kind') != 'incremental' or manifest.get('parent') != previous['backup_id']:
+            raise Exception(f"{directory} does not follow backup {previous['backup_id']}")
+
+    os.makedirs(os.path.join(output, 'data'), exist_ok=True)
+    for name in (base['schema'], base['views']):
+        shutil.copyfile(os.path.join(full, name), os.path.join(output, name))
+
+    base_names = {table['name'] for table in base['tables']}
+    for manifest, directory in zip(manifests[1:], directories[1:]):
+        for table in manifest['tables']:
+            if table['name'] not in base_names:
+                raise Exception(f"{table['name']} is not in the full backup: take a new full backup")
+
+    tables = []
+    for base_table in base['tables']:
+        name = base_table['name']
+        sources = [(directory, table) for directory, manifest in zip(directories, manifests)
+                   for table in manifest['tables'] if table['name'] == name]
+        parts = []
+        if any(table.get('incremental') for _, table in sources):
+            for index, (directory, table) in enumerate(sources):
+                # A row survives unless a later backup has its tombstone
+                removed = set()
+                for _, later in sources[index + 1:]:
+                    removed.update(later.get('removed', ()))
+                for part in table['parts']:
+                    relative_path = f"data/{name}.{len(parts):04d}.sql.gz"
+                    counts = filter_rows(os.path.join(directory, part['file']),
+                                         os.path.join(output, relative_path), removed)
+                    parts.append({'file': relative_path, 'range': part['range'], **counts, 'seconds': 0})
+        else:
+            # Copied whole every time: the latest copy is the right one
+            directory, table = sources[-1]
+            for part in table['parts']:
+                shutil.copyfile(os.path.join(directory, part['file']), os.path.join(output, part['file']))
+                parts.append(dict(part))
+        tables.append({
+            'name': name,
+            'columns': base_table['columns'],
+            'key': base_table['key'],
+            'rows': sum(part['rows'] for part in parts),
+            'parts': parts,
+        })
+
+    last = manifests[-1]
+    manifest = {
+        **base,
+        'kind': 'full',
+        'backup_id': last['backup_id'],
+        'merged_from': [manifest['backup_id'] for manifest in manifests],
+        'created_at': last['created_at'],
+        'marks': last['marks'],
+        'tables': tables,
+        'rows': sum(table['rows'] for table in tables),
+        'sql_bytes': sum(part['sql_bytes'] for table in tables for part in table['parts']),
+        'seconds': round(time.monotonic() - started, 3),
+    }
+    write_manifest(output, manifest)
+    return manifest
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Incremental backups of the append-mostly tables")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('install', help='create the changelog table and its triggers')
+    for name in ('full', 'incremental'):
+        command = commands.add_parser(name, help=f'write a {name} backup into a directory')
+        command.add_argument('directory')
+        command.add_argument('--jobs', type=int, default=ARCHIVE_JOBS)
+    command = commands.add_parser('merge', help='merge a full backup and its incrementals')
+    command.add_argument('full')
+    command.add_argument('incrementals', nargs='*')
+    command.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    if args.command == 'install':
+        print(f"Triggers installed on: {', '.join(install())}")
+    elif args.command == 'merge':
+        manifest = merge(args.full, args.incrementals, args.output)
+        print(f"Backups {manifest['merged_from']} merged: {manifest['rows']} rows in {manifest['seconds']}s")
+    else:
+        if args.command == 'full':
+            manifest = full_backup(args.directory, args.jobs)
+        else:
+            manifest = IncrementalDumper(args.jobs).dump(args.directory)
+        print(f"Backup {manifest['backup_id']} ({args.command}): {manifest['rows']} rows, "
+              f"{manifest['sql_bytes'] / 1e6:.1f} MB of SQL in {manifest['seconds']}s")
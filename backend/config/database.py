@@ -2,34 +2,412 @@
 Database configuration module
 """
 import MySQLdb
-import subprocess
-import tempfile
+import re
+import threading
+import time
 import os
-import datetime
 from typing import Optional
+from flask import current_app, g, has_app_context
+
+from config import request_timing
+from config.metrics import QUERY_BUCKETS, metrics
+from config.query_stats import query_stats
+
+# Key under app.extensions that enables request-scoped connections
+UNIT_OF_WORK = 'unit_of_work'
+
+# Connections abandoned by a forked child. They share their socket with the
+# parent process, so they must never be closed (closing sends COM_QUIT on the
+# parent's session) nor garbage collected (which closes them implicitly).
+_orphaned_connections = []
+
+# Statements that never need a transaction: they run in autocommit mode
+READ_ONLY_STATEMENTS = ('SELECT', 'SHOW', 'DESCRIBE', 'DESC', 'EXPLAIN', 'WITH', 'SET')
+
+# SELECT ... FOR UPDATE / FOR SHARE only hold their locks inside a transaction
+LOCKING_READ = re.compile(r'\bFOR\s+(UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b', re.IGNORECASE)
+
+def is_read_only(query: str) -> bool:
+    """Whether a statement can run outside a transaction"""
+    if isinstance(query, bytes):
+        query = query.decode('latin-1')  # statements read from a dump file
+    words = query.lstrip(' \t\r\n(').split(None, 1)
+    if not words:
+        return True
+    return words[0].upper() in READ_ONLY_STATEMENTS and not LOCKING_READ.search(query)
+
+class LazyTransactionCursor:
+    """Cursor that opens a transaction on its connection right before the first write.
+
+    Every statement is timed, recorded by config.query_stats and config.metrics
+    and added to the request's "db" span (config.request_timing).
+    """
+
+    def __init__(self, connection: 'PooledConnection', cursor):
+        self._connection = connection
+        self._cursor = cursor
+
+    def execute(self, query, args=None):
+        self._connection._begin_if_write(query)
+        started = time.perf_counter()
+        result = self._cursor.execute(query, args)
+        elapsed = time.perf_counter() - started
+        request_timing.add('db', elapsed)
+        metrics.observe('cdd_db_query_duration_seconds', elapsed, QUERY_BUCKETS)
+        query_stats.record(query, args, elapsed, self._cursor.rowcount)
+        return result
+
+    def executemany(self, query, args):
+        self._connection._begin_if_write(query)
+        started = time.perf_counter()
+        result = self._cursor.executemany(query, args)
+        elapsed = time.perf_counter() - started
+        request_timing.add('db', elapsed)
+        metrics.observe('cdd_db_query_duration_seconds', elapsed, QUERY_BUCKETS)
+        query_stats.record(query, None, elapsed, self._cursor.rowcount, explain=False)
+        return result
+
+    @property
+    def in_transaction(self) -> bool:
+        """Whether the connection has uncommitted writes (which its reads see)"""
+        return self._connection.in_transaction
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class PooledConnection:
+    """Connection borrowed from the pool: close() gives it back instead of closing it.
+
+    Pooled connections run in autocommit mode, so reads never open a
+    transaction and commit()/rollback() cost nothing when nothing was written.
+    A transaction is started lazily by the first write statement.
+    """
+
+    def __init__(self, pool: 'ConnectionPool', raw):
+        self._pool = pool
+        self._raw = raw
+        self.in_transaction = False
+        self._after_commit = []
+
+    def cursor(self, *args):
+        return LazyTransactionCursor(self, self._get_raw().cursor(*args))
+
+    def _begin_if_write(self, query: str) -> None:
+        if not self.in_transaction and not is_read_only(query):
+            self._get_raw().begin()
+            self.in_transaction = True
+
+    def after_commit(self, callback) -> None:
+        """Call callback once the open transaction commits (at once if there is none).
+
+        Dropped if the transaction is rolled back.
+        """
+        if not self.in_transaction:
+            callback()
+            return
+        self._after_commit.append(callback)
+
+    def commit(self) -> None:
+        """Commit the open transaction, if any"""
+        if self.in_transaction:
+            self._get_raw().commit()
+            self.in_transaction = False
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error after commit: {e}")
+
+    def rollback(self) -> None:
+        """Roll back the open transaction, if any"""
+        self._after_commit = []
+        if self.in_transaction:
+            self.in_transaction = False
+            self._get_raw().rollback()
+
+    def close(self) -> None:
+        """Return the connection to the pool, rolling back an unfinished transaction"""
+        if self._raw is None:
+            return
+        self._after_commit = []
+        raw, self._raw = self._raw, None
+        if self.in_transaction:
+            self.in_transaction = False
+            try:
+                raw.rollback()
+            except MySQLdb.Error:
+                self._pool.discard(raw)
+                return
+        self._pool.release(raw)
+
+    def discard(self) -> None:
+        """Close the connection instead of returning it, e.g. after changing session variables"""
+        if self._raw is None:
+            return
+        raw, self._raw = self._raw, None
+        self.in_transaction = False
+        self._after_commit = []
+        self._pool.discard(raw)
+
+    def _get_raw(self):
+        if self._raw is None:
+            raise Exception("Connection already returned to the pool")
+        return self._raw
+
+    def __getattr__(self, name):
+        return getattr(self._get_raw(), name)
+
+class RequestConnection(PooledConnection):
+    """Connection shared by every DAO call of one request (see config.unit_of_work).
+
+    DAOs keep calling commit() and close() as usual: both are deferred to the
+    end of the request, where the whole request is committed or rolled back once.
+    """
+
+    def __init__(self, pool: 'ConnectionPool', raw):
+        super().__init__(pool, raw)
+        self.failed = False
+
+    def commit(self) -> None:
+        """Deferred: the unit of work commits when the request ends"""
+
+    def rollback(self) -> None:
+        """Roll back immediately and make sure nothing else in this request is committed"""
+        self.failed = True
+        super().rollback()
+
+    def close(self) -> None:
+        """Deferred: the unit of work releases the connection when the request ends"""
+
+    def finish(self, commit: bool) -> None:
+        """Commit or roll back the request's transaction and return the connection"""
+        try:
+            if commit and not self.failed:
+                PooledConnection.commit(self)
+        finally:
+            PooledConnection.close(self)
+
+class ConnectionPool:
+    """Per-process pool of MySQL connections"""
+
+    def __init__(self, connect, min_size: int = 1, max_size: int = 5,
+                 idle_timeout: float = 300.0, checkout_timeout: float = 10.0,
+                 ping_interval: float = 5.0):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.ping_interval = ping_interval
+
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, returned_at), most recently used last
+        self._size = 0   # idle + checked out
+        self._pid = os.getpid()
+        self._counters = self._new_counters()
+
+    @staticmethod
+    def _new_counters() -> dict:
+        return {
+            'checkouts': 0,      # successful acquire() calls
+            'hits': 0,           # served by an idle connection
+            'misses': 0,         # required a new MySQLdb.connect
+            'waits': 0,          # had to wait because the pool was full
+            'timeouts': 0,       # gave up waiting
+            'ping_failures': 0,  # idle connection found dead on checkout
+            'evictions': 0,      # closed after idle_timeout
+        }
+
+    def _check_pid(self) -> None:
+        """Drop connections inherited from the parent after a fork (gunicorn workers)"""
+        if self._pid != os.getpid():
+            self.reset()
+
+    def reset(self) -> None:
+        """Forget every pooled connection without touching their sockets"""
+        with self._cond:
+            _orphaned_connections.extend(raw for raw, _ in self._idle)
+            self._idle = []
+            self._size = 0
+            self._pid = os.getpid()
+            self._counters = self._new_counters()
+            self._cond.notify_all()
+
+    def acquire(self):
+        """Check out a healthy connection, connecting or waiting if needed"""
+        self._check_pid()
+        deadline = time.monotonic() + self.checkout_timeout
+        waited = False
+        evicted = []
+
+        with self._cond:
+            while True:
+                evicted.extend(self._evict_idle())
+                if self._idle:
+                    raw, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    raw, returned_at = None, None
+                    break
+                if not waited:
+                    self._counters['waits'] += 1
+                    waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise Exception(f"Database connection pool exhausted ({self.max_size} connections in use)")
+                self._cond.wait(remaining)
+
+        for connection in evicted:
+            self._close_quietly(connection)
+
+        if raw is not None and time.monotonic() - returned_at >= self.ping_interval:
+            try:
+                raw.ping()
+            except MySQLdb.Error:
+                with self._cond:
+                    self._counters['ping_failures'] += 1
+                self._close_quietly(raw)
+                raw = None
+
+        if raw is None:
+            try:
+                raw = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._counters['misses'] += 1
+        else:
+            with self._cond:
+                self._counters['hits'] += 1
+
+        with self._cond:
+            self._counters['checkouts'] += 1
+        return raw
+
+    def release(self, raw) -> None:
+        """Give back a connection with no open transaction"""
+        if self._pid != os.getpid():
+            _orphaned_connections.append(raw)
+            return
+
+        with self._cond:
+            self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, raw) -> None:
+        """Close a checked-out connection that can no longer be reused"""
+        self._close_quietly(raw)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _evict_idle(self) -> list:
+        """Remove connections idle for too long, keeping at least min_size open (lock held)"""
+        evicted = []
+        now = time.monotonic()
+        while (self._idle and self._size > self.min_size
+               and now - self._idle[0][1] > self.idle_timeout):
+            raw, _ = self._idle.pop(0)
+            self._size -= 1
+            self._counters['evictions'] += 1
+            evicted.append(raw)
+        return evicted
+
+    @staticmethod
+    def _close_quietly(raw) -> None:
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        """Pool counters and current occupancy for this worker"""
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                'pid': self._pid,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            })
+            return stats
 
 class DatabaseConfig:
     """Database configuration and connection management"""
     
-    def __init__(self):
-        self.host = "localhost"
-        self.user = "mybackenduser"
-        self.password = "password"
-        self.database = "cdd_legrigne"
+    def __init__(self, pool_min_size: int = 1, pool_max_size: int = 5,
+                 pool_idle_timeout: float = 300.0, pool_checkout_timeout: float = 10.0,
+                 pool_ping_interval: float = 5.0):
+        # Overridable so that a load test can point a server at a stand-in database
+        self.host = os.environ.get('DB_HOST', "localhost")
+        self.user = os.environ.get('DB_USER', "mybackenduser")
+        self.password = os.environ.get('DB_PASSWORD', "password")
+        self.database = os.environ.get('DB_NAME', "cdd_legrigne")
+        self.pool = ConnectionPool(
+            self._connect,
+            min_size=pool_min_size,
+            max_size=pool_max_size,
+            idle_timeout=pool_idle_timeout,
+            checkout_timeout=pool_checkout_timeout,
+            ping_interval=pool_ping_interval
+        )
     
-    def get_connection(self) -> MySQLdb.Connection:
-        """Get database connection"""
-        try:
-            connection = MySQLdb.connect(
-                host=self.host,
-                user=self.user,
-                passwd=self.password,
-                db=self.database
-            )
+    def _connect(self) -> MySQLdb.Connection:
+        """Open a new physical connection"""
+        return MySQLdb.connect(
+            host=self.host,
+            user=self.user,
+            passwd=self.password,
+            db=self.database,
+            autocommit=True
+        )
+    
+    def get_connection(self) -> PooledConnection:
+        """Borrow a connection from the pool; close() returns it.
+
+        Inside a Flask app context with the unit of work enabled, every call
+        returns the same request-scoped connection.
+        """
+        if has_app_context() and UNIT_OF_WORK in current_app.extensions:
+            connection = g.get('db_connection')
+            if connection is None:
+                connection = g.db_connection = RequestConnection(self.pool, self._acquire())
             return connection
+        return PooledConnection(self.pool, self._acquire())
+    
+    def get_dedicated_connection(self) -> PooledConnection:
+        """Borrow a connection outside the request's unit of work.
+
+        For work that outlives the view function, such as a streamed response:
+        the request-scoped connection is released as soon as the view returns.
+        """
+        return PooledConnection(self.pool, self._acquire())
+    
+    def _acquire(self):
+        try:
+            return self.pool.acquire()
         except MySQLdb.Error as e:
             raise Exception(f"Database connection failed: {e}")
     
+    def pool_stats(self) -> dict:
+        """Connection pool statistics for the current worker"""
+        return self.pool.stats()
+    
+    def reset_pool(self) -> None:
+        """Forget connections inherited from a parent process (call after fork)"""
+        self.pool.reset()
+    
     def execute_query(self, query: str, params: Optional[tuple] = None):
         """Execute a query and return results"""
         connection = None
@@ -61,151 +439,6 @@ class DatabaseConfig:
                 cursor.close()
             if connection:
                 connection.close()
-    
-    def backup_database(self) -> str:
-        """Generate a complete SQL backup of the database including structure and data"""
-        try:
-            # Use mysqldump to create a complete backup
-            cmd = [
-                'mysqldump',
-                f'--host={self.host}',
-                f'--user={self.user}',
-                f'--password={self.password}',
-                '--single-transaction',  # Ensures consistency
-                '--routines',            # Include stored procedures and functions
-                '--triggers',            # Include triggers
-                '--events',              # Include events
-                '--add-drop-table',      # Add DROP TABLE statements
-                '--create-options',      # Include table creation options
-                '--extended-insert',     # Use extended INSERT syntax for efficiency
-                '--set-charset',         # Add charset information
-                self.database
-            ]
-            
-            # Execute mysqldump and capture output
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            
-            backup_sql = result.stdout
-            
-            # Process the backup to uncomment view definitions
-            lines = backup_sql.split('\n')
-            processed_lines = []
-            
-            for line in lines:
-                # Remove MySQL version-specific comment syntax for views
-                if line.startswith('/*!50001 ') and line.endswith(' */'):
-                    # Extract the actual SQL from the comment
-                    processed_line = line[9:-3]  # Remove /*!50001 and */
-                    processed_lines.append(processed_line)
-                elif line.startswith('/*!50013 ') and line.endswith(' */'):
-                    # Extract the actual SQL from the comment
-                    processed_line = line[9:-3]  # Remove /*!50013 and */
-                    processed_lines.append(processed_line)
-                else:
-                    processed_lines.append(line)
-            
-            return '\n'.join(processed_lines)
-            
-        except subprocess.CalledProcessError as e:
-            raise Exception(f"Database backup failed: {e.stderr}")
-        except Exception as e:
-            raise Exception(f"Database backup error: {str(e)}")
-    
-    def backup_database_python(self) -> str:
-        """Alternative backup method using pure Python (fallback if mysqldump not available)"""
-        connection = None
-        cursor = None
-        sql_backup = []
-        
-        try:
-            connection = self.get_connection()
-            cursor = connection.cursor()
-            
-            # Get all table names (excluding views)
-            cursor.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
-            tables = [table[0] for table in cursor.fetchall()]
-            
-            # Get all view names
-            cursor.execute("SHOW FULL TABLES WHERE Table_type = 'VIEW'")
-            views = [view[0] for view in cursor.fetchall()]
-            
-            sql_backup.append("-- Database backup generated by CDD Legrigne")
-            sql_backup.append(f"-- Database: {self.database}")
-            sql_backup.append("-- Generated on: " + str(datetime.datetime.now()))
-            sql_backup.append("")
-            sql_backup.append("SET FOREIGN_KEY_CHECKS = 0;")
-            sql_backup.append("")
-            
-            # Process tables
-            for table in tables:
-                # Get table structure
-                cursor.execute(f"SHOW CREATE TABLE `{table}`")
-                create_table = cursor.fetchone()[1]
-                sql_backup.append(f"-- Structure for table `{table}`")
-                sql_backup.append(f"DROP TABLE IF EXISTS `{table}`;")
-                sql_backup.append(create_table + ";")
-                sql_backup.append("")
-                
-                # Get table data
-                cursor.execute(f"SELECT * FROM `{table}`")
-                rows = cursor.fetchall()
-                
-                if rows:
-                    # Get column information
-                    cursor.execute(f"DESCRIBE `{table}`")
-                    columns = [col[0] for col in cursor.fetchall()]
-                    
-                    sql_backup.append(f"-- Data for table `{table}`")
-                    
-                    for row in rows:
-                        values = []
-                        for value in row:
-                            if value is None:
-                                values.append("NULL")
-                            elif isinstance(value, str):
-                                # Escape single quotes in strings
-                                escaped_value = value.replace("'", "''")
-                                values.append(f"'{escaped_value}'")
-                            elif isinstance(value, bytes):
-                                # Handle binary data
-                                values.append(f"0x{value.hex()}")
-                            else:
-                                values.append(str(value))
-                        
-                        column_list = ", ".join([f"`{col}`" for col in columns])
-                        value_list = ", ".join(values)
-                        sql_backup.append(f"INSERT INTO `{table}` ({column_list}) VALUES ({value_list});")
-                    
-                    sql_backup.append("")
-            
-            # Process views (structure only, no data)
-            for view in views:
-                try:
-                    cursor.execute(f"SHOW CREATE VIEW `{view}`")
-                    create_view = cursor.fetchone()[1]
-                    sql_backup.append(f"-- View structure for `{view}`")
-                    sql_backup.append(f"DROP VIEW IF EXISTS `{view}`;")
-                    sql_backup.append(create_view + ";")
-                    sql_backup.append("")
-                except Exception as e:
-                    sql_backup.append(f"-- Error creating view {view}: {str(e)}")
-                    sql_backup.append("")
-            
-            sql_backup.append("SET FOREIGN_KEY_CHECKS = 1;")
-            return "\n".join(sql_backup)
-            
-        except Exception as e:
-            raise Exception(f"Python backup failed: {str(e)}")
-        finally:
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
 
 # Global database instance
 db_config = DatabaseConfig()
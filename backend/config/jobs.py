@@ -0,0 +1,499 @@
+"""
+Durable background jobs, run by a worker process next to gunicorn
+
+Backups, restores, the semester rollover and the appreciation graphs take
+longer than a request should, and a gunicorn thread busy with them is
+one less for data entry. The web workers enqueue them in lavori (migration
+4) and answer at once; worker.py takes them from there, one thread per
+queue, so that a long backup never holds up the graphs. The owner follows a
+job through /jobs (servlets.jobs_servlet): state, progress, result, the
+files it wrote under JOBS_DIR/<id>, and cancellation.
+
+A job kind is a function(context, params) registered with @job_kind; its
+JobContext reports progress, tells it whether it was cancelled and where to
+put its result files. A running job refreshes its heartbeat every
+HEARTBEAT_INTERVAL: if its worker dies, the job is queued again (up to
+MAX_ATTEMPTS times), so every job kind must be safe to run again.
+
+With JOBS_WORKER=0 (the Flask dev server, without worker.py) jobs run in a
+thread of the process that enqueued them.
+"""
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from config.database import db_config
+from config.metrics import metrics
+from config.migrations import JOBS_TABLE
+from config.query_stats import process_alive
+
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'cdd_jobs'))
+JOBS_WORKER = os.environ.get('JOBS_WORKER', '1') != '0'
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+JOB_FINISHED = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+DEFAULT_QUEUE = 'default'
+PROGRESS_INTERVAL = 1          # seconds between progress writes of a running job
+HEARTBEAT_INTERVAL = 10        # seconds between heartbeats (and cancellation checks) without progress
+STALE_AFTER = 60               # seconds without a heartbeat before a running job counts as interrupted
+MAX_ATTEMPTS = 3
+JOB_FILES_MAX_AGE = 24 * 3600  # seconds the result files of a finished job are kept
+JOB_ROWS_MAX_AGE = 30          # days a finished job stays listed
+
+COLUMNS = ("id, tipo, coda, parametri, stato, annullato, avanzamento, risultato, errore, id_account, "
+           "tentativi, creato_il, iniziato_il, finito_il")
+
+class JobCancelled(Exception):
+    """Raised by JobContext.check once the owner has cancelled the job"""
+
+class JobInterrupted(Exception):
+    """Raised by JobContext.check while the worker stops: the job is queued again"""
+
+@dataclass
+class JobKind:
+    name: str
+    run: Callable[['JobContext', dict], object]
+    queue: str
+    cancellable: bool
+
+JOB_KINDS = {}
+
+def job_kind(name: str, queue: str = DEFAULT_QUEUE, cancellable: bool = True):
+    """Register function(context, params) -> JSON result as the job kind name.
+
+    Every job can be cancelled while queued, only cancellable kinds while
+    running: they must call context.check() often enough for it to matter.
+    """
+    def register(run):
+        JOB_KINDS[name] = JobKind(name, run, queue, cancellable)
+        return run
+    return register
+
+def queues() -> List[str]:
+    return sorted({kind.queue for kind in JOB_KINDS.values()})
+
+def job_directory(job_id: int) -> str:
+    return os.path.join(JOBS_DIR, str(job_id))
+
+def artifacts(job_id: int) -> List[dict]:
+    """name and size of the result files of a job"""
+    try:
+        entries = sorted(os.scandir(job_directory(job_id)), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return []
+    return [{'name': entry.name, 'size': entry.stat().st_size} for entry in entries if entry.is_file()]
+
+def artifact_path(job_id: int, name: str) -> Optional[str]:
+    """Path of a result file of a job, None if there is no such file"""
+    if not name or os.path.basename(name) != name or name.startswith('.'):
+        return None
+    path = os.path.join(job_directory(job_id), name)
+    return path if os.path.isfile(path) else None
+
+def _job(row) -> dict:
+    kind = JOB_KINDS.get(row[1])
+    return {
+        'id': row[0],
+        'kind': row[1],
+        'queue': row[2],
+        'params': json.loads(row[3]),
+        'state': row[4],
+        'cancel_requested': bool(row[5]),
+        'cancellable': row[4] == JOB_QUEUED or (row[4] == JOB_RUNNING and kind is not None and kind.cancellable),
+        'progress': json.loads(row[6]) if row[6] else None,
+        'result': json.loads(row[7]) if row[7] else None,
+        'error': row[8],
+        'owner': row[9],
+        'attempts': row[10],
+        'created_at': str(row[11]),
+        'started_at': str(row[12]) if row[12] else None,
+        'finished_at': str(row[13]) if row[13] else None,
+    }
+
+def enqueue(kind: str, params: dict, owner: Optional[int] = None, key: Optional[str] = None) -> int:
+    """Queue a job, return its id.
+
+    With a key, a job of the same kind and key still queued or running is
+    returned instead of queueing another. Inside a request the job is
+    committed, and so visible to the worker, with the rest of the request;
+    with JOBS_WORKER=0 its thread starts only then.
+    """
+    if kind not in JOB_KINDS:
+        raise Exception(f"Unknown job kind: {kind}")
+
+    connection = None
+    cursor = None
+
+    try:
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        if key is not None:
+            cursor.execute(f"""
+                SELECT id FROM {JOBS_TABLE} WHERE tipo = %s AND chiave = %s AND stato IN (%s, %s)
+                ORDER BY id DESC LIMIT 1
+            """, (kind, key, JOB_QUEUED, JOB_RUNNING))
+            row = cursor.fetchone()
+            if row is not None:
+                return row[0]
+        cursor.execute(
+            f"INSERT INTO {JOBS_TABLE} (tipo, coda, chiave, parametri, stato, id_account) "
+            "VALUES (%s, %s, %s, %s, %s, %s)",
+            (kind, JOB_KINDS[kind].queue, key, json.dumps(params, default=str), JOB_QUEUED, owner)
+        )
+        job_id = cursor.lastrowid
+        if not JOBS_WORKER:
+            # claim() runs on another connection: it sees the job once committed
+            connection.after_commit(
+                lambda: threading.Thread(target=run_inline, args=(job_id,), daemon=True).start()
+            )
+        connection.commit()
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise Exception(f"Error queueing a {kind} job: {str(e)}")
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+    return job_id
+
+def get_job(job_id: int) -> Optional[dict]:
+    """A job with its result files, None if there is no such job"""
+    connection = None
+    cursor = None
+
+    try:
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT {COLUMNS} FROM {JOBS_TABLE} WHERE id = %s", (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        job = _job(row)
+        job['artifacts'] = artifacts(job_id)
+        return job
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise e
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+def list_jobs(owner: Optional[int] = None, limit: int = 20) -> List[dict]:
+    """The latest jobs, of one owner or (None) of everyone, newest first"""
+    connection = None
+    cursor = None
+
+    try:
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        owner_constraint = "WHERE id_account = %s" if owner is not None else ""
+        cursor.execute(
+            f"SELECT {COLUMNS} FROM {JOBS_TABLE} {owner_constraint} ORDER BY id DESC LIMIT %s",
+            (owner, limit) if owner is not None else (limit,)
+        )
+        return [_job(row) for row in cursor.fetchall()]
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise e
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+def cancel_job(job_id: int) -> None:
+    """Cancel a queued job now, ask a running one to stop at its next check"""
+    connection = None
+    cursor = None
+
+    try:
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        cursor.execute(
+            f"UPDATE {JOBS_TABLE} SET stato = %s, annullato = 1, finito_il = NOW() WHERE id = %s AND stato = %s",
+            (JOB_CANCELLED, job_id, JOB_QUEUED)
+        )
+        if cursor.rowcount == 0:
+            cursor.execute(f"UPDATE {JOBS_TABLE} SET annullato = 1 WHERE id = %s AND stato = %s",
+                           (job_id, JOB_RUNNING))
+        connection.commit()
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise Exception(f"Error cancelling job {job_id}: {str(e)}")
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+class JobContext:
+    """What a running job sees of itself: progress, cancellation and result files"""
+
+    def __init__(self, job: dict, worker: str, stopping: threading.Event):
+        self.id = job['id']
+        self.kind = job['kind']
+        self.owner = job['owner']
+        self.directory = job_directory(self.id)
+        self.worker = worker
+        self._stopping = stopping
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+        self._progress = job['progress']
+        self._written_at = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def progress(self, progress) -> None:
+        """Report the progress (any JSON value), written at most every PROGRESS_INTERVAL"""
+        with self._lock:
+            self._progress = progress
+        if time.monotonic() - self._written_at >= PROGRESS_INTERVAL:
+            self.beat()
+
+    def check(self) -> None:
+        """Raise JobCancelled or JobInterrupted if the job should stop"""
+        if self._cancelled.is_set():
+            raise JobCancelled(f"job {self.id} cancelled")
+        if self._stopping.is_set():
+            raise JobInterrupted(f"job {self.id} interrupted: the worker is stopping")
+
+    def artifact_path(self, name: str) -> str:
+        """Where to write the result file name"""
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        return os.path.join(self.directory, name)
+
+    def beat(self) -> None:
+        """Write the progress and heartbeat, and read whether the job was cancelled"""
+        with self._lock:
+            self._written_at = time.monotonic()
+            progress = json.dumps(self._progress, default=str)
+            connection = None
+            cursor = None
+            try:
+                connection = db_config.get_dedicated_connection()
+                cursor = connection.cursor()
+                cursor.execute(
+                    f"UPDATE {JOBS_TABLE} SET avanzamento = %s, battito = NOW() WHERE id = %s AND esecutore = %s",
+                    (progress, self.id, self.worker)
+                )
+                cursor.execute(f"SELECT annullato FROM {JOBS_TABLE} WHERE id = %s", (self.id,))
+                row = cursor.fetchone()
+                if row and row[0]:
+                    self._cancelled.set()
+                connection.commit()
+            except Exception as e:
+                print(f"Error updating job {self.id}: {e}")
+            finally:
+                if cursor:
+                    cursor.close()
+                if connection:
+                    connection.close()
+
+    def _heartbeat(self) -> None:
+        while not self._finished.wait(HEARTBEAT_INTERVAL):
+            self.beat()
+
+def claim(worker: str, queue: Optional[str] = None, job_id: Optional[int] = None) -> Optional[dict]:
+    """Mark the oldest queued job of queue (or job job_id) as running for worker and return it"""
+    connection = None
+    cursor = None
+
+    try:
+        connection = db_config.get_dedicated_connection()
+        cursor = connection.cursor()
+        constraint, params = ("coda = %s", queue) if job_id is None else ("id = %s", job_id)
+        cursor.execute(f"""
+            UPDATE {JOBS_TABLE}
+            SET stato = %s, esecutore = %s, tentativi = tentativi + 1, battito = NOW(),
+                iniziato_il = IFNULL(iniziato_il, NOW())
+            WHERE stato = %s AND {constraint}
+            ORDER BY id LIMIT 1
+        """, (JOB_RUNNING, worker, JOB_QUEUED, params))
+        if cursor.rowcount == 0:
+            connection.commit()
+            return None
+        cursor.execute(
+            f"SELECT {COLUMNS} FROM {JOBS_TABLE} WHERE stato = %s AND esecutore = %s AND {constraint} "
+            "ORDER BY id DESC LIMIT 1",
+            (JOB_RUNNING, worker, params)
+        )
+        row = cursor.fetchone()
+        connection.commit()
+        return _job(row) if row else None
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise e
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+def _finish(job_id: int, worker: str, state: str, progress=None, result=None, error: Optional[str] = None) -> None:
+    connection = None
+    cursor = None
+
+    try:
+        connection = db_config.get_dedicated_connection()
+        cursor = connection.cursor()
+        if state == JOB_QUEUED:
+            # Interrupted on purpose: does not count as an attempt
+            cursor.execute(f"""
+                UPDATE {JOBS_TABLE} SET stato = %s, esecutore = NULL, tentativi = tentativi - 1, avanzamento = %s
+                WHERE id = %s AND esecutore = %s AND stato = %s
+            """, (JOB_QUEUED, json.dumps(progress, default=str), job_id, worker, JOB_RUNNING))
+        else:
+            cursor.execute(f"""
+                UPDATE {JOBS_TABLE}
+                SET stato = %s, avanzamento = %s, risultato = %s, errore = %s, finito_il = NOW()
+                WHERE id = %s AND esecutore = %s AND stato = %s
+            """, (state, json.dumps(progress, default=str), json.dumps(result, default=str), error,
+                  job_id, worker, JOB_RUNNING))
+        connection.commit()
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+def run_job(job: dict, worker: str, stopping: threading.Event) -> str:
+    """Run a claimed job to its end and record the outcome; returns the job's new state"""
+    context = JobContext(job, worker, stopping)
+    kind = JOB_KINDS.get(job['kind'])
+    heartbeat = threading.Thread(target=context._heartbeat, daemon=True)
+    heartbeat.start()
+    result = None
+    error = None
+    started = time.monotonic()
+    try:
+        if kind is None:
+            raise Exception(f"Unknown job kind: {job['kind']}")
+        result = kind.run(context, job['params'])
+        state = JOB_DONE
+    except JobCancelled:
+        state = JOB_CANCELLED
+    except JobInterrupted:
+        state = JOB_QUEUED
+    except Exception as e:
+        state = JOB_FAILED
+        error = str(e)
+        print(f"Job {job['id']} ({job['kind']}) failed: {error}")
+    finally:
+        context._finished.set()
+        heartbeat.join()
+
+    try:
+        _finish(job['id'], worker, state, context._progress, result, error)
+    except Exception as e:
+        print(f"Error recording the end of job {job['id']}: {e}")
+    if state != JOB_QUEUED:
+        metrics.inc('cdd_jobs_total', kind=job['kind'], state=state)
+        print(f"Job {job['id']} ({job['kind']}): {state} in {time.monotonic() - started:.1f}s")
+    return state
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def run_inline(job_id: int) -> None:
+    """Run a job in this process (JOBS_WORKER=0)"""
+    try:
+        worker = f"{worker_name()}:{threading.get_ident()}"
+        job = claim(worker, job_id=job_id)
+        if job is not None:
+            run_job(job, worker, threading.Event())
+    except Exception as e:
+        print(f"Error running job {job_id}: {e}")
+
+def requeue_interrupted() -> List[int]:
+    """Queue again the running jobs whose worker died, fail those out of attempts; return their ids.
+
+    A worker is dead when its heartbeat is older than STALE_AFTER, or at
+    once when it was a process of this host that no longer exists.
+    """
+    connection = None
+    cursor = None
+
+    try:
+        connection = db_config.get_dedicated_connection()
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            SELECT id, esecutore, battito < NOW() - INTERVAL %s SECOND FROM {JOBS_TABLE} WHERE stato = %s
+        """, (STALE_AFTER, JOB_RUNNING))
+        host = socket.gethostname()
+        interrupted = []
+        for job_id, worker, stale in cursor.fetchall():
+            parts = (worker or '').split(':')
+            dead = len(parts) >= 2 and parts[0] == host and parts[1].isdigit() and not process_alive(int(parts[1]))
+            if stale or dead:
+                interrupted.append((job_id, worker))
+        for job_id, worker in interrupted:
+            cursor.execute(f"""
+                UPDATE {JOBS_TABLE}
+                SET stato = IF(tentativi >= %s, %s, %s), esecutore = NULL,
+                    errore = IF(tentativi >= %s, %s, errore), finito_il = IF(tentativi >= %s, NOW(), NULL)
+                WHERE id = %s AND stato = %s AND esecutore <=> %s
+            """, (MAX_ATTEMPTS, JOB_FAILED, JOB_QUEUED,
+                  MAX_ATTEMPTS, f"interrupted {MAX_ATTEMPTS} times", MAX_ATTEMPTS,
+                  job_id, JOB_RUNNING, worker))
+        connection.commit()
+        return [job_id for job_id, _ in interrupted]
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise e
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+def cleanup_old_jobs() -> None:
+    """Remove the result files of jobs finished JOB_FILES_MAX_AGE ago, and the oldest finished jobs"""
+    connection = None
+    cursor = None
+
+    try:
+        connection = db_config.get_dedicated_connection()
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            DELETE FROM {JOBS_TABLE} WHERE stato IN (%s, %s, %s) AND finito_il < NOW() - INTERVAL %s DAY
+        """, (*JOB_FINISHED, JOB_ROWS_MAX_AGE))
+        cursor.execute(f"SELECT id FROM {JOBS_TABLE} WHERE stato IN (%s, %s)", (JOB_QUEUED, JOB_RUNNING))
+        unfinished = {str(row[0]) for row in cursor.fetchall()}
+        connection.commit()
+
+        if os.path.exists(JOBS_DIR):
+            current_time = time.time()
+            for entry in os.scandir(JOBS_DIR):
+                if (entry.is_dir() and entry.name not in unfinished
+                        and current_time - entry.stat().st_mtime > JOB_FILES_MAX_AGE):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+    except Exception as e:
+        print(f"Error cleaning up old jobs: {e}")
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
@@ -0,0 +1,329 @@
+"""
+Prometheus metrics shared by all gunicorn workers
+
+Each process (gunicorn workers and their graph rendering processes) keeps
+its counters, gauges and histograms in memory and a background thread writes
+them to METRICS_DIR/metrics-<pid>.json every FLUSH_INTERVAL seconds. /metrics
+adds up the files of the live processes; the counters and histograms of
+processes that exited are folded into retired.json so that totals never go
+backwards when gunicorn recycles a worker, while their gauges are dropped.
+"""
+import fcntl
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+from typing import Callable, List, Optional
+
+from flask import Flask, g, request
+
+from config.query_stats import process_alive
+
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'cdd_metrics'))
+METRICS_ENABLED = os.environ.get('METRICS', '1') != '0'
+FLUSH_INTERVAL = 1  # seconds: how stale another worker's numbers can be on a scrape
+RETIRED = os.path.join(METRICS_DIR, 'retired.json')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+RENDER_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# name: (type, help); every metric written by this app must be listed here
+METRICS = {
+    'cdd_http_requests_total': ('counter', 'HTTP requests by route and status'),
+    'cdd_http_request_duration_seconds': ('histogram', 'Time spent in the Flask view and its hooks'),
+    'cdd_http_requests_in_flight': ('gauge', 'Requests being handled right now'),
+    'cdd_db_query_duration_seconds': ('histogram', 'Statements run through the connection pool'),
+    'cdd_db_pool_connections': ('gauge', 'Pooled database connections by state'),
+    'cdd_db_pool_events_total': ('counter', 'Connection pool checkouts, hits, misses, waits, timeouts...'),
+    'cdd_chart_render_seconds': ('histogram', 'Chart renders (plot cache misses) by chart kind'),
+    'cdd_plot_cache_events_total': ('counter', 'Plot cache hits, misses and evictions'),
+    'cdd_appreciation_graph_queue_depth': ('gauge', 'Appreciation graphs submitted and not yet rendered'),
+    'cdd_process_resident_memory_bytes': ('gauge', 'Resident memory of each process'),
+    'cdd_jobs_total': ('counter', 'Background jobs finished, by kind and state'),
+    'cdd_query_cache_events_total': ('counter', 'Query cache hits, misses, bypasses and invalidations by DAO method'),
+}
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+def _role() -> str:
+    """'worker' for a gunicorn worker (or dev server), 'graph_renderer' for a pool process"""
+    return 'graph_renderer' if multiprocessing.parent_process() is not None else 'worker'
+
+def _resident_memory() -> Optional[int]:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Metrics:
+    """This process's metrics, flushed to a file of its own"""
+
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._collectors = []
+        self._pid = None
+        self._reset()
+        # A fork while the flush thread holds the lock would leave it locked in the child
+        os.register_at_fork(after_in_child=self._new_lock)
+
+    def _new_lock(self) -> None:
+        self._lock = threading.Lock()
+
+    def _reset(self) -> None:
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}  # key: [bucket counts..., +Inf count, sum]
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Add to a counter"""
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._ensure_writer()
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_gauge(self, name: str, delta: float, **labels) -> None:
+        """Move a gauge up or down"""
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._ensure_writer()
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def observe(self, name: str, seconds: float, buckets: tuple, **labels) -> None:
+        """Record a duration in a histogram"""
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._ensure_writer()
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(buckets)] += 1
+            histogram[-1] += seconds
+
+    def add_collector(self, collect: Callable[[], List[tuple]]) -> None:
+        """Register a function returning (kind, name, labels, value) samples read at flush time.
+
+        kind is 'counter' or 'gauge'; collected counters are this process's running totals.
+        """
+        self._collectors.append(collect)
+
+    def snapshot(self) -> dict:
+        """This process's metrics in the file format"""
+        with self._lock:
+            state = {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'gauges': [[name, dict(labels), value] for (name, labels), value in self._gauges.items()],
+                'histograms': [[name, dict(labels), list(histogram)]
+                               for (name, labels), histogram in self._histograms.items()],
+            }
+        for collect in self._collectors:
+            try:
+                for kind, name, labels, value in collect():
+                    if value is not None:
+                        state[f"{kind}s"].append([name, labels, value])
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+        return state
+
+    def _ensure_writer(self) -> None:
+        """Start the flush thread in this process, forgetting a parent's numbers (lock held)"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._reset()
+            threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _write_loop(self) -> None:
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self._flush()
+            except OSError as e:
+                print(f"Error writing metrics: {e}")
+
+    def _flush(self) -> None:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, path)
+
+    def collect(self) -> list:
+        """Snapshots of every live process plus the retired totals"""
+        with self._lock:
+            self._ensure_writer()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        own = f"metrics-{os.getpid()}.json"
+        states = [self.snapshot()]
+        for name in os.listdir(METRICS_DIR):
+            if not (name.startswith('metrics-') and name.endswith('.json')) or name == own:
+                continue
+            try:
+                pid = int(name[8:-5])
+            except ValueError:
+                continue
+            path = os.path.join(METRICS_DIR, name)
+            if not process_alive(pid):
+                self._retire(path)
+                continue
+            try:
+                with open(path) as f:
+                    states.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        try:
+            with open(RETIRED) as f:
+                states.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return states
+
+    @staticmethod
+    def _retire(path: str) -> None:
+        """Fold the counters and histograms of an exited process into retired.json"""
+        with open(f"{RETIRED}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except FileNotFoundError:
+                return  # retired by a concurrent scrape
+            except ValueError:
+                os.remove(path)
+                return
+            try:
+                with open(RETIRED) as f:
+                    retired = json.load(f)
+            except (OSError, ValueError):
+                retired = {'counters': [], 'gauges': [], 'histograms': []}
+            merged = merge([retired, {'counters': state['counters'], 'histograms': state['histograms']}])
+            retired = {
+                'counters': [[name, dict(labels), value] for (name, labels), value in merged['counters'].items()],
+                'gauges': [],
+                'histograms': [[name, dict(labels), histogram]
+                               for (name, labels), histogram in merged['histograms'].items()],
+            }
+            temp_path = f"{RETIRED}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(retired, f)
+            os.replace(temp_path, RETIRED)
+            os.remove(path)
+
+def merge(states: list) -> dict:
+    """Sum snapshots: {'counters'|'gauges'|'histograms': {(name, labels): value}}"""
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    for state in states:
+        for kind in ('counters', 'gauges'):
+            for name, labels, value in state.get(kind, []):
+                key = _key(name, labels)
+                merged[kind][key] = merged[kind].get(key, 0) + value
+        for name, labels, histogram in state.get('histograms', []):
+            key = _key(name, labels)
+            total = merged['histograms'].get(key)
+            if total is None or len(total) != len(histogram):
+                merged['histograms'][key] = list(histogram)  # first seen, or buckets changed
+            else:
+                merged['histograms'][key] = [a + b for a, b in zip(total, histogram)]
+    return merged
+
+def _format_labels(labels, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def exposition(states: list) -> str:
+    """Prometheus text format (0.0.4) of the summed snapshots"""
+    merged = merge(states)
+    samples = {}
+    for kind in ('counters', 'gauges'):
+        for (name, labels), value in merged[kind].items():
+            value = int(value) if float(value).is_integer() else value
+            samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), histogram in merged['histograms'].items():
+        buckets = {
+            'cdd_http_request_duration_seconds': LATENCY_BUCKETS,
+            'cdd_db_query_duration_seconds': QUERY_BUCKETS,
+            'cdd_chart_render_seconds': RENDER_BUCKETS,
+        }[name]
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(buckets + ('+Inf',), histogram[:-1]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-1]:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    output = []
+    for name, (kind, help_text) in METRICS.items():
+        if name in samples:
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(sorted(samples[name]) if kind != 'histogram' else samples[name])
+    return "\n".join(output) + "\n"
+
+def _process_samples() -> list:
+    return [('gauge', 'cdd_process_resident_memory_bytes',
+             {'pid': str(os.getpid()), 'role': _role()}, _resident_memory())]
+
+def _pool_samples() -> list:
+    if _role() != 'worker':
+        return []
+    from config.database import db_config
+    stats = db_config.pool_stats()
+    samples = [
+        ('gauge', 'cdd_db_pool_connections', {'state': 'idle'}, stats['idle']),
+        ('gauge', 'cdd_db_pool_connections', {'state': 'in_use'}, stats['in_use']),
+        ('gauge', 'cdd_db_pool_connections', {'state': 'max'}, stats['max_size']),
+    ]
+    for event in ('checkouts', 'hits', 'misses', 'waits', 'timeouts', 'ping_failures', 'evictions'):
+        samples.append(('counter', 'cdd_db_pool_events_total', {'event': event}, stats[event]))
+    return samples
+
+metrics = Metrics()
+metrics.add_collector(_process_samples)
+metrics.add_collector(_pool_samples)
+
+def init_metrics(app: Flask) -> None:
+    """Count and time every request; register after init_request_timing"""
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        metrics.add_gauge('cdd_http_requests_in_flight', 1)
+
+    @app.after_request
+    def record_response_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request_metrics(exc):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        metrics.add_gauge('cdd_http_requests_in_flight', -1)
+        # Unmatched URLs share one label value, so scanners cannot blow up the series
+        route = request.url_rule.rule if request.url_rule is not None else '(unmatched)'
+        labels = {'blueprint': request.blueprint or '', 'route': route, 'method': request.method}
+        metrics.observe('cdd_http_request_duration_seconds', time.perf_counter() - started,
+                        LATENCY_BUCKETS, **labels)
+        metrics.inc('cdd_http_requests_total', status=str(g.pop('metrics_status', 500)), **labels)
@@ -0,0 +1,395 @@
+"""
+Versioned schema migrations, applied online
+
+Every migration has a version number and runs once: registro_migrazioni
+records the applied versions, when and how long they took. Migrations must
+not stop the centre from working, so they change the schema with online DDL
+(ALGORITHM=INSTANT, else INPLACE with LOCK=NONE) and rewrite rows in short
+batches, each committed on its own. Every step checks information_schema
+first, so an interrupted migration is simply applied again. Usage (from the
+backend directory, before restarting the service on a new release):
+
+    python -m config.migrations status
+    python -m config.migrations apply [--to VERSION] [--batch ROWS]
+"""
+import argparse
+import time
+from typing import Optional
+
+import MySQLdb
+
+from config.database import db_config
+from dao.appreciations_summary_dao import LIVE_SEMESTER
+
+MIGRATIONS_TABLE = 'registro_migrazioni'
+
+CREATE_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+        versione INT PRIMARY KEY,
+        nome VARCHAR(128) NOT NULL,
+        applicata_il TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        secondi DECIMAL(10, 3) NOT NULL
+    )
+"""
+
+BATCH_ROWS = 2000
+
+# Checkpoint of the background semester rollover (SemesterDAO)
+ROLLOVER_TABLE = 'cambio_semestre'
+
+# Queue of the background jobs (config.jobs)
+JOBS_TABLE = 'lavori'
+
+# MariaDB/MySQL errors for an ALTER the requested algorithm or lock cannot do
+ALTER_NOT_SUPPORTED = (1845, 1846)
+
+# The tables with one row per guest and day, read per guest and semester, newest first
+RECORD_TABLES = (
+    'diario', 'bagno', 'doccia', 'idratazione', 'attivita_mirata', 'crisi_epilettica',
+    'peso', 'pressione', 'partecipazione_attivita', 'comportamento_problema',
+)
+
+# The day of a record, from the columns the application writes
+RECORD_DATE = "MAKEDATE({0}anno, 1) + INTERVAL ({0}mese_int - 1) MONTH + INTERVAL ({0}giorno - 1) DAY"
+SEMESTER_KEY = f"IFNULL({{0}}id_semestre, {LIVE_SEMESTER})"
+
+# (migration, column, expression) of the columns the record table triggers compute
+DERIVED_COLUMNS = (
+    (1, 'data', RECORD_DATE),
+    (2, 'semestre_chiave', SEMESTER_KEY),
+)
+
+def record_index(table: str) -> str:
+    return f"idx_{table}_persona_semestre_data"
+
+# The home page reads every guest's activities of the last week by day
+ACTIVITY_DATE_INDEX = 'idx_partecipazione_attivita_data_persona'
+
+def semester_key_index(table: str) -> str:
+    return f"idx_{table}_persona_chiave_data"
+
+def derived_trigger(table: str, column: str, event: str) -> str:
+    return f"{table}_{column}_{event}"
+
+def _exists(cursor, query: str, params: tuple) -> bool:
+    cursor.execute(query, (db_config.database,) + params)
+    return cursor.fetchone() is not None
+
+def _column_exists(cursor, table: str, column: str) -> bool:
+    return _exists(cursor, """
+        SELECT 1 FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    """, (table, column))
+
+def _index_exists(cursor, table: str, index: str) -> bool:
+    return _exists(cursor, """
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND INDEX_NAME = %s
+    """, (table, index))
+
+def _trigger_exists(cursor, trigger: str) -> bool:
+    return _exists(cursor, """
+        SELECT 1 FROM information_schema.TRIGGERS
+        WHERE TRIGGER_SCHEMA = %s AND TRIGGER_NAME = %s
+    """, (trigger,))
+
+def online_alter(cursor, table: str, change: str) -> str:
+    """ALTER TABLE with the least locking algorithm the server supports, return the one used"""
+    for algorithm in ('ALGORITHM=INSTANT', 'ALGORITHM=INPLACE, LOCK=NONE'):
+        try:
+            cursor.execute(f"ALTER TABLE `{table}` {change}, {algorithm}")
+            return algorithm
+        except MySQLdb.Error as e:
+            if e.args[0] not in ALTER_NOT_SUPPORTED:
+                raise
+    # Neither: a table copy that blocks writes, so warn whoever is applying it
+    print(f"  {table}: no online algorithm for '{change}', copying the table")
+    cursor.execute(f"ALTER TABLE `{table}` {change}")
+    return 'ALGORITHM=COPY'
+
+def backfill(connection, table: str, assignment: str, pending: str, batch_rows: int) -> int:
+    """UPDATE the rows matching pending in primary key ranges of batch_rows, one commit each"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"SELECT MIN(id), MAX(id) FROM `{table}`")
+        low, high = cursor.fetchone()
+        updated = 0
+        if low is None:
+            return 0
+        for start in range(low, high + 1, batch_rows):
+            cursor.execute(
+                f"UPDATE `{table}` SET {assignment} WHERE id >= %s AND id < %s AND {pending}",
+                (start, start + batch_rows)
+            )
+            updated += cursor.rowcount
+            connection.commit()
+        return updated
+    finally:
+        cursor.close()
+
+def add_derived_column(connection, table: str, column: str, definition: str,
+                       expression: str, pending: str, batch_rows: int) -> None:
+    """Add a column that triggers compute from the row, filling in the rows matching pending.
+
+    expression refers to the row's columns as {0}name ({0} becomes NEW. in
+    the triggers). Triggers are created before the backfill, so that no row
+    written meanwhile is missed.
+    """
+    cursor = connection.cursor()
+    try:
+        if not _column_exists(cursor, table, column):
+            algorithm = online_alter(cursor, table, f"ADD COLUMN {column} {definition}")
+            print(f"  {table}: {column} column added ({algorithm})")
+        add_derived_triggers(cursor, table, column, expression)
+        connection.commit()
+    finally:
+        cursor.close()
+    updated = backfill(connection, table, f"{column} = {expression.format('')}", pending, batch_rows)
+    print(f"  {table}: {column} filled in on {updated} rows")
+
+def add_derived_triggers(cursor, table: str, column: str, expression: str) -> list:
+    """Create the missing triggers computing column on insert and update, return their names"""
+    created = []
+    for event in ('INSERT', 'UPDATE'):
+        trigger = derived_trigger(table, column, event.lower())
+        if not _trigger_exists(cursor, trigger):
+            cursor.execute(f"""
+                CREATE TRIGGER `{trigger}` BEFORE {event} ON `{table}`
+                FOR EACH ROW SET NEW.{column} = {expression.format('NEW.')}
+            """)
+            created.append(trigger)
+    return created
+
+def repair_derived_triggers() -> list:
+    """Recreate the missing triggers of the applied derived-column migrations, return their names.
+
+    Backups written before the dumps held triggers restore the columns and
+    registro_migrazioni without them: the rows written afterwards would get
+    no date and the live semester key. The restored rows already have both.
+    """
+    connection = None
+    cursor = None
+    created = []
+    try:
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        applied = applied_versions(cursor)
+        for version, column, expression in DERIVED_COLUMNS:
+            if version not in applied:
+                continue
+            for table in RECORD_TABLES:
+                if _column_exists(cursor, table, column):
+                    created += add_derived_triggers(cursor, table, column, expression)
+        connection.commit()
+        return created
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise Exception(f"Error recreating the record table triggers: {str(e)}")
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+def add_index(cursor, table: str, index: str, columns: str) -> None:
+    if not _index_exists(cursor, table, index):
+        algorithm = online_alter(cursor, table, f"ADD INDEX `{index}` ({columns})")
+        print(f"  {table}: index {index} added ({algorithm})")
+
+def record_tables(cursor) -> list:
+    """The record tables present in the database"""
+    tables = []
+    for table in RECORD_TABLES:
+        if _column_exists(cursor, table, 'id_persona'):
+            tables.append(table)
+        else:
+            print(f"  {table}: not found, skipped")
+    return tables
+
+def add_record_dates(connection, batch_rows: int) -> None:
+    """data column and (id_persona, id_semestre, data) index on the record tables.
+
+    data is an ordinary column kept up to date by triggers rather than a
+    stored generated column: adding the latter rebuilds the whole table
+    with writes blocked, while an ordinary column is added instantly and
+    filled in batches. It is INVISIBLE so that SELECT * and the INSERTs
+    without a column list keep their shape.
+    """
+    cursor = connection.cursor()
+    try:
+        for table in record_tables(cursor):
+            add_derived_column(connection, table, 'data', "DATE NULL INVISIBLE", RECORD_DATE,
+                               "data IS NULL", batch_rows)
+            add_index(cursor, table, record_index(table), "id_persona, id_semestre, data")
+    finally:
+        cursor.close()
+
+def add_semester_keys(connection, batch_rows: int) -> None:
+    """semestre_chiave column and (id_persona, semestre_chiave, data) index on the record tables.
+
+    semestre_chiave is id_semestre with the live semester stored as
+    LIVE_SEMESTER instead of NULL, as in riepilogo_gradimento: being NOT
+    NULL, it can be part of
+    the primary key, which config.partitioning needs to partition on it.
+    The DAOs filter on it so that reads prune to one partition; its index
+    replaces the one of migration 1.
+    """
+    cursor = connection.cursor()
+    try:
+        for table in record_tables(cursor):
+            add_derived_column(connection, table, 'semestre_chiave',
+                               f"INT NOT NULL DEFAULT {LIVE_SEMESTER} INVISIBLE",
+                               SEMESTER_KEY,
+                               "id_semestre IS NOT NULL AND semestre_chiave <> id_semestre", batch_rows)
+            add_index(cursor, table, semester_key_index(table), "id_persona, semestre_chiave, data")
+            if _index_exists(cursor, table, record_index(table)):
+                algorithm = online_alter(cursor, table, f"DROP INDEX `{record_index(table)}`")
+                print(f"  {table}: index {record_index(table)} dropped ({algorithm})")
+    finally:
+        cursor.close()
+
+def add_rollover_table(connection, batch_rows: int) -> None:
+    """cambio_semestre table: one row per semester rollover with its progress per table"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {ROLLOVER_TABLE} (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                id_semestre INT NOT NULL,
+                stato VARCHAR(16) NOT NULL,
+                avanzamento MEDIUMTEXT NOT NULL,
+                errore TEXT NULL,
+                iniziato_il TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                finito_il TIMESTAMP NULL
+            )
+        """)
+    finally:
+        cursor.close()
+
+def add_jobs_table(connection, batch_rows: int) -> None:
+    """lavori table: the background jobs queued, running and finished"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                tipo VARCHAR(32) NOT NULL,
+                coda VARCHAR(16) NOT NULL,
+                chiave VARCHAR(64) NULL,
+                parametri MEDIUMTEXT NOT NULL,
+                stato VARCHAR(16) NOT NULL,
+                annullato TINYINT(1) NOT NULL DEFAULT 0,
+                avanzamento TEXT NULL,
+                risultato MEDIUMTEXT NULL,
+                errore TEXT NULL,
+                id_account INT NULL,
+                esecutore VARCHAR(96) NULL,
+                tentativi INT NOT NULL DEFAULT 0,
+                creato_il TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                iniziato_il TIMESTAMP NULL,
+                battito TIMESTAMP NULL,
+                finito_il TIMESTAMP NULL,
+                INDEX idx_{JOBS_TABLE}_coda_stato (coda, stato, id),
+                INDEX idx_{JOBS_TABLE}_tipo_chiave (tipo, chiave)
+            )
+        """)
+    finally:
+        cursor.close()
+
+def add_activity_date_index(connection, batch_rows: int) -> None:
+    """(data, id_persona, mattino) index on partecipazione_attivita.
+
+    The other indexes lead with id_persona: a range of days over every
+    guest would read the whole history. This one covers the query of
+    dao.home_dao, which then reads the last week's entries only.
+    """
+    cursor = connection.cursor()
+    try:
+        add_index(cursor, 'partecipazione_attivita', ACTIVITY_DATE_INDEX, "data, id_persona, mattino")
+    finally:
+        cursor.close()
+
+# (version, name, function(connection, batch_rows)); append only, never renumber
+MIGRATIONS = [
+    (1, 'data column and (id_persona, id_semestre, data) index on the record tables', add_record_dates),
+    (2, 'semestre_chiave column and (id_persona, semestre_chiave, data) index on the record tables',
+     add_semester_keys),
+    (3, 'cambio_semestre table for the background semester rollover', add_rollover_table),
+    (4, 'lavori table for the background jobs', add_jobs_table),
+    (5, '(data, id_persona, mattino) index on partecipazione_attivita', add_activity_date_index),
+]
+
+def applied_versions(cursor) -> dict:
+    """version: (name, applied at, seconds) of the applied migrations"""
+    cursor.execute(CREATE_TABLE)
+    cursor.execute(f"SELECT versione, nome, applicata_il, secondi FROM {MIGRATIONS_TABLE}")
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+def status() -> list:
+    """(version, name, applied at or None) of every known migration"""
+    connection = None
+    cursor = None
+    try:
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        applied = applied_versions(cursor)
+        return [(version, name, applied[version][1] if version in applied else None)
+                for version, name, _ in MIGRATIONS]
+    except Exception as e:
+        raise Exception(f"Error reading the applied migrations: {str(e)}")
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+def apply(target: Optional[int] = None, batch_rows: int = BATCH_ROWS) -> list:
+    """Apply the pending migrations up to target (all if None), return their versions"""
+    connection = None
+    cursor = None
+    done = []
+    current = None
+    try:
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        applied = applied_versions(cursor)
+        for version, name, migrate in MIGRATIONS:
+            if version in applied or (target is not None and version > target):
+                continue
+            current = version
+            print(f"Migration {version}: {name}")
+            started = time.monotonic()
+            migrate(connection, batch_rows)
+            cursor.execute(
+                f"INSERT INTO {MIGRATIONS_TABLE} (versione, nome, secondi) VALUES (%s, %s, %s)",
+                (version, name, round(time.monotonic() - started, 3))
+            )
+            connection.commit()
+            done.append(version)
+        return done
+    except Exception as e:
+        if connection:
+            connection.rollback()
+        raise Exception(f"Error applying migration {current}: {str(e)}")
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Versioned schema migrations, applied online")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help='list the migrations and whether they are applied')
+    command = commands.add_parser('apply', help='apply the pending migrations')
+    command.add_argument('--to', type=int, default=None, help='stop after this version')
+    command.add_argument('--batch', type=int, default=BATCH_ROWS, help='rows updated per transaction')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        for version, name, applied_at in status():
+            print(f"{version:>4}  {'applied ' + str(applied_at) if applied_at else 'pending':<28}  {name}")
+    else:
+        versions = apply(args.to, args.batch)
+        print(f"Applied: {', '.join(map(str, versions))}" if versions else "Nothing to apply")
@@ -0,0 +1,227 @@
+"""
+Optional partitioning of the record tables by semester
+
+Each archived semester makes the live rows a smaller share of every record
+table. Partitioned by LIST on semestre_chiave (migration 2), a table keeps
+the live semester in its own partition, p_live, and every closed semester
+in p_s<id>; the DAOs filter on semestre_chiave, so every read touches one
+partition only.
+
+MariaDB and MySQL require the partitioning column in the primary key,
+which becomes (id, semestre_chiave), and refuse foreign keys on partitioned
+tables: enable stops on a table that has any, unless told to drop them.
+Converting rebuilds each table with writes blocked, so run it when the
+centre is closed:
+
+    python -m config.partitioning status
+    python -m config.partitioning enable [--drop-foreign-keys]
+    python -m config.partitioning disable
+
+On a partitioned table the semester rollover (roll_over, called by
+SemesterDAO.run_rollover) moves the live partition rather than
+updating every live row.
+"""
+import argparse
+from typing import Optional
+
+from config.backup_incremental import CHANGES_TABLE, INCREMENTAL_TABLES
+from config.database import db_config
+from config.migrations import RECORD_TABLES, applied_versions
+from dao.appreciations_summary_dao import LIVE_SEMESTER
+
+PARTITION_KEY = 'semestre_chiave'
+LIVE_PARTITION = 'p_live'
+STAGING_SUFFIX = '_cambio_semestre'
+KEPT_SUFFIX = '_cambio_semestre_nuove'
+
+# Migration that adds PARTITION_KEY
+REQUIRED_MIGRATION = 2
+
+def partition_name(semester_id: int) -> str:
+    return f"p_s{semester_id}"
+
+def partitions(cursor, table: str) -> list:
+    """Names of the partitions of table (empty if it is not partitioned)"""
+    cursor.execute("""
+        SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """, (db_config.database, table))
+    return [row[0] for row in cursor.fetchall()]
+
+def partitioned_tables(cursor) -> list:
+    return [table for table in RECORD_TABLES if partitions(cursor, table)]
+
+def foreign_keys(cursor, table: str) -> list:
+    """(table, constraint) of the foreign keys from or to table"""
+    cursor.execute("""
+        SELECT TABLE_NAME, CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA = %s AND (TABLE_NAME = %s OR REFERENCED_TABLE_NAME = %s)
+    """, (db_config.database, table, table))
+    return [(row[0], row[1]) for row in cursor.fetchall()]
+
+def columns(cursor, table: str) -> list:
+    """Every column of table, invisible ones included"""
+    cursor.execute(f"SHOW COLUMNS FROM `{table}`")
+    return [row[0] for row in cursor.fetchall()]
+
+def enable(drop_foreign_keys: bool = False) -> list:
+    """Partition the record tables by semester, return the tables converted"""
+    connection = None
+    cursor = None
+    converted = []
+    try:
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        if REQUIRED_MIGRATION not in applied_versions(cursor):
+            raise Exception(f"apply migration {REQUIRED_MIGRATION} first: python -m config.migrations apply")
+        cursor.execute("SELECT id FROM semestre ORDER BY id")
+        semester_ids = [row[0] for row in cursor.fetchall()]
+        definitions = ", ".join(
+            [f"PARTITION {LIVE_PARTITION} VALUES IN ({LIVE_SEMESTER})"]
+            + [f"PARTITION {partition_name(semester_id)} VALUES IN ({semester_id})" for semester_id in semester_ids]
+        )
+
+        for table in RECORD_TABLES:
+            if partitions(cursor, table) or PARTITION_KEY not in columns(cursor, table):
+                continue
+            keys = foreign_keys(cursor, table)
+            if keys and not drop_foreign_keys:
+                raise Exception(f"{table} has foreign keys ({', '.join(name for _, name in keys)}), "
+                                "which partitioned tables cannot have: rerun with --drop-foreign-keys")
+            for owner, name in keys:
+                cursor.execute(f"ALTER TABLE `{owner}` DROP FOREIGN KEY `{name}`")
+            print(f"  {table}: partitioning...")
+            cursor.execute(f"""
+                ALTER TABLE `{table}` DROP PRIMARY KEY, ADD PRIMARY KEY (id, {PARTITION_KEY})
+                PARTITION BY LIST ({PARTITION_KEY}) ({definitions})
+            """)
+            converted.append(table)
+        return converted
+    except Exception as e:
+        raise Exception(f"Error partitioning the record tables: {str(e)}")
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+def disable() -> list:
+    """Turn the record tables back into plain tables, return the tables converted"""
+    connection = None
+    cursor = None
+    converted = []
+    try:
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        for table in partitioned_tables(cursor):
+            print(f"  {table}: removing partitioning...")
+            cursor.execute(f"ALTER TABLE `{table}` REMOVE PARTITIONING")
+            cursor.execute(f"ALTER TABLE `{table}` DROP PRIMARY KEY, ADD PRIMARY KEY (id)")
+            converted.append(table)
+        return converted
+    except Exception as e:
+        raise Exception(f"Error removing the partitioning of the record tables: {str(e)}")
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+def roll_over(connection, table: str, semester_id: int, up_to: Optional[int] = None) -> int:
+    """Move the live partition of table (ids up to up_to, if given) to a new closed semester.
+
+    The live rows are copied, with their semester set, into a staging table
+    that is then exchanged with the new partition: a bulk copy into an empty
+    table rather than an UPDATE moving each row between partitions. The live
+    rows above up_to, written since the rollover started, are set aside and
+    put back after the live partition is truncated. Writes to the table
+    wait meanwhile. Exchange and truncate skip the triggers, so the moved
+    rows are logged for the incremental backups here. Safe to run again
+    after an interruption. Returns the number of rows moved.
+    """
+    staging = f"{table}{STAGING_SUFFIX}"
+    kept = f"{table}{KEPT_SUFFIX}"
+    partition = partition_name(semester_id)
+    connection.commit()
+    cursor = connection.cursor()
+    try:
+        names = columns(cursor, table)
+        column_list = ", ".join(f"`{name}`" for name in names)
+        cursor.execute("SELECT 1 FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+                       (db_config.database, kept))
+        if cursor.fetchone() is not None:
+            # Interrupted after the truncate: the set aside rows may be missing
+            cursor.execute(f"INSERT IGNORE INTO `{table}` ({column_list}) SELECT {column_list} FROM `{kept}`")
+            cursor.execute(f"DROP TABLE `{kept}`")
+
+        up_to_constraint = " WHERE id <= %s" if up_to is not None else ""
+        up_to_params = (up_to,) if up_to is not None else ()
+        cursor.execute(f"SELECT 1 FROM `{table}` PARTITION ({LIVE_PARTITION}){up_to_constraint} LIMIT 1",
+                       up_to_params or None)
+        if cursor.fetchone() is None:
+            return 0  # nothing to move, or moved before an interruption
+
+        if partition not in partitions(cursor, table):
+            cursor.execute(f"ALTER TABLE `{table}` ADD PARTITION (PARTITION {partition} VALUES IN ({semester_id}))")
+        for name in (staging, kept):
+            cursor.execute(f"DROP TABLE IF EXISTS `{name}`")
+            cursor.execute(f"CREATE TABLE `{name}` LIKE `{table}`")
+            cursor.execute(f"ALTER TABLE `{name}` REMOVE PARTITIONING")
+
+        values = ", ".join("%s" if name in ('id_semestre', PARTITION_KEY) else f"`{name}`" for name in names)
+        params = tuple(semester_id for name in names if name in ('id_semestre', PARTITION_KEY)) + up_to_params
+        cursor.execute("SELECT 1 FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+                       (db_config.database, CHANGES_TABLE))
+        log_changes = table in INCREMENTAL_TABLES and cursor.fetchone() is not None
+
+        # The pooled connection is in autocommit mode: each statement below commits on its own
+        cursor.execute(f"LOCK TABLES `{table}` WRITE, `{staging}` WRITE, `{kept}` WRITE"
+                       + (f", {CHANGES_TABLE} WRITE" if log_changes else ""))
+        try:
+            cursor.execute(
+                f"INSERT INTO `{staging}` ({column_list}) "
+                f"SELECT {values} FROM `{table}` PARTITION ({LIVE_PARTITION}){up_to_constraint}",
+                params
+            )
+            moved = cursor.rowcount
+            if up_to is not None:
+                cursor.execute(f"INSERT INTO `{kept}` ({column_list}) SELECT {column_list} "
+                               f"FROM `{table}` PARTITION ({LIVE_PARTITION}) WHERE id > %s", (up_to,))
+            if log_changes:
+                cursor.execute(f"INSERT INTO {CHANGES_TABLE} (tabella, id_riga, operazione) "
+                               f"SELECT %s, id, 'U' FROM `{staging}`", (table,))
+            cursor.execute(f"ALTER TABLE `{table}` EXCHANGE PARTITION {partition} WITH TABLE `{staging}`")
+            cursor.execute(f"ALTER TABLE `{table}` TRUNCATE PARTITION {LIVE_PARTITION}")
+            cursor.execute(f"INSERT INTO `{table}` ({column_list}) SELECT {column_list} FROM `{kept}`")
+        finally:
+            cursor.execute("UNLOCK TABLES")
+        for name in (staging, kept):
+            cursor.execute(f"DROP TABLE IF EXISTS `{name}`")
+        return moved
+    finally:
+        cursor.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Optional partitioning of the record tables by semester")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help='list the partitions of every record table')
+    command = commands.add_parser('enable', help='partition the record tables by semester')
+    command.add_argument('--drop-foreign-keys', action='store_true',
+                         help='drop the foreign keys from and to the record tables')
+    commands.add_parser('disable', help='turn the record tables back into plain tables')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        connection = db_config.get_connection()
+        cursor = connection.cursor()
+        try:
+            for table in RECORD_TABLES:
+                print(f"{table}: {', '.join(partitions(cursor, table)) or 'not partitioned'}")
+        finally:
+            cursor.close()
+            connection.close()
+    elif args.command == 'enable':
+        print(f"Partitioned: {', '.join(enable(args.drop_foreign_keys)) or 'nothing to do'}")
+    else:
+        print(f"Unpartitioned: {', '.join(disable()) or 'nothing to do'}")
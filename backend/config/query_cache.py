@@ -0,0 +1,233 @@
+"""
+Write-invalidated cache of the per-guest record reads, shared by all gunicorn workers
+
+The record pages read a guest's rows on every view, while they change a few
+times a day. query_cache.fetchall runs a DAO's query only on a miss and
+stores the rows in a SQLite file every worker opens (one per database,
+under QUERY_CACHE_DIR), keyed by the calling DAO method, the query and its
+parameters (guest and semester included) and the current versions of its
+tags: the (table, guest, semester) it reads,
+plus one for everything. The DAO write methods bump the versions of the
+tags they touch once their transaction commits, so that later reads miss,
+while a read racing with the write can only store its rows under the old
+versions, which nobody asks for again. Entries also expire after
+QUERY_CACHE_TTL seconds, for changes made behind the application's back.
+
+Reads on a connection with uncommitted writes bypass the cache: they see
+rows that may still be rolled back. Hit rates are in /ping (this worker)
+and /query_cache (every worker, through config.metrics).
+"""
+import datetime
+import decimal
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import List, Optional
+
+from config.database import db_config
+from config.metrics import metrics
+from config.query_stats import find_caller
+from dao.appreciations_summary_dao import semester_key
+
+QUERY_CACHE_DIR = os.environ.get('QUERY_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'cdd_query_cache'))
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', 600))
+QUERY_CACHE_ENABLED = os.environ.get('QUERY_CACHE', '1') != '0'
+
+BUSY_TIMEOUT = 1.0    # seconds a worker waits for another one's write to the file
+PURGE_INTERVAL = 300  # seconds between removals of expired entries, per worker
+
+EVERYTHING = '*'
+EVENTS = ('hits', 'misses', 'bypasses', 'invalidations', 'errors')
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, rows TEXT NOT NULL, expires REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS tag_versions (tag TEXT PRIMARY KEY, version INTEGER NOT NULL)",
+)
+
+def record_tag(table: str, person_id, semester: Optional[int]) -> str:
+    """Tag of a guest's records of table in a semester (semester_key value, LIVE_SEMESTER for the live one)"""
+    return f"{table}:{person_id}:{semester}"
+
+def _encode(value):
+    """JSON for the column types json does not know, decoded back by _decode"""
+    if isinstance(value, datetime.datetime):
+        return {'$t': 'datetime', 'v': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'$t': 'date', 'v': value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {'$t': 'timedelta', 'v': value.total_seconds()}
+    if isinstance(value, decimal.Decimal):
+        return {'$t': 'decimal', 'v': str(value)}
+    if isinstance(value, bytes):
+        return {'$t': 'bytes', 'v': value.hex()}
+    raise TypeError(f"{type(value).__name__} cannot be cached")
+
+def _decode(value: dict):
+    kind = value.get('$t')
+    if kind == 'datetime':
+        return datetime.datetime.fromisoformat(value['v'])
+    if kind == 'date':
+        return datetime.date.fromisoformat(value['v'])
+    if kind == 'timedelta':
+        return datetime.timedelta(seconds=value['v'])
+    if kind == 'decimal':
+        return decimal.Decimal(value['v'])
+    if kind == 'bytes':
+        return bytes.fromhex(value['v'])
+    return value
+
+class QueryCache:
+    """Rows of DAO queries in a SQLite file, invalidated by tag versions.
+
+    Each process (and thread) opens the file on its own; WAL mode lets the
+    workers read while one of them writes.
+    """
+
+    def __init__(self, directory: str = QUERY_CACHE_DIR, ttl: float = QUERY_CACHE_TTL,
+                 enabled: bool = QUERY_CACHE_ENABLED):
+        self.directory = directory
+        self.ttl = ttl
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._purged_at = time.monotonic()
+
+    def _db(self) -> sqlite3.Connection:
+        """This thread's connection to the cache file of the database, opened again after a fork"""
+        local = self._local
+        path = os.path.join(self.directory, f"{db_config.database}.sqlite3")
+        if getattr(local, 'pid', None) != os.getpid() or local.path != path:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            local.connection, local.pid, local.path = connection, os.getpid(), path
+        return local.connection
+
+    def _count(self, event: str, method: str) -> None:
+        with self._lock:
+            counters = self._counters.setdefault(method, dict.fromkeys(EVENTS, 0))
+            counters[event] += 1
+        metrics.inc('cdd_query_cache_events_total', event=event, method=method)
+
+    def _key(self, db: sqlite3.Connection, method: str, query: str, params, tags: List[str]) -> str:
+        tags = sorted(set(tags) | {EVERYTHING})
+        placeholders = ', '.join('?' * len(tags))
+        versions = dict(db.execute(f"SELECT tag, version FROM tag_versions WHERE tag IN ({placeholders})", tags))
+        payload = json.dumps([method, query, params, [(tag, versions.get(tag, 0)) for tag in tags]],
+                             default=_encode)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def fetchall(self, cursor, query: str, params, tags: List[str]) -> list:
+        """cursor.execute(query, params) then fetchall(), from the cache while tags are unchanged"""
+        method = find_caller()
+        if not self.enabled or cursor.in_transaction:
+            if self.enabled:
+                self._count('bypasses', method)
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+        try:
+            db = self._db()
+            key = self._key(db, method, query, params, tags)
+            row = db.execute("SELECT rows FROM entries WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        except (sqlite3.Error, TypeError) as e:
+            print(f"Error reading the query cache: {e}")
+            self._count('errors', method)
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        if row is not None:
+            self._count('hits', method)
+            return [tuple(values) for values in json.loads(row[0], object_hook=_decode)]
+
+        self._count('misses', method)
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        try:
+            db.execute("INSERT OR REPLACE INTO entries (key, rows, expires) VALUES (?, ?, ?)",
+                       (key, json.dumps(rows, default=_encode), time.time() + self.ttl))
+            self._purge(db)
+        except (sqlite3.Error, TypeError) as e:
+            print(f"Error writing the query cache: {e}")
+            self._count('errors', method)
+        return rows
+
+    def _purge(self, db: sqlite3.Connection) -> None:
+        """Remove the expired entries, at most every PURGE_INTERVAL (entries of old versions expire too)"""
+        if time.monotonic() - self._purged_at < PURGE_INTERVAL:
+            return
+        self._purged_at = time.monotonic()
+        db.execute("DELETE FROM entries WHERE expires <= ?", (time.time(),))
+
+    def invalidate(self, connection, tags: List[str]) -> None:
+        """Bump the versions of tags once connection's transaction commits (at once if there is none)"""
+        if not self.enabled or not tags:
+            return
+        method = find_caller()
+
+        def bump():
+            try:
+                db = self._db()
+                db.executemany("""
+                    INSERT INTO tag_versions (tag, version) VALUES (?, 1)
+                    ON CONFLICT(tag) DO UPDATE SET version = version + 1
+                """, [(tag,) for tag in set(tags)])
+                self._count('invalidations', method)
+            except sqlite3.Error as e:
+                # Stale rows stay served until they expire
+                print(f"Error invalidating the query cache ({', '.join(tags)}): {e}")
+                self._count('errors', method)
+        if connection is None:
+            bump()
+        else:
+            connection.after_commit(bump)
+
+    def invalidate_record(self, connection, table: str, person_id, semester_id: Optional[int] = None) -> None:
+        """After writing a guest's record of table (in the live semester unless semester_id is given)"""
+        self.invalidate(connection, [record_tag(table, person_id, semester_key(semester_id))])
+
+    def record_owner(self, cursor, table: str, record_id) -> Optional[tuple]:
+        """(id_persona, id_semestre) of a record, read before deleting it to know what to invalidate"""
+        cursor.execute(f"SELECT id_persona, id_semestre FROM `{table}` WHERE id = %s", (record_id,))
+        return cursor.fetchone()
+
+    def invalidate_all(self, connection=None) -> None:
+        """After changes to any guest's records: a restore, the semester rollover"""
+        self.invalidate(connection, [EVERYTHING])
+
+    def stats(self) -> dict:
+        """Counters of this process, per DAO method and in total"""
+        with self._lock:
+            methods = {method: dict(counters) for method, counters in self._counters.items()}
+        return summarize(methods)
+
+def summarize(methods: dict) -> dict:
+    """Totals and hit rates of per-method counters"""
+    total = dict.fromkeys(EVENTS, 0)
+    for counters in methods.values():
+        for event in EVENTS:
+            total[event] += counters.get(event, 0)
+        lookups = counters.get('hits', 0) + counters.get('misses', 0)
+        counters['hit_rate'] = round(counters.get('hits', 0) / lookups, 3) if lookups else None
+    lookups = total['hits'] + total['misses']
+    total['hit_rate'] = round(total['hits'] / lookups, 3) if lookups else None
+    return {'enabled': QUERY_CACHE_ENABLED, 'ttl_s': QUERY_CACHE_TTL, 'total': total, 'methods': methods}
+
+def collected_stats(states: list) -> dict:
+    """Counters of every worker, from metrics.collect()"""
+    methods = {}
+    for state in states:
+        for name, labels, value in state.get('counters', []):
+            if name == 'cdd_query_cache_events_total' and labels.get('event') in EVENTS:
+                counters = methods.setdefault(labels.get('method', '?'), dict.fromkeys(EVENTS, 0))
+                counters[labels['event']] += value
+    return summarize(methods)
+
+query_cache = QueryCache()
@@ -0,0 +1,292 @@
+"""
+Query instrumentation: per-fingerprint timings and a slow-query log with EXPLAIN plans
+
+Every statement run through a db_config cursor is recorded under its
+fingerprint (the SQL with literals and parameters replaced by ?) and the
+DAO method that issued it: count, total and max duration, rows. Statements
+slower than QUERY_SLOW_MS are explained and appended to the slow-query log
+(JSON lines) by a background thread, so the request never waits for the
+EXPLAIN. The same thread writes each worker's totals to QUERY_STATS_DIR,
+where the admin endpoint adds up all the gunicorn workers.
+"""
+import functools
+import glob
+import json
+import os
+import queue
+import re
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+
+QUERY_STATS_DIR = os.environ.get('QUERY_STATS_DIR', os.path.join(tempfile.gettempdir(), 'cdd_query_stats'))
+QUERY_SLOW_MS = float(os.environ.get('QUERY_SLOW_MS', 100))
+QUERY_STATS_ENABLED = os.environ.get('QUERY_STATS', '1') != '0'
+SLOW_LOG = os.path.join(QUERY_STATS_DIR, 'slow_queries.log')
+SLOW_LOG_MAX_BYTES = 8 * 1024 * 1024  # then rotated to slow_queries.log.1
+
+MAX_FINGERPRINTS = 1000     # distinct (fingerprint, caller) pairs kept per worker
+FINGERPRINT_CHARS = 2000    # long statements (bulk INSERTs) are fingerprinted on their start
+EXPLAIN_MAX_CHARS = 10000
+EXPLAIN_INTERVAL = 300      # seconds before the same fingerprint is explained again
+FLUSH_INTERVAL = 5          # seconds between writes of a worker's totals
+SLOW_LOG_TAIL = 256 * 1024
+
+EXPLAINABLE = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT', 'REPLACE')
+
+_COMMENTS = re.compile(r'/\*.*?\*/|--[^\n]*|#[^\n]*', re.S)
+_STRINGS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", re.S)
+_NUMBERS = re.compile(r'(?<![\w`.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b', re.I)
+_PLACEHOLDERS = re.compile(r'%s|%\(\w+\)s|\bNULL\b', re.I)
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_TUPLES = re.compile(r'(\(\?\+?\))(?:\s*,\s*\(\?\+?\))+')
+_SPACES = re.compile(r'\s+')
+
+# Frames of these files are the instrumentation itself, not the caller
+_INTERNAL = ('config/database.py', 'config/query_stats.py', 'config/query_cache.py',
+             'config\\database.py', 'config\\query_stats.py', 'config\\query_cache.py')
+
+@functools.lru_cache(maxsize=4096)
+def fingerprint(query: str) -> str:
+    """The statement with comments, literals and placeholders normalised, lists collapsed"""
+    text = _COMMENTS.sub(' ', query)
+    text = _STRINGS.sub('?', text)
+    text = _NUMBERS.sub('?', text)
+    text = _PLACEHOLDERS.sub('?', text)
+    text = _SPACES.sub(' ', text).strip()
+    text = _LISTS.sub('(?+)', text)
+    return _TUPLES.sub(r'\1+', text)
+
+def find_caller() -> str:
+    """module:function of the DAO method (or other code) that ran the query"""
+    frame = sys._getframe(2)
+    fallback = None
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if not path.endswith(_INTERNAL):
+            code = frame.f_code
+            name = f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}"
+            if f"{os.sep}dao{os.sep}" in path:
+                return name
+            fallback = fallback or name
+        frame = frame.f_back
+    return fallback or '?'
+
+def process_alive(pid: int) -> bool:
+    """Whether a process (e.g. a gunicorn worker that wrote a stats file) still exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class QueryStats:
+    """Per-worker query totals, shared with the other workers through small JSON files"""
+
+    def __init__(self, slow_ms: float = QUERY_SLOW_MS, enabled: bool = QUERY_STATS_ENABLED):
+        self.slow_ms = slow_ms
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._explained = {}
+        self._queue = queue.Queue(maxsize=100)
+        self._pid = None
+        self._writer = None
+
+    def record(self, query, args, seconds: float, rows: Optional[int], explain: bool = True) -> None:
+        """Account for one executed statement (explain=False when args cannot be replayed)"""
+        if not self.enabled or threading.current_thread() is self._writer:
+            return
+        if rows is not None and rows < 0:
+            rows = None  # unknown for streaming cursors
+        if isinstance(query, bytes):
+            # Statements of a dump file (restore): bulk INSERTs, not worth explaining
+            query = query[:FINGERPRINT_CHARS].decode('utf-8', 'replace')
+            explain = False
+        key = (fingerprint(query[:FINGERPRINT_CHARS]), find_caller())
+        ms = seconds * 1000
+
+        with self._lock:
+            self._ensure_writer()
+            entry = self._stats.get(key)
+            if entry is None:
+                if len(self._stats) >= MAX_FINGERPRINTS:
+                    key = ('(other)', '')
+                entry = self._stats.setdefault(key, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0})
+            entry['count'] += 1
+            entry['total_ms'] += ms
+            entry['max_ms'] = max(entry['max_ms'], ms)
+            entry['rows'] += max(rows or 0, 0)
+
+            slow = ms >= self.slow_ms
+            if slow:
+                now = time.monotonic()
+                explain = (explain and len(query) <= EXPLAIN_MAX_CHARS
+                           and query.lstrip(' \t\r\n(').split(None, 1)[0].upper() in EXPLAINABLE
+                           and now - self._explained.get(key[0], -EXPLAIN_INTERVAL) >= EXPLAIN_INTERVAL)
+                if explain:
+                    self._explained[key[0]] = now
+
+        if slow:
+            try:
+                self._queue.put_nowait({
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'pid': os.getpid(),
+                    'fingerprint': key[0],
+                    'caller': key[1],
+                    'ms': round(ms, 2),
+                    'rows': rows,
+                    # The query text, never the parameters: they hold the guests' data
+                    'query': query[:EXPLAIN_MAX_CHARS],
+                    '_explain': (query, args) if explain else None,
+                })
+            except queue.Full:
+                pass
+
+    def snapshot(self) -> dict:
+        """This worker's totals, keyed by 'fingerprint\\tcaller'"""
+        with self._lock:
+            return {f"{fp}\t{caller}": dict(entry) for (fp, caller), entry in self._stats.items()}
+
+    def top(self, n: int = 20, order: str = 'total_ms') -> dict:
+        """The n heaviest queries over every live worker"""
+        merged = {}
+        workers = 0
+        own = f"stats-{os.getpid()}.json"
+        sources = [self.snapshot()]
+        for path in glob.glob(os.path.join(QUERY_STATS_DIR, 'stats-*.json')):
+            name = os.path.basename(path)
+            if name == own:
+                continue
+            try:
+                pid = int(name[6:-5])
+            except ValueError:
+                continue
+            if not process_alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    sources.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+        for stats in sources:
+            workers += 1
+            for key, entry in stats.items():
+                total = merged.setdefault(key, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0})
+                total['count'] += entry['count']
+                total['total_ms'] += entry['total_ms']
+                total['max_ms'] = max(total['max_ms'], entry['max_ms'])
+                total['rows'] += entry['rows']
+
+        queries = []
+        for key, entry in merged.items():
+            fp, caller = key.split('\t', 1)
+            queries.append({
+                'fingerprint': fp,
+                'caller': caller,
+                'count': entry['count'],
+                'total_ms': round(entry['total_ms'], 2),
+                'mean_ms': round(entry['total_ms'] / entry['count'], 2),
+                'max_ms': round(entry['max_ms'], 2),
+                'rows': entry['rows'],
+            })
+        queries.sort(key=lambda query: query.get(order, 0), reverse=True)
+        return {'workers': workers, 'slow_ms': self.slow_ms, 'queries': queries[:n]}
+
+    def slow_queries(self, n: int = 50) -> list:
+        """The last n entries of the slow-query log, newest first"""
+        try:
+            with open(SLOW_LOG, 'rb') as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - SLOW_LOG_TAIL))
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        if size > SLOW_LOG_TAIL:
+            lines = lines[1:]  # cut by the seek
+        entries = []
+        for line in reversed(lines[-n:]):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries
+
+    def reset(self) -> None:
+        """Forget this worker's totals"""
+        with self._lock:
+            self._stats = {}
+
+    def _ensure_writer(self) -> None:
+        """Start the background writer in this process (threads do not survive a fork; lock held)"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._stats = {}
+            self._queue = queue.Queue(maxsize=100)
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    def _write_loop(self) -> None:
+        flushed = time.monotonic()
+        while True:
+            try:
+                entry = self._queue.get(timeout=FLUSH_INTERVAL)
+                self._log_slow(entry)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                print(f"Error writing the slow-query log: {e}")
+            if time.monotonic() - flushed >= FLUSH_INTERVAL:
+                flushed = time.monotonic()
+                try:
+                    self._flush()
+                except OSError as e:
+                    print(f"Error writing query stats: {e}")
+
+    def _log_slow(self, entry: dict) -> None:
+        request = entry.pop('_explain')
+        if request is not None:
+            entry['explain'] = self._explain(*request)
+        os.makedirs(QUERY_STATS_DIR, exist_ok=True)
+        try:
+            if os.path.getsize(SLOW_LOG) > SLOW_LOG_MAX_BYTES:
+                os.replace(SLOW_LOG, f"{SLOW_LOG}.1")
+        except FileNotFoundError:
+            pass
+        with open(SLOW_LOG, 'a') as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+
+    @staticmethod
+    def _explain(query: str, args) -> list:
+        """EXPLAIN on a connection of its own: the query's connection may be streaming"""
+        from config.database import db_config
+        connection = db_config.get_dedicated_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"EXPLAIN {query}", args)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            return [{'error': str(e)}]
+        finally:
+            cursor.close()
+            connection.close()
+
+    def _flush(self) -> None:
+        os.makedirs(QUERY_STATS_DIR, exist_ok=True)
+        path = os.path.join(QUERY_STATS_DIR, f"stats-{os.getpid()}.json")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, path)
+
+query_stats = QueryStats()
@@ -0,0 +1,102 @@
+"""
+Per-request timing spans, sent as a Server-Timing header and an access-log line
+
+Code that does measurable work wraps it in span(name) (or reports a duration
+with add(name, seconds)): the database cursor for "db", chart templates for
+"render", Chart.base64() for "encode" and the JSON provider for "serialize".
+Outside a request (background threads, CLI scripts) spans cost nothing.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Flask, g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+# Set REQUEST_TIMING_LOG=0 to keep the header but drop the access-log line
+ACCESS_LOG_ENABLED = os.environ.get('REQUEST_TIMING_LOG', '1') != '0'
+
+# Order of the spans in the header; unknown names follow in first-use order
+SPAN_ORDER = ('db', 'render', 'encode', 'serialize')
+
+def add(name: str, seconds: float) -> None:
+    """Add a duration to the current request's span (no-op outside a request)"""
+    if not has_request_context():
+        return
+    spans = g.get('timing_spans')
+    if spans is None:
+        return
+    span_total = spans.get(name)
+    if span_total is None:
+        spans[name] = [seconds, 1]
+    else:
+        span_total[0] += seconds
+        span_total[1] += 1
+
+@contextmanager
+def span(name: str):
+    """Time the enclosed block into the current request's span"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - started)
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, timing jsonify() into the "serialize" span"""
+
+    def response(self, *args, **kwargs):
+        with span('serialize'):
+            return super().response(*args, **kwargs)
+
+def server_timing(spans: dict, total: float) -> str:
+    """Server-Timing header value, durations in milliseconds"""
+    names = [name for name in SPAN_ORDER if name in spans]
+    names += [name for name in spans if name not in SPAN_ORDER]
+    metrics = []
+    for name in names:
+        seconds, count = spans[name]
+        metric = f"{name};dur={seconds * 1000:.1f}"
+        if count > 1:
+            metric += f';desc="{count}x"'
+        metrics.append(metric)
+    metrics.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(metrics)
+
+def init_request_timing(app: Flask) -> None:
+    """Collect spans for every request of the app.
+
+    Register it before the other after_request hooks (Flask runs them in
+    reverse order), so the total includes the unit of work's commit.
+    """
+    app.json_provider_class = TimedJSONProvider
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_request_timing():
+        g.timing_started = time.perf_counter()
+        g.timing_spans = {}
+
+    @app.after_request
+    def send_request_timing(response):
+        started = g.get('timing_started')
+        if started is None:
+            return response
+        total = time.perf_counter() - started
+        spans = g.pop('timing_spans', {})
+        response.headers['Server-Timing'] = server_timing(spans, total)
+
+        if ACCESS_LOG_ENABLED:
+            print(json.dumps({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'pid': os.getpid(),
+                'method': request.method,
+                'path': request.path,
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'bytes': response.calculate_content_length(),
+                'ms': round(total * 1000, 1),
+                'spans': {name: round(seconds * 1000, 1) for name, (seconds, _) in spans.items()},
+            }), flush=True)
+        return response
@@ -0,0 +1,562 @@
+"""
+Bulk restore of backups
+
+Restorer loads either kind of backup into db_config.database:
+
+- an archive (directory or tar, see config.backup_archive): the schema is
+  created first, then the data parts are loaded concurrently, largest
+  first, and the triggers and views are created last;
+- a single .sql or .sql.gz dump (mysqldump or the Python engine): the
+  statements are read in order, the INSERTs are handed to the load
+  connections and everything else runs in order on one connection.
+
+Every connection loads with foreign key and unique checks off. Consecutive
+INSERTs into a table are merged into statements of up to BATCH_BYTES, each
+committed as its own transaction. Secondary indexes are dropped as soon as
+their table is created and added back with one ALTER TABLE per table once
+the data is in, so every index is built once from sorted data instead of
+being updated row by row. Indexes the server refuses to drop (those a
+foreign key needs) are kept and maintained during the load. Backups older
+than the dumped triggers lack the ones of the migrations, which are then
+recreated (config.migrations.repair_derived_triggers). The job queue
+(config.sql_dump.NOT_DUMPED) is left as it is, even when an older backup
+holds it: the restore runs as one of its jobs.
+
+Restore a backup from the command line with:
+
+    python -m config.restore <backup.tar | directory | backup.sql.gz> [--jobs 3]
+"""
+import argparse
+import gzip
+import os
+import queue
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+import MySQLdb
+
+from config.backup import read_json, write_json_atomic
+from config.backup_archive import ARCHIVE_FORMAT, ARCHIVE_VERSION, MANIFEST
+from config.database import db_config
+from config.jobs import enqueue, job_kind
+from config.migrations import repair_derived_triggers
+from config.query_cache import query_cache
+from config.sql_dump import NOT_DUMPED
+
+RESTORES_DIR = os.path.join(tempfile.gettempdir(), 'cdd_restores')
+RESTORE_MAX_AGE = 24 * 3600  # seconds the status of a finished restore stays available
+
+RESTORE_JOBS = 3                   # the pool holds 5 connections per worker: leave some for requests
+BATCH_BYTES = 4 * 1024 * 1024      # merged INSERTs stay below MariaDB's 16 MB default max_allowed_packet
+PROGRESS_INTERVAL = 0.5            # seconds between progress reports
+
+# Session of every restore connection; the SET statements of the dump are added to it
+LOAD_SESSION = (b"SET FOREIGN_KEY_CHECKS = 0", b"SET UNIQUE_CHECKS = 0")
+
+VERSION_COMMENT = re.compile(rb'^/\*!\d*\s*')
+KEYWORDS = re.compile(rb'([A-Za-z]+)(?:\s+([A-Za-z]+))?')
+INSERT = re.compile(rb'^INSERT INTO `[^`]+`(?: \([^)]*\))? VALUES\s*')
+CREATE_TABLE = re.compile(rb'^CREATE TABLE (?:IF NOT EXISTS )?`([^`]+)`')
+TABLE_STATEMENT = re.compile(
+    rb'^(?:INSERT INTO|DROP TABLE(?: IF EXISTS)?|CREATE TABLE(?: IF NOT EXISTS)?|ALTER TABLE|LOCK TABLES)\s+`([^`]+)`',
+    re.IGNORECASE
+)
+SECONDARY_INDEX = re.compile(r'^\s*((?:UNIQUE )?KEY `([^`]+)` .*?),?$')
+
+SKIPPED = ('LOCK TABLES', 'UNLOCK TABLES', 'KEYS')    # pointless with several load connections
+CONCURRENT = ('SET', 'DROP TABLE', 'CREATE TABLE')    # need not wait for the INSERTs before them
+
+def open_sql(path: str):
+    """Open a dump file for reading in binary mode, compressed or not"""
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    return gzip.open(path, 'rb') if magic == b'\x1f\x8b' else open(path, 'rb')
+
+def read_statements(lines) -> Iterator[bytes]:
+    """Statements of a dump without their delimiter, honouring the client's DELIMITER command.
+
+    Dumps escape line breaks inside strings, so a statement ends with the
+    first line that ends with the delimiter.
+    """
+    delimiter = b';'
+    statement = []
+    for line in lines:
+        stripped = line.strip()
+        if not statement:
+            if not stripped or stripped.startswith(b'--'):
+                continue
+            if stripped[:10].upper() == b'DELIMITER ':
+                delimiter = stripped[10:].strip()
+                continue
+        statement.append(line)
+        if stripped.endswith(delimiter):
+            yield b''.join(statement).rstrip()[:-len(delimiter)]
+            statement = []
+    if statement and b''.join(statement).strip():
+        yield b''.join(statement).rstrip()
+
+def statement_kind(statement: bytes) -> str:
+    """What a statement does, looking inside mysqldump's /*!NNNNN ... */ comments"""
+    body = VERSION_COMMENT.sub(b'', statement.lstrip(), count=1)
+    match = KEYWORDS.match(body)
+    if not match:
+        return ''
+    first = match.group(1).upper().decode()
+    second = (match.group(2) or b'').upper().decode()
+    if first == 'ALTER' and re.search(rb'\s(DISABLE|ENABLE) KEYS\b', statement):
+        return 'KEYS'
+    if second in ('TABLE', 'TABLES'):
+        return f"{first} {second}"
+    return first
+
+def statement_table(statement: bytes) -> Optional[str]:
+    """The table a statement creates, drops, alters, locks or fills, None for any other"""
+    match = TABLE_STATEMENT.match(VERSION_COMMENT.sub(b'', statement.lstrip(), count=1))
+    return match.group(1).decode() if match else None
+
+def restored_statements(statements: Iterator[bytes]) -> Iterator[bytes]:
+    """statements without those on the tables a restore leaves alone (older backups hold them)"""
+    for statement in statements:
+        if statement_table(statement) not in NOT_DUMPED:
+            yield statement
+
+def extract_archive(path: str, directory: str) -> str:
+    """Extract a backup tar into directory, refusing entries that would land outside it"""
+    root = os.path.realpath(directory)
+    with tarfile.open(path) as tar:
+        for member in tar.getmembers():
+            target = os.path.realpath(os.path.join(root, member.name))
+            if not (member.isfile() or member.isdir()) or not target.startswith(root + os.sep):
+                raise Exception(f"unexpected entry in backup archive: {member.name}")
+        tar.extractall(root)
+    return root
+
+class LoadConnections:
+    """Connections set up for bulk loading, lent to a thread pool one task at a time"""
+
+    def __init__(self, jobs: int, session: list):
+        self.idle = queue.Queue()
+        self.connections = []
+        self.futures = []
+        # Bounds the statements read ahead of the load
+        self.slots = threading.BoundedSemaphore(jobs * 2)
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        for _ in range(jobs):
+            connection = db_config.get_dedicated_connection()
+            self.connections.append(connection)
+            cursor = connection.cursor()
+            try:
+                for statement in session:
+                    cursor.execute(statement)
+            finally:
+                cursor.close()
+            self.idle.put(connection)
+
+    def submit(self, task: Callable, *args) -> None:
+        """Run task(connection, *args) on the next free connection, waiting while too many are queued"""
+        self._raise_failures()
+        self.slots.acquire()
+
+        def run():
+            connection = self.idle.get()
+            try:
+                return task(connection, *args)
+            finally:
+                self.idle.put(connection)
+                self.slots.release()
+
+        self.futures.append(self.executor.submit(run))
+
+    def wait(self) -> None:
+        """Wait for every submitted task, raising the first failure"""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def _raise_failures(self) -> None:
+        pending = []
+        for future in self.futures:
+            if not future.done():
+                pending.append(future)
+            elif future.exception():
+                raise future.exception()
+        self.futures = pending
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        # Their session variables must not reach the requests
+        for connection in self.connections:
+            connection.discard()
+
+class Restorer:
+    """Load a backup into the configured database as fast as the server takes it"""
+
+    def __init__(self, jobs: int = RESTORE_JOBS, batch_bytes: int = BATCH_BYTES,
+                 on_progress: Optional[Callable[[dict], None]] = None):
+        # One more connection runs the schema
+        self.jobs = max(1, min(jobs, db_config.pool.max_size - 1))
+        self.batch_bytes = batch_bytes
+        self.on_progress = on_progress
+        self.session = list(LOAD_SESSION)
+        self.tables = []
+        self.deferred = {}   # table -> index definitions to add back after the load
+        self.kept = []       # indexes the server would not drop
+        self.phases = {}
+        self.progress = {'phase': None, 'files_done': 0, 'files_total': 0, 'rows': 0, 'sql_bytes': 0}
+        self._lock = threading.Lock()
+        self._reported_at = 0.0
+
+    def restore(self, path: str) -> dict:
+        """Restore a backup archive (directory or tar) or a .sql/.sql.gz dump, return a report"""
+        started = time.monotonic()
+        if os.path.isdir(path):
+            source = 'archive'
+            self._restore_archive(path)
+        elif tarfile.is_tarfile(path):
+            source = 'archive'
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as directory:
+                with self._phase('extract'):
+                    extract_archive(path, directory)
+                self._restore_archive(directory)
+        else:
+            source = 'sql'
+            self._restore_sql(path)
+        with self._phase('triggers'):
+            recreated = repair_derived_triggers()
+
+        seconds = time.monotonic() - started
+        rows = self.progress['rows']
+        sql_bytes = self.progress['sql_bytes']
+        return {
+            'source': source,
+            'database': db_config.database,
+            'jobs': self.jobs,
+            'tables': len(self.tables),
+            'rows': rows,
+            'sql_bytes': sql_bytes,
+            'seconds': round(seconds, 3),
+            'rows_per_s': round(rows / seconds) if seconds else None,
+            'mb_per_s': round(sql_bytes / seconds / 1e6, 2) if seconds else None,
+            'phases': self.phases,
+            'indexes_rebuilt': sum(len(definitions) for definitions in self.deferred.values()),
+            'indexes_kept': self.kept,
+            'triggers_recreated': recreated,
+        }
+
+    def _restore_archive(self, directory: str) -> None:
+        manifest = read_json(os.path.join(directory, MANIFEST))
+        if manifest.get('format') != ARCHIVE_FORMAT or manifest.get('version', 0) > ARCHIVE_VERSION:
+            raise Exception("not a backup archive this version can restore")
+        if manifest.get('kind') == 'incremental':
+            raise Exception("an incremental backup only holds changes: merge it with its full backup first "
+                            "(python -m config.backup_incremental merge)")
+        # Largest parts first, so that the last ones to finish are short
+        parts = sorted((part for table in manifest['tables'] if table['name'] not in NOT_DUMPED
+                        for part in table['parts']),
+                       key=lambda part: part['sql_bytes'], reverse=True)
+        files = [part['file'] for part in parts]
+        self.progress['files_total'] = len(files)
+
+        main = self._connect()
+        loaders = None
+        try:
+            with self._phase('schema'):
+                self._run_file(main, os.path.join(directory, manifest['schema']))
+            loaders = LoadConnections(self.jobs, self.session)
+            with self._phase('data'):
+                for relative_path in files:
+                    loaders.submit(self._load_file, os.path.join(directory, relative_path))
+                loaders.wait()
+            with self._phase('indexes'):
+                self._rebuild_indexes(loaders)
+            with self._phase('views'):
+                self._run_file(main, os.path.join(directory, manifest['views']))
+        finally:
+            if loaders:
+                loaders.close()
+            main.discard()
+
+    def _restore_sql(self, path: str) -> None:
+        main = self._connect()
+        loaders = None
+        loading = set()  # tables with INSERTs submitted since the last wait
+        try:
+            # Structure, data and views are interleaved in a single dump
+            with self._phase('data'):
+                with open_sql(path) as f:
+                    for statement in self._batches(restored_statements(read_statements(f))):
+                        kind = statement_kind(statement)
+                        if kind == 'INSERT':
+                            loaders = loaders or LoadConnections(self.jobs, self.session)
+                            loaders.submit(self._insert, statement)
+                            loading.add(statement_table(statement))
+                        elif kind not in SKIPPED:
+                            # Triggers and the like must not see the rows still being loaded, and
+                            # a resumed mysqldump backup drops again a table it was filling
+                            if loaders and (kind not in CONCURRENT or statement_table(statement) in loading):
+                                loaders.wait()
+                                loading.clear()
+                            self._run(main, statement)
+                if loaders:
+                    loaders.wait()
+            loaders = loaders or LoadConnections(self.jobs, self.session)
+            with self._phase('indexes'):
+                self._rebuild_indexes(loaders)
+        finally:
+            if loaders:
+                loaders.close()
+            main.discard()
+
+    def _connect(self):
+        connection = db_config.get_dedicated_connection()
+        cursor = connection.cursor()
+        try:
+            for statement in LOAD_SESSION:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+        return connection
+
+    def _run_file(self, connection, path: str) -> None:
+        with open_sql(path) as f:
+            for statement in restored_statements(read_statements(f)):
+                self._run(connection, statement)
+
+    def _run(self, connection, statement: bytes) -> None:
+        """Run a statement on the main connection, noting session settings and new tables"""
+        cursor = connection.cursor()
+        try:
+            cursor.execute(statement)
+            connection.commit()
+        finally:
+            cursor.close()
+
+        kind = statement_kind(statement)
+        if kind == 'SET':
+            self.session.append(statement)
+        elif kind == 'CREATE TABLE':
+            table = CREATE_TABLE.match(VERSION_COMMENT.sub(b'', statement.lstrip(), count=1)).group(1).decode()
+            # A resumed mysqldump backup creates the table it was cut in twice
+            if table not in self.tables:
+                self.tables.append(table)
+            self.deferred.pop(table, None)
+            self._defer_indexes(connection, table)
+
+    def _defer_indexes(self, connection, table: str) -> None:
+        """Drop the secondary indexes of a new, empty table, remembering their definitions"""
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"SHOW CREATE TABLE `{table}`")
+            create_table = cursor.fetchone()[1]
+            for line in create_table.splitlines():
+                match = SECONDARY_INDEX.match(line)
+                if not match:
+                    continue
+                definition, name = match.groups()
+                try:
+                    cursor.execute(f"ALTER TABLE `{table}` DROP INDEX `{name}`")
+                    self.deferred.setdefault(table, []).append(definition)
+                except MySQLdb.Error:
+                    # A foreign key needs it: it is maintained during the load instead
+                    self.kept.append(f"{table}.{name}")
+        finally:
+            cursor.close()
+
+    def _rebuild_indexes(self, loaders: LoadConnections) -> None:
+        for table, definitions in self.deferred.items():
+            loaders.submit(self._add_indexes, table, definitions)
+        loaders.wait()
+
+    @staticmethod
+    def _add_indexes(connection, table: str, definitions: list) -> None:
+        cursor = connection.cursor()
+        try:
+            # One statement builds every index of the table in a single pass
+            cursor.execute(f"ALTER TABLE `{table}` " + ", ".join(f"ADD {definition}" for definition in definitions))
+        finally:
+            cursor.close()
+
+    def _load_file(self, connection, path: str) -> None:
+        with open_sql(path) as f:
+            for statement in self._batches(read_statements(f)):
+                self._insert(connection, statement)
+        self._advance(files_done=1)
+
+    def _insert(self, connection, statement: bytes) -> None:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(statement)
+            rows = cursor.rowcount
+            connection.commit()
+        finally:
+            cursor.close()
+        self._advance(rows=rows, sql_bytes=len(statement))
+
+    def _batches(self, statements: Iterator[bytes]) -> Iterator[bytes]:
+        """Merge consecutive INSERTs into the same table into statements of up to batch_bytes"""
+        prefix = None
+        values = []
+        size = 0
+        for statement in statements:
+            match = INSERT.match(statement)
+            if match and match.group(0) == prefix and size + len(statement) <= self.batch_bytes:
+                values.append(statement[match.end():])
+                size += len(statement) - match.end() + 2
+                continue
+            if values:
+                yield prefix + b",\n".join(values)
+            if match:
+                prefix = match.group(0)
+                values = [statement[match.end():]]
+                size = len(statement)
+            else:
+                prefix = None
+                values = []
+                size = 0
+                yield statement
+        if values:
+            yield prefix + b",\n".join(values)
+
+    @contextmanager
+    def _phase(self, name: str):
+        started = time.monotonic()
+        with self._lock:
+            self.progress['phase'] = name
+            self._report(force=True)
+        yield
+        self.phases[name] = round(time.monotonic() - started, 3)
+
+    def _advance(self, **counts) -> None:
+        with self._lock:
+            for name, count in counts.items():
+                self.progress[name] += count
+            self._report()
+
+    def _report(self, force: bool = False) -> None:
+        """Pass the progress to on_progress, at most every PROGRESS_INTERVAL (lock held)"""
+        now = time.monotonic()
+        if self.on_progress and (force or now - self._reported_at >= PROGRESS_INTERVAL):
+            self._reported_at = now
+            self.on_progress(dict(self.progress))
+
+class Restore:
+    """A restore started from the web interface: the uploaded backup and the status of its load"""
+
+    def __init__(self, restore_id: str):
+        self.id = restore_id
+        self.directory = os.path.join(RESTORES_DIR, restore_id)
+        self.upload_path = os.path.join(self.directory, 'backup')
+        self.status_path = os.path.join(self.directory, 'status.json')
+
+    @classmethod
+    def create(cls, owner: int, upload) -> 'Restore':
+        """Save an uploaded backup and queue the job that restores it"""
+        cleanup_old_restores()
+        restore = cls(str(uuid.uuid4()))
+        os.makedirs(restore.directory, mode=0o700)
+        upload.save(restore.upload_path)
+        write_json_atomic(restore.status_path, {
+            'restore_id': restore.id,
+            'owner': owner,
+            'filename': upload.filename,
+            'state': 'running',
+            'progress': None,
+            'report': None,
+            'error': None,
+        })
+        job_id = enqueue('restore', {'restore_id': restore.id}, owner)
+        write_json_atomic(restore.status_path, {**restore.status(), 'job_id': job_id})
+        return restore
+
+    @classmethod
+    def open(cls, restore_id: str) -> Optional['Restore']:
+        """Find an existing restore, None if the id is unknown or not a valid restore id"""
+        try:
+            restore = cls(str(uuid.UUID(restore_id)))
+        except ValueError:
+            return None
+        return restore if os.path.exists(restore.status_path) else None
+
+    def status(self) -> dict:
+        return read_json(self.status_path)
+
+    def run(self, on_progress: Optional[Callable[[dict], None]] = None) -> dict:
+        """Load the uploaded backup, return the final status"""
+        status = self.status()
+
+        def progress(current):
+            write_json_atomic(self.status_path, {**status, 'progress': current})
+            if on_progress:
+                on_progress(current)
+
+        try:
+            restorer = Restorer(on_progress=progress)
+            status['report'] = restorer.restore(self.upload_path)
+            status['progress'] = restorer.progress
+            status['state'] = 'complete'
+            report = status['report']
+            print(f"Restore {self.id}: {report['rows']} rows in {report['seconds']}s "
+                  f"({report['rows_per_s']} rows/s)")
+        except Exception as e:
+            status['state'] = 'failed'
+            status['error'] = f"Database restore failed: {str(e)}"
+        finally:
+            # Loaded in part even if it failed
+            query_cache.invalidate_all()
+            # The upload holds the whole database: keep it no longer than needed
+            if os.path.exists(self.upload_path):
+                os.remove(self.upload_path)
+        write_json_atomic(self.status_path, status)
+        return status
+
+@job_kind('restore', cancellable=False)
+def run_restore(context, params: dict) -> dict:
+    """Job: load a backup uploaded with Restore.create (not cancellable: it would leave half a database)"""
+    restore = Restore.open(params['restore_id'])
+    if restore is None:
+        raise Exception(f"restore {params['restore_id']} not found")
+    if restore.status()['state'] == 'complete':
+        return restore.status()['report']  # finished before its worker died
+    if not os.path.exists(restore.upload_path):
+        raise Exception("the uploaded backup is gone, upload it again")
+    status = restore.run(context.progress)
+    if status['state'] == 'failed':
+        raise Exception(status['error'])
+    return status['report']
+
+def cleanup_old_restores() -> None:
+    """Remove the status of restores older than RESTORE_MAX_AGE"""
+    try:
+        if not os.path.exists(RESTORES_DIR):
+            os.makedirs(RESTORES_DIR, mode=0o700, exist_ok=True)
+            return
+        current_time = time.time()
+        for entry in os.scandir(RESTORES_DIR):
+            if entry.is_dir() and current_time - entry.stat().st_mtime > RESTORE_MAX_AGE:
+                shutil.rmtree(entry.path, ignore_errors=True)
+    except Exception as e:
+        print(f"Error cleaning up old restores: {e}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Restore a backup into the database")
+    parser.add_argument('backup', help='archive directory or .tar, or a .sql/.sql.gz dump')
+    parser.add_argument('--jobs', type=int, default=RESTORE_JOBS)
+    parser.add_argument('--batch-mb', type=float, default=BATCH_BYTES / 1024 / 1024,
+                        help='size of the merged INSERT statements')
+    parser.add_argument('--database', default=db_config.database)
+    args = parser.parse_args()
+
+    db_config.database = args.database
+    report = Restorer(args.jobs, int(args.batch_mb * 1024 * 1024)).restore(args.backup)
+    query_cache.invalidate_all()
+    print(f"{report['rows']} rows into {report['tables']} tables in {report['seconds']}s "
+          f"({report['rows_per_s']} rows/s, {report['mb_per_s']} MB/s of SQL), "
+          f"{report['indexes_rebuilt']} indexes rebuilt, phases: {report['phases']}")
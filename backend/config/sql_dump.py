@@ -0,0 +1,262 @@
+"""
+SQL dump of the database as bounded chunks, shared by the backup engines
+"""
+import datetime
+import re
+from typing import Iterator, Optional, Tuple
+
+import MySQLdb.cursors
+
+from config.migrations import JOBS_TABLE
+
+ROWS_PER_INSERT = 500             # rows fetched from the server-side cursor at a time
+MAX_INSERT_BYTES = 1024 * 1024    # keeps every statement well below max_allowed_packet
+
+INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint')
+
+# Restored triggers belong to the account restoring them, which may not be allowed to name another
+DEFINER = re.compile(r'\s+DEFINER\s*=\s*(?:`[^`]*`|\S+?)@(?:`[^`]*`|\S+)')
+
+# The job queue belongs to the running server, not to the data: restoring it would
+# drop the row of the restore job itself and run the snapshot's jobs again.
+# cambio_semestre stays: its checkpoints say which restored rows up to a mark
+# still belong to an unfinished rollover, which can then be resumed.
+NOT_DUMPED = (JOBS_TABLE,)
+
+class SqlDumper:
+    """Dump of the database as bounded SQL chunks, restartable from any chunk boundary.
+
+    A position says where the dump stands: {'part': i} with part 0 the header,
+    parts 1..n the tables of the plan and n + 1 the triggers, views and
+    footer (after the data, so that restoring the rows does not fire the
+    triggers). Inside a table, 'rows' counts the rows already dumped (None
+    before its structure) and 'after' holds the primary key of the last one.
+    """
+
+    def __init__(self, connection, database: str):
+        self.connection = connection
+        self.database = database
+
+    def plan(self) -> dict:
+        """Tables (with their columns and primary key), views and triggers to dump"""
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
+            tables = [row[0] for row in cursor.fetchall() if row[0] not in NOT_DUMPED]
+            cursor.execute("SHOW FULL TABLES WHERE Table_type = 'VIEW'")
+            views = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SHOW TRIGGERS")
+            triggers = [row[0] for row in cursor.fetchall() if row[2] not in NOT_DUMPED]
+
+            plan_tables = []
+            for table in tables:
+                cursor.execute(f"SHOW COLUMNS FROM `{table}`")
+                columns = cursor.fetchall()
+                key = [column for column in columns if column[3] == 'PRI']
+                plan_tables.append({
+                    'name': table,
+                    'columns': [column[0] for column in columns],
+                    'key': [column[0] for column in key],
+                    # An integer primary key can be split into ranges, as can an auto-increment
+                    # id followed by other key columns (the partitioned record tables)
+                    'integer_key': bool(key) and key[0][1].split('(')[0].lower() in INTEGER_TYPES
+                                   and (len(key) == 1 or 'auto_increment' in key[0][5].lower()),
+                })
+            return {
+                'created_at': str(datetime.datetime.now()),
+                'tables': plan_tables,
+                'views': views,
+                'triggers': triggers,
+            }
+        finally:
+            cursor.close()
+
+    def chunks(self, plan: dict, position: dict) -> Iterator[Tuple[bytes, dict]]:
+        """Yield (SQL chunk, position after it) from position to the end of the dump"""
+        tables = plan['tables']
+        part = position['part']
+
+        if part == 0:
+            part = 1
+            yield self.header(plan), {'part': part}
+
+        while part <= len(tables):
+            table = tables[part - 1]
+            if position.get('part') != part or position.get('rows') is None:
+                position = {'part': part, 'rows': 0, 'after': None}
+                yield self.structure(table['name']), position
+            yield from self.rows(part, table, position)
+            part += 1
+
+        if part == len(tables) + 1:
+            # Plans checkpointed before triggers were dumped have none
+            yield self.triggers(plan.get('triggers', [])) + self.views(plan['views']), {'part': part + 1}
+
+    def header(self, plan: dict) -> bytes:
+        return "\n".join([
+            "-- Database backup generated by CDD Legrigne",
+            f"-- Database: {self.database}",
+            f"-- Generated on: {plan['created_at']}",
+            "",
+            "SET FOREIGN_KEY_CHECKS = 0;",
+            "",
+            "",
+        ]).encode()
+
+    def structure(self, table: str) -> bytes:
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(f"SHOW CREATE TABLE `{table}`")
+            create_table = cursor.fetchone()[1]
+        finally:
+            cursor.close()
+        return "\n".join([
+            f"-- Structure for table `{table}`",
+            f"DROP TABLE IF EXISTS `{table}`;",
+            create_table + ";",
+            "",
+            f"-- Data for table `{table}`",
+            "",
+        ]).encode()
+
+    def rows(self, part: int, table: dict, position: dict,
+             bounds: Optional[Tuple[Optional[int], Optional[int]]] = None) -> Iterator[Tuple[bytes, dict]]:
+        """Multi-row INSERTs of the rows after position, streamed from a server-side cursor.
+
+        bounds limits an integer primary key to [low, high) for range
+        splitting; None leaves that side open.
+        """
+        name = table['name']
+        column_list = ", ".join(f"`{column}`" for column in table['columns'])
+        key = table['key']
+        query = f"SELECT {column_list} FROM `{name}`"
+        conditions = []
+        params = []
+
+        if key:
+            # Keyset resume: restart right after the last dumped primary key
+            key_list = ", ".join(f"`{column}`" for column in key)
+            if position['after'] is not None:
+                conditions.append(f"({key_list}) > ({', '.join(['%s'] * len(key))})")
+                params.extend(position['after'])
+            if bounds is not None:
+                low, high = bounds
+                if low is not None:
+                    conditions.append(f"`{key[0]}` >= %s")
+                    params.append(low)
+                if high is not None:
+                    conditions.append(f"`{key[0]}` < %s")
+                    params.append(high)
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            query += f" ORDER BY {key_list}"
+        else:
+            # No primary key: a total order over every column, skipping what was dumped
+            query += f" ORDER BY {column_list} LIMIT 18446744073709551615 OFFSET {int(position['rows'])}"
+
+        key_indexes = [table['columns'].index(column) for column in key]
+        insert = f"INSERT INTO `{name}` ({column_list}) VALUES\n".encode()
+        rows_done = position['rows']
+
+        cursor = self.connection.cursor(MySQLdb.cursors.SSCursor)
+        try:
+            cursor.execute(query, tuple(params) or None)
+            while True:
+                rows = cursor.fetchmany(ROWS_PER_INSERT)
+                if not rows:
+                    break
+                values = []
+                size = 0
+                for index, row in enumerate(rows):
+                    literal = self._literal(row)
+                    values.append(literal)
+                    size += len(literal) + 2
+                    if size >= MAX_INSERT_BYTES or index == len(rows) - 1:
+                        rows_done += len(values)
+                        yield insert + b",\n".join(values) + b";\n\n", {
+                            'part': part,
+                            'rows': rows_done,
+                            'after': [row[i] for i in key_indexes] or None,
+                        }
+                        values = []
+                        size = 0
+        finally:
+            cursor.close()
+
+    def rows_with_keys(self, table: dict, keys: list) -> Iterator[Tuple[bytes, dict]]:
+        """Multi-row INSERTs of the rows whose single-column primary key is in keys"""
+        name = table['name']
+        column_list = ", ".join(f"`{column}`" for column in table['columns'])
+        key = table['key'][0]
+        insert = f"INSERT INTO `{name}` ({column_list}) VALUES\n".encode()
+        rows_done = 0
+
+        cursor = self.connection.cursor()
+        try:
+            for start in range(0, len(keys), ROWS_PER_INSERT):
+                batch = keys[start:start + ROWS_PER_INSERT]
+                cursor.execute(
+                    f"SELECT {column_list} FROM `{name}` WHERE `{key}` IN ({', '.join(['%s'] * len(batch))}) "
+                    f"ORDER BY `{key}`",
+                    tuple(batch)
+                )
+                values = []
+                size = 0
+                rows = cursor.fetchall()
+                for index, row in enumerate(rows):
+                    literal = self._literal(row)
+                    values.append(literal)
+                    size += len(literal) + 2
+                    if size >= MAX_INSERT_BYTES or index == len(rows) - 1:
+                        rows_done += len(values)
+                        yield insert + b",\n".join(values) + b";\n\n", {'rows': rows_done}
+                        values = []
+                        size = 0
+        finally:
+            cursor.close()
+
+    def _literal(self, row) -> bytes:
+        """A row as an escaped SQL tuple, using the connection's own quoting"""
+        literal = self.connection.literal(tuple(row))
+        return literal if isinstance(literal, bytes) else literal.encode()
+
+    def triggers(self, triggers: list) -> bytes:
+        """DROP and CREATE of the triggers, between DELIMITER lines as their bodies may hold ';'"""
+        if not triggers:
+            return b""
+        sql = ["DELIMITER ;;"]
+        cursor = self.connection.cursor()
+        try:
+            for trigger in triggers:
+                cursor.execute(f"SHOW CREATE TRIGGER `{trigger}`")
+                create_trigger = DEFINER.sub('', cursor.fetchone()[2], count=1)
+                sql.append(f"-- Trigger `{trigger}`")
+                sql.append(f"DROP TRIGGER IF EXISTS `{trigger}`;;")
+                sql.append(create_trigger + ";;")
+        finally:
+            cursor.close()
+        sql.append("DELIMITER ;")
+        sql.append("")
+        sql.append("")
+        return "\n".join(sql).encode()
+
+    def views(self, views: list) -> bytes:
+        sql = []
+        cursor = self.connection.cursor()
+        try:
+            for view in views:
+                try:
+                    cursor.execute(f"SHOW CREATE VIEW `{view}`")
+                    create_view = cursor.fetchone()[1]
+                    sql.append(f"-- View structure for `{view}`")
+                    sql.append(f"DROP VIEW IF EXISTS `{view}`;")
+                    sql.append(create_view + ";")
+                    sql.append("")
+                except Exception as e:
+                    sql.append(f"-- Error creating view {view}: {str(e)}")
+                    sql.append("")
+        finally:
+            cursor.close()
+        sql.append("SET FOREIGN_KEY_CHECKS = 1;")
+        sql.append("")
+        return "\n".join(sql).encode()
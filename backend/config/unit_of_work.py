@@ -0,0 +1,39 @@
+"""
+Request-scoped unit of work: one connection and one transaction per request
+"""
+from flask import Flask, g, jsonify
+
+from config import request_timing
+from config.database import UNIT_OF_WORK
+
+def init_unit_of_work(app: Flask) -> None:
+    """Make every db_config.get_connection() in a request share one connection.
+
+    The connection is acquired lazily on first use and stored in flask.g.
+    Reads run in autocommit mode; the first write opens a transaction, which
+    is committed once after the view returns (or rolled back on a 5xx) and
+    the connection goes back to the pool when the app context ends.
+    """
+    app.extensions[UNIT_OF_WORK] = True
+
+    @app.after_request
+    def commit_unit_of_work(response):
+        connection = g.pop('db_connection', None)
+        if connection is None:
+            return response
+        try:
+            with request_timing.span('db'):
+                connection.finish(commit=response.status_code < 500)
+        except Exception as e:
+            error = jsonify({'error': f"Transaction commit failed: {e}"})
+            error.status_code = 500
+            return error
+        return response
+
+    @app.teardown_appcontext
+    def release_unit_of_work(exc):
+        # Only reached with a connection when after_request did not run
+        # (unhandled exception, or an app context without a request)
+        connection = g.pop('db_connection', None)
+        if connection is not None:
+            connection.finish(commit=exc is None)
@@ -5,7 +5,9 @@ Account Data Access Object for interacting with user account data.
 from typing import List, Optional
 
 from flask import session
+from config.backup import Backup
 from config.database import db_config
+from config.restore import Restore
 
 class AccountDAO:
     """Data Access Object for user accounts"""
@@ -163,8 +165,8 @@ class AccountDAO:
             if connection:
                 connection.close()
                 
-    def backup_database(self, password: str) -> Optional[str]: 
-        """Verify user credentials and return database backup SQL"""
+    def backup_database(self, password: str, engine: Optional[str] = None) -> Optional[Backup]: 
+        """Verify user credentials and register a database backup to download"""
         query = """
             SELECT * FROM account
             WHERE password = %s and id = %s
@@ -180,15 +182,38 @@ class AccountDAO:
             result = cursor.fetchone()
             
             if result:
-                # User authenticated, proceed with backup
-                try:
-                    # Try mysqldump first (more efficient)
-                    sql_backup = db_config.backup_database_python()
-                    return sql_backup
-                except Exception:
-                    # Fallback to Python-based backup
-                    sql_backup = db_config.backup_database_python()
-                    return sql_backup
+                # User authenticated: the dump itself is streamed by the download
+                return Backup.create(session.get('user_id'), engine)
+            return None  # Authentication failed
+        
+        except Exception as e:
+            if connection:
+                connection.rollback()
+            raise e
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def restore_database(self, password: str, upload) -> Optional[Restore]:
+        """Verify user credentials and restore an uploaded backup in the background"""
+        query = """
+            SELECT * FROM account
+            WHERE password = %s and id = %s
+        """
+        
+        connection = None
+        cursor = None
+        
+        try:
+            connection = db_config.get_connection()
+            cursor = connection.cursor()
+            cursor.execute(query, (password, session.get('user_id')))
+            result = cursor.fetchone()
+            
+            if result:
+                return Restore.create(session.get('user_id'), upload)
             return None  # Authentication failed
         
         except Exception as e:
@@ -2,17 +2,23 @@
 Data Access Object for activities
 """
 
-from typing import List
+from typing import Dict, List
 
+import numpy as np
 from flask import session
 from config.database import db_config
+from charts.series import rows_to_columns, with_epoch_days
+from config.query_cache import query_cache, record_tag
+from dao.appreciations_summary_dao import (
+    appreciations_summary_dao, score_percent, semester_key, LIVE_SEMESTER, SUMMARY_TABLE
+)
+from dao.semester_dao import rollover_semester
 
 class ActivitiesDAO:
     """Data Access Object for activities"""
 
     def get_activities(self, person_id: int, month: int | None) -> List[dict]:
         """Get activities for a specific person"""
-        semester_constraint = " = %s" if session.get('semester') is not None else " IS NULL"
         month_constraint = " AND pa.mese_int = %s" if month is not None else ""
         query = f"""
             SELECT 
@@ -28,12 +34,13 @@ class ActivitiesDAO:
                 pa.umore,
                 pa.comunicazione,
                 pa.comportamento_problematico,
-                a.id as attivita_id
+                a.id as attivita_id,
+                pa.data
 
             FROM partecipazione_attivita pa
             LEFT JOIN attivita a ON pa.attivita = a.id
-            WHERE id_persona = %s AND pa.id_semestre {semester_constraint}{month_constraint}
-            ORDER BY anno DESC, mese_int DESC, giorno DESC, mattino ASC
+            WHERE id_persona = %s AND pa.semestre_chiave = %s{month_constraint}
+            ORDER BY pa.data DESC, mattino ASC
         """
         
         connection = None
@@ -42,13 +49,11 @@ class ActivitiesDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
-            params = [person_id]
-            if session.get('semester') is not None:
-                params.append(session.get('semester'))
+            key = semester_key(session.get('semester'))
+            params = [person_id, key]
             if month is not None:
                 params.append(month)
-            cursor.execute(query, params)
-            results = cursor.fetchall()
+            results = query_cache.fetchall(cursor, query, params, [record_tag('partecipazione_attivita', person_id, key)])
             
             if results is None:
                 raise Exception("No activities found for the given person_id")
@@ -58,7 +63,7 @@ class ActivitiesDAO:
                 activities.append({
                     'id': row[0],
                     'person_id': row[1],
-                    'date': str(row[4]) + '-' + str(row[3]).zfill(2) + '-' + str(row[2]).zfill(2),
+                    'date': str(row[13]),
                     'morning': row[5],
                     'activity': row[6],
                     'adesion': row[7],
@@ -81,117 +86,155 @@ class ActivitiesDAO:
             if connection:
                 connection.close()
                 
-    def get_appreciations(self, month: int = None) -> List[dict]:
-        """Get appreciations for all persons"""
-        semester_constraint = " = %s" if session.get('semester') is not None else " IS NULL"
-        month_constraint = " AND g.mese = %s" if month is not None else ""
+    def get_activity_series(self, person_id: int, month: int | None) -> Dict[str, np.ndarray]:
+        """Get mood and communication of a person as chronological columns"""
+        month_constraint = " AND mese_int = %s" if month is not None else ""
+        query = f"""
+            SELECT anno, mese_int, giorno, mattino, umore, comunicazione
+            FROM partecipazione_attivita
+            WHERE id_persona = %s AND semestre_chiave = %s{month_constraint}
+                AND umore IS NOT NULL AND comunicazione IS NOT NULL
+            ORDER BY data, mattino DESC
+        """
+        
+        connection = None
+        cursor = None
         
+        try:
+            connection = db_config.get_connection()
+            cursor = connection.cursor()
+            key = semester_key(session.get('semester'))
+            params = [person_id, key]
+            if month is not None:
+                params.append(month)
+            rows = query_cache.fetchall(cursor, query, params, [record_tag('partecipazione_attivita', person_id, key)])
+            return with_epoch_days(rows_to_columns(rows, {
+                'year': (0, 'int16'),
+                'month': (1, 'int8'),
+                'day': (2, 'int8'),
+                'morning': (3, 'uint8'),
+                'mood': (4, 'uint8'),
+                'communication': (5, 'uint8'),
+            }))
+        
+        except Exception as e:
+            if connection:
+                connection.rollback()
+            raise e
+
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def _appreciations_query(self, month: int | None):
+        """Build the appreciations query and its parameters for the session's semester"""
         if month is not None:
             # Return data for specific month
             query = f"""
                 SELECT 
                     p.nome,
                     p.cognome,
-                    g.id_persona,
-                    g.attivita,
-                    g.mese,
-                    g.id_semestre,
-                    g.mediaAdesione,
-                    g.mediaPartecipazione,
-                    g.nVolte,
+                    r.id_persona,
+                    r.attivita,
+                    r.mese,
+                    NULLIF(r.id_semestre, {LIVE_SEMESTER}),
+                    {score_percent('r.somma_adesione', 'r.n_adesione')} as media_adesione,
+                    {score_percent('r.somma_partecipazione', 'r.n_partecipazione')} as media_partecipazione,
+                    SUM(r.n_volte) as n_volte,
                     a.id,
                     a.nome_attivita,
                     a.abbreviazione
-                FROM grad g 
-                JOIN attivita a ON g.attivita = a.id
-                JOIN persona p ON g.id_persona = p.id
-                WHERE id_semestre {semester_constraint}{month_constraint}
-                ORDER BY g.id_persona, a.abbreviazione, g.mese
+                FROM {SUMMARY_TABLE} r
+                JOIN attivita a ON r.attivita = a.id
+                JOIN persona p ON r.id_persona = p.id
+                WHERE r.id_semestre = %s AND r.mese = %s
+                GROUP BY r.id_persona, r.attivita, r.mese, r.id_semestre, a.id, a.nome_attivita, a.abbreviazione, p.nome, p.cognome
+                ORDER BY r.id_persona, a.abbreviazione, r.mese
             """
         else:
-            # Aggregate by month and calculate final averages
+            # Average the monthly averages, as grad consumers always did
             query = f"""
                 SELECT 
                     p.nome,
                     p.cognome,
-                    g.id_persona,
-                    g.attivita,
-                    AVG(g.mediaAdesione) as avg_adesione,
-                    AVG(g.mediaPartecipazione) as avg_partecipazione,
-                    SUM(g.nVolte) as total_volte,
+                    m.id_persona,
+                    m.attivita,
+                    AVG(m.media_adesione) as avg_adesione,
+                    AVG(m.media_partecipazione) as avg_partecipazione,
+                    SUM(m.n_volte) as total_volte,
                     a.id,
                     a.nome_attivita,
                     a.abbreviazione
-                FROM grad g 
-                JOIN attivita a ON g.attivita = a.id
-                JOIN persona p ON g.id_persona = p.id
-                WHERE id_semestre {semester_constraint}
-                GROUP BY g.id_persona, g.attivita, a.id, a.nome_attivita, a.abbreviazione, p.nome, p.cognome
-                ORDER BY g.id_persona, a.abbreviazione
+                FROM (
+                    SELECT
+                        r.id_persona,
+                        r.attivita,
+                        {score_percent('r.somma_adesione', 'r.n_adesione')} as media_adesione,
+                        {score_percent('r.somma_partecipazione', 'r.n_partecipazione')} as media_partecipazione,
+                        SUM(r.n_volte) as n_volte
+                    FROM {SUMMARY_TABLE} r
+                    WHERE r.id_semestre = %s
+                    GROUP BY r.id_persona, r.attivita, r.mese
+                ) m
+                JOIN attivita a ON m.attivita = a.id
+                JOIN persona p ON m.id_persona = p.id
+                GROUP BY m.id_persona, m.attivita, a.id, a.nome_attivita, a.abbreviazione, p.nome, p.cognome
+                ORDER BY m.id_persona, a.abbreviazione
             """
         
+        params = [semester_key(session.get('semester'))]
+        if month is not None:
+            params.append(month)
+        return query, params
+
+    def get_appreciations(self, month: int = None) -> List[dict]:
+        """Get appreciations for all persons"""
+        query, params = self._appreciations_query(month)
+        
         connection = None
         cursor = None
 
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
-            
-            params = []
-            if session.get('semester') is not None:
-                params.append(session.get('semester'))
-            if month is not None:
-                params.append(month)
-                
             cursor.execute(query, params)
             results = cursor.fetchall()
 
+            # Rows come ordered by id_persona: consecutive rows belong to the same person
             appreciations = []
-            # Group results by id_persona
-            grouped_data = {}
-            person_names = {}
             for row in results:
                 person_id = row[2]
                 
-                # Store person's name and surname
-                if person_id not in person_names:
-                    person_names[person_id] = {
+                if not appreciations or appreciations[-1]['id_persona'] != person_id:
+                    appreciations.append({
+                        'id_persona': person_id,
                         'nome': row[0],
-                        'cognome': row[1]
-                    }
-                
-                if person_id not in grouped_data:
-                    grouped_data[person_id] = []
+                        'cognome': row[1],
+                        'activities': []
+                    })
                 
                 if month is not None:
-                    grouped_data[person_id].append({
+                    appreciations[-1]['activities'].append({
                         'id_persona': row[2],
                         'attivita': row[3],
                         'mese': row[4],
                         'id_semestre': row[5],
-                        'media_adesione': int(row[6]),
-                        'media_partecipazione': int(row[7]),
+                        'media_adesione': int(row[6] or 0),
+                        'media_partecipazione': int(row[7] or 0),
                         'n_volte': int(row[8]),
                         'abbreviazione': row[11],
                     })
                 else:
-                    grouped_data[person_id].append({
+                    appreciations[-1]['activities'].append({
                         'id_persona': row[2],
                         'attivita': row[3],
-                        'media_adesione': int(round(row[4], 0)),
-                        'media_partecipazione': int(round(row[5], 0)),
+                        'media_adesione': int(round(row[4] or 0, 0)),
+                        'media_partecipazione': int(round(row[5] or 0, 0)),
                         'n_volte': int(row[6]),
                         'abbreviazione': row[9],
                     })
-            
-            # Convert grouped data to list format
-            for person_id, person_data in grouped_data.items():
-                appreciations.append({
-                    'id_persona': person_id,
-                    'nome': person_names[person_id]['nome'],
-                    'cognome': person_names[person_id]['cognome'],
-                    'activities': person_data
-                })
                 
             activities = self.get_activities_list()
             return {
@@ -210,6 +253,56 @@ class ActivitiesDAO:
             if connection:
                 connection.close()
 
+    def get_appreciations_series(self, month: int = None) -> dict:
+        """Get appreciations as columns (one entry per person and activity) plus person names"""
+        query, params = self._appreciations_query(month)
+        if month is not None:
+            spec = {'person_id': (2, 'int32'), 'activity_id': (3, 'int32'),
+                    'media_adesione': (6, 'float32'), 'media_partecipazione': (7, 'float32'),
+                    'n_volte': (8, 'int32')}
+        else:
+            spec = {'person_id': (2, 'int32'), 'activity_id': (3, 'int32'),
+                    'media_adesione': (4, 'float32'), 'media_partecipazione': (5, 'float32'),
+                    'n_volte': (6, 'int32')}
+        
+        connection = None
+        cursor = None
+
+        try:
+            connection = db_config.get_connection()
+            cursor = connection.cursor()
+            cursor.execute(query, params)
+            results = cursor.fetchall()
+
+            columns = rows_to_columns(results, spec, fill_null={'media_adesione': 0, 'media_partecipazione': 0})
+            # Same integer conversion as get_appreciations
+            to_int = np.trunc if month is not None else np.round
+            for name in ('media_adesione', 'media_partecipazione'):
+                columns[name] = to_int(columns[name]).astype(np.uint8)
+
+            person_ids, first_rows = np.unique(columns['person_id'], return_index=True)
+            persons = {
+                'id_persona': person_ids.tolist(),
+                'nome': [results[i][0] for i in first_rows],
+                'cognome': [results[i][1] for i in first_rows]
+            }
+            return {
+                'columns': columns,
+                'persons': persons,
+                'activities': self.get_activities_list()
+            }
+
+        except Exception as e:
+            if connection:
+                connection.rollback()
+            raise e
+
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
     def get_activities_list(self) -> List[dict]:
         """Get the available activities"""
         query = """
@@ -276,6 +369,17 @@ class ActivitiesDAO:
                 data['communication'],
                 problem_behaviour
             ))
+            appreciations_summary_dao.add_entry(
+                cursor,
+                person_id=data['person_id'],
+                activity_id=data['activity'],
+                semester_id=None,
+                year=int(date[0]),
+                month=int(date[1]),
+                adhesion=data['adesion'],
+                participation=data['participation']
+            )
+            query_cache.invalidate_record(connection, 'partecipazione_attivita', data['person_id'])
             connection.commit()
 
         except Exception as e:
@@ -291,6 +395,12 @@ class ActivitiesDAO:
                 
     def delete_activity(self, activity_id: int) -> None:
         """Delete an activity entry"""
+        select_query = """
+            SELECT id_persona, attivita, id_semestre, anno, mese_int, adesione, partecipazione
+            FROM partecipazione_attivita
+            WHERE id = %s
+            FOR UPDATE
+        """
         query = "DELETE FROM partecipazione_attivita WHERE id = %s"
         
         connection = None
@@ -299,7 +409,25 @@ class ActivitiesDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
+            cursor.execute(select_query, (activity_id,))
+            row = cursor.fetchone()
             cursor.execute(query, (activity_id,))
+            if row:
+                semester_id = row[2]
+                if semester_id is None:
+                    # Not moved yet by a running rollover, whose semester already holds it in the summary
+                    semester_id = rollover_semester(cursor, 'partecipazione_attivita', activity_id)
+                appreciations_summary_dao.remove_entry(
+                    cursor,
+                    person_id=row[0],
+                    activity_id=row[1],
+                    semester_id=semester_id,
+                    year=row[3],
+                    month=row[4],
+                    adhesion=row[5],
+                    participation=row[6]
+                )
+                query_cache.invalidate_record(connection, 'partecipazione_attivita', row[0], row[2])
             connection.commit()
 
         except Exception as e:
@@ -314,7 +442,10 @@ class ActivitiesDAO:
                 connection.close()
                 
     def declare_absence(self, data: dict) -> None:
-        """Declare absence for a person"""
+        """Declare absence for a person.
+
+        Absence rows have no activity, so riepilogo_gradimento is left untouched.
+        """
         query = """
             INSERT INTO partecipazione_attivita (id_persona, giorno, mese_int, anno, mattino, attivita, id_semestre)
             VALUES (%s, %s, %s, %s, %s, NULL, NULL);
@@ -341,6 +472,7 @@ class ActivitiesDAO:
                 date[0],
                 1
             ))
+            query_cache.invalidate_record(connection, 'partecipazione_attivita', data['person_id'])
             connection.commit()
 
         except Exception as e:
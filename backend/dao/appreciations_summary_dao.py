@@ -0,0 +1,298 @@
+"""
+Data Access Object for the appreciation summary table
+
+riepilogo_gradimento holds, per (person, activity, semester, year, month),
+the sums and counts of the adhesion/participation scores recorded in
+partecipazione_attivita. It replaces scans of the grad view and is kept up
+to date incrementally by the activity and semester DAOs.
+
+Rebuild it from scratch with:
+
+    python -m dao.appreciations_summary_dao rebuild [--no-verify]
+
+The rebuild can run while the application is serving: the deployment
+scripts run it once before restarting, as a check, and again once the new
+code maintains the table, for the entries written in between.
+
+The rebuild is compared with the grad view, when the database has it, and
+exits with status 1 on any difference, printing grad's definition: the
+deployment scripts stop there rather than serve percentages that differ
+from the ones operators are used to. Compare without rebuilding, e.g. on a
+copy of the production database, with:
+
+    python -m dao.appreciations_summary_dao verify
+"""
+
+import argparse
+import sys
+from typing import Optional
+
+from config.database import db_config
+
+SUMMARY_TABLE = 'riepilogo_gradimento'
+
+# The live semester (id_semestre IS NULL elsewhere) is stored as 0 so it can be part of the key
+LIVE_SEMESTER = 0
+
+CREATE_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS {SUMMARY_TABLE} (
+        id_semestre INT NOT NULL DEFAULT {LIVE_SEMESTER},
+        id_persona INT NOT NULL,
+        attivita INT NOT NULL,
+        anno INT NOT NULL,
+        mese INT NOT NULL,
+        somma_adesione INT NOT NULL DEFAULT 0,
+        n_adesione INT NOT NULL DEFAULT 0,
+        somma_partecipazione INT NOT NULL DEFAULT 0,
+        n_partecipazione INT NOT NULL DEFAULT 0,
+        n_volte INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (id_semestre, id_persona, attivita, anno, mese)
+    )
+"""
+
+# Stands for grad.mediaAdesione / grad.mediaPartecipazione, which get_appreciations read before
+# the summary (per month, and AVG() of the months for a semester). grad is a view defined only
+# in the production database, not in this repository, so this formula (scores 1-4 mapped to
+# 0-100) is checked rather than derived: verify_against_grad compares both on the real rows,
+# and rebuild refuses to go on when they differ
+def score_percent(total: str, count: str) -> str:
+    """SQL expression turning summed scores into grad's percentage"""
+    return f"(SUM({total}) / NULLIF(SUM({count}), 0) - 1) * 100 / 3"
+
+def semester_key(semester_id: Optional[int]) -> int:
+    """Key value of a semester in the summary table"""
+    return semester_id if semester_id is not None else LIVE_SEMESTER
+
+class AppreciationsSummaryDAO:
+    """Data Access Object for riepilogo_gradimento.
+
+    The incremental methods take the caller's cursor so that the summary is
+    updated in the same transaction as the activity rows.
+    """
+
+    def add_entry(self, cursor, person_id: int, activity_id: Optional[int], semester_id: Optional[int],
+                  year: int, month: int, adhesion: Optional[int], participation: Optional[int]) -> None:
+        """Account for a new partecipazione_attivita row"""
+        if activity_id is None:
+            # Absences have no activity and never show up in appreciations
+            return
+        cursor.execute(f"""
+            INSERT INTO {SUMMARY_TABLE}
+                (id_semestre, id_persona, attivita, anno, mese,
+                 somma_adesione, n_adesione, somma_partecipazione, n_partecipazione, n_volte)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 1)
+            ON DUPLICATE KEY UPDATE
+                somma_adesione = somma_adesione + VALUES(somma_adesione),
+                n_adesione = n_adesione + VALUES(n_adesione),
+                somma_partecipazione = somma_partecipazione + VALUES(somma_partecipazione),
+                n_partecipazione = n_partecipazione + VALUES(n_partecipazione),
+                n_volte = n_volte + 1
+        """, (
+            semester_key(semester_id), person_id, activity_id, year, month,
+            adhesion or 0, 0 if adhesion is None else 1,
+            participation or 0, 0 if participation is None else 1
+        ))
+
+    def remove_entry(self, cursor, person_id: int, activity_id: Optional[int], semester_id: Optional[int],
+                     year: int, month: int, adhesion: Optional[int], participation: Optional[int]) -> None:
+        """Account for a deleted partecipazione_attivita row"""
+        if activity_id is None:
+            return
+        key = (semester_key(semester_id), person_id, activity_id, year, month)
+        cursor.execute(f"""
+            UPDATE {SUMMARY_TABLE} SET
+                somma_adesione = somma_adesione - %s,
+                n_adesione = n_adesione - %s,
+                somma_partecipazione = somma_partecipazione - %s,
+                n_partecipazione = n_partecipazione - %s,
+                n_volte = n_volte - 1
+            WHERE id_semestre = %s AND id_persona = %s AND attivita = %s AND anno = %s AND mese = %s
+        """, (
+            adhesion or 0, 0 if adhesion is None else 1,
+            participation or 0, 0 if participation is None else 1
+        ) + key)
+        cursor.execute(f"""
+            DELETE FROM {SUMMARY_TABLE}
+            WHERE id_semestre = %s AND id_persona = %s AND attivita = %s AND anno = %s AND mese = %s
+                AND n_volte <= 0
+        """, key)
+
+    def close_semester(self, cursor, semester_id: int) -> None:
+        """Move the live semester's rows to a newly created semester"""
+        cursor.execute(
+            f"UPDATE {SUMMARY_TABLE} SET id_semestre = %s WHERE id_semestre = %s",
+            (semester_id, LIVE_SEMESTER)
+        )
+
+    def rebuild(self) -> int:
+        """Recompute the whole table from partecipazione_attivita, return the number of rows.
+
+        Safe next to the live application: the rebuild first share-locks
+        partecipazione_attivita, so the entries being written are committed
+        (with their summary update) before it and new ones wait until after
+        it. Writers lock the activity rows before the summary, as it does.
+        """
+        connection = None
+        cursor = None
+
+        try:
+            connection = db_config.get_connection()
+            cursor = connection.cursor()
+            cursor.execute(CREATE_TABLE)
+            # DDL commits implicitly: start the rebuild transaction afterwards
+            connection.commit()
+            cursor.execute("SELECT COUNT(*) FROM partecipazione_attivita LOCK IN SHARE MODE")
+            cursor.execute(f"DELETE FROM {SUMMARY_TABLE}")
+            cursor.execute(f"""
+                INSERT INTO {SUMMARY_TABLE}
+                    (id_semestre, id_persona, attivita, anno, mese,
+                     somma_adesione, n_adesione, somma_partecipazione, n_partecipazione, n_volte)
+                SELECT
+                    COALESCE(id_semestre, {LIVE_SEMESTER}),
+                    id_persona,
+                    attivita,
+                    anno,
+                    mese_int,
+                    COALESCE(SUM(adesione), 0),
+                    COUNT(adesione),
+                    COALESCE(SUM(partecipazione), 0),
+                    COUNT(partecipazione),
+                    COUNT(*)
+                FROM partecipazione_attivita
+                WHERE attivita IS NOT NULL
+                GROUP BY COALESCE(id_semestre, {LIVE_SEMESTER}), id_persona, attivita, anno, mese_int
+            """)
+            rows = cursor.rowcount
+            connection.commit()
+            return rows
+
+        except Exception as e:
+            if connection:
+                connection.rollback()
+            raise Exception(f"Error rebuilding {SUMMARY_TABLE}: {str(e)}")
+
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def grad_definition(self) -> Optional[str]:
+        """CREATE VIEW statement of grad, None if the database has no such view"""
+        connection = None
+        cursor = None
+
+        try:
+            connection = db_config.get_connection()
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1 FROM information_schema.VIEWS WHERE TABLE_SCHEMA = DATABASE() "
+                           "AND TABLE_NAME = 'grad'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute("SHOW CREATE VIEW grad")
+            return cursor.fetchone()[1]
+
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def verify_against_grad(self) -> list:
+        """Return the groups whose values differ from the grad view.
+
+        Both what /appreciations shows for a month, per (person, activity,
+        semester, month), and for a whole semester, the average of the
+        months, per (person, activity, semester) with mese None.
+        """
+        monthly = f"""
+            SELECT g.id_persona, g.attivita, g.id_semestre, g.mese,
+                g.mediaAdesione, g.mediaPartecipazione, g.nVolte,
+                s.media_adesione, s.media_partecipazione, s.n_volte
+            FROM grad g
+            LEFT JOIN ({self._monthly_percents()}) s ON s.id_persona = g.id_persona AND s.attivita = g.attivita
+                AND s.id_semestre <=> g.id_semestre AND s.mese = g.mese
+        """
+        semester = f"""
+            SELECT g.id_persona, g.attivita, g.id_semestre, NULL,
+                g.media_adesione, g.media_partecipazione, g.n_volte,
+                s.media_adesione, s.media_partecipazione, s.n_volte
+            FROM (
+                SELECT id_persona, attivita, id_semestre, AVG(mediaAdesione) as media_adesione,
+                    AVG(mediaPartecipazione) as media_partecipazione, SUM(nVolte) as n_volte
+                FROM grad
+                GROUP BY id_persona, attivita, id_semestre
+            ) g
+            LEFT JOIN (
+                SELECT id_persona, attivita, id_semestre, AVG(media_adesione) as media_adesione,
+                    AVG(media_partecipazione) as media_partecipazione, SUM(n_volte) as n_volte
+                FROM ({self._monthly_percents()}) m
+                GROUP BY id_persona, attivita, id_semestre
+            ) s ON s.id_persona = g.id_persona AND s.attivita = g.attivita AND s.id_semestre <=> g.id_semestre
+        """
+        connection = None
+        cursor = None
+
+        try:
+            connection = db_config.get_connection()
+            cursor = connection.cursor()
+            mismatches = []
+            for query in (monthly, semester):
+                cursor.execute(query)
+                for row in cursor.fetchall():
+                    # To the hundredth: a different formula must not hide behind the rounding
+                    expected = tuple(round(float(v), 2) if v is not None else None for v in row[4:7])
+                    actual = tuple(round(float(v), 2) if v is not None else None for v in row[7:10])
+                    if expected != actual:
+                        mismatches.append({
+                            'id_persona': row[0],
+                            'attivita': row[1],
+                            'id_semestre': row[2],
+                            'mese': row[3],
+                            'grad': expected,
+                            'summary': actual
+                        })
+            return mismatches
+
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    @staticmethod
+    def _monthly_percents() -> str:
+        """The summary's monthly values, keyed like grad (id_semestre NULL for the live semester)"""
+        return f"""
+            SELECT id_persona, attivita, NULLIF(id_semestre, {LIVE_SEMESTER}) as id_semestre, mese,
+                {score_percent('somma_adesione', 'n_adesione')} as media_adesione,
+                {score_percent('somma_partecipazione', 'n_partecipazione')} as media_partecipazione,
+                SUM(n_volte) as n_volte
+            FROM {SUMMARY_TABLE}
+            GROUP BY id_persona, attivita, id_semestre, mese
+        """
+
+appreciations_summary_dao = AppreciationsSummaryDAO()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f"Maintain the {SUMMARY_TABLE} table")
+    parser.add_argument('command', choices=['rebuild', 'verify'],
+                        help='rebuild (then verify) the table, or only compare it with grad')
+    parser.add_argument('--no-verify', action='store_true', help='skip the comparison with the grad view')
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        print(f"{SUMMARY_TABLE}: {appreciations_summary_dao.rebuild()} rows")
+    if args.command == 'verify' or not args.no_verify:
+        definition = appreciations_summary_dao.grad_definition()
+        if definition is None:
+            print("No grad view to compare with")
+            sys.exit(0)
+        mismatches = appreciations_summary_dao.verify_against_grad()
+        if mismatches:
+            for mismatch in mismatches[:20]:
+                print(mismatch)
+            print(f"{len(mismatches)} groups differ from grad, defined as:\n{definition}\n"
+                  "Make score_percent match it before serving /appreciations from the summary")
+            sys.exit(1)
+        print("Every group matches grad, per month and per semester")
@@ -5,18 +5,19 @@ Data Access Object for logbook
 from typing import List
 from flask import session
 from config.database import db_config
+from config.query_cache import query_cache, record_tag
+from dao.appreciations_summary_dao import semester_key
 
 class LogbookDAO:
     """Data Access Object for logbook"""
     
     def get_logbook_entries(self, person_id: int) -> List[dict]:
         """Get logbook entries for a specific person"""
-        semester_constraint = " = %s" if session.get('semester') is not None else " IS NULL"
-        query = f"""
-            SELECT diario.*, account.nome, account.cognome FROM diario
+        query = """
+            SELECT diario.*, account.nome, account.cognome, diario.data FROM diario
             JOIN account ON diario.firma = account.id
-            WHERE id_persona = %s AND id_semestre {semester_constraint}
-            ORDER BY anno DESC, mese_int DESC, giorno DESC
+            WHERE id_persona = %s AND semestre_chiave = %s
+            ORDER BY diario.data DESC
         """
         
         connection = None
@@ -25,18 +26,15 @@ class LogbookDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
-            if session.get('semester') is not None:
-                cursor.execute(query, (person_id, session.get('semester')))
-            else:
-                cursor.execute(query, (person_id,))
-            results = cursor.fetchall()
+            key = semester_key(session.get('semester'))
+            results = query_cache.fetchall(cursor, query, (person_id, key), [record_tag('diario', person_id, key)])
             
             logbook_entries = []
             for row in results:
                 logbook_entries.append({
                     'id': row[0],
                     'person_id': row[1],
-                    'date': str(row[4]) + '-' + str(row[3]).zfill(2) + '-' + str(row[2]).zfill(2),
+                    'date': str(row[11]),
                     'event': row[5],
                     'intervention': row[6],
                     'signature': f"{row[9]} {row[10]}",
@@ -77,6 +75,7 @@ class LogbookDAO:
                 data['intervention'],
                 session.get('user_id')
             ))
+            query_cache.invalidate_record(connection, 'diario', data['person_id'])
             connection.commit()
 
         except Exception as e:
@@ -100,7 +99,10 @@ class LogbookDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
+            owner = query_cache.record_owner(cursor, 'diario', id)
             cursor.execute(query, (id,))
+            if owner:
+                query_cache.invalidate_record(connection, 'diario', *owner)
             connection.commit()
 
         except Exception as e:
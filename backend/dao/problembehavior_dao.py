@@ -5,13 +5,14 @@ Data Access Object for Problem Behavior
 from typing import List, Dict
 from flask import Blueprint, jsonify, session
 from config.database import db_config
+from config.query_cache import query_cache, record_tag
+from dao.appreciations_summary_dao import semester_key
 
 class ProblemBehaviorDAO:
     """Data Access Object for problem behavior"""
     
     def get_problem_behaviors(self, person_id: int) -> List[Dict]:
         """Get problem behaviors for a specific person"""
-        semester_constraint = " = %s" if session.get('semester') is not None else " IS NULL"
         
         connection = None
         cursor = None
@@ -38,7 +39,7 @@ class ProblemBehaviorDAO:
                 grouped_problems[classe].append(problem_dict)
             
             # Get all comportamento_problema records for the person
-            query_behaviors = f"""
+            query_behaviors = """
                 SELECT 
                     comportamento_problema.id,
                     id_persona,
@@ -51,19 +52,17 @@ class ProblemBehaviorDAO:
                     contenimento,
                     firma,
                     a.nome,
-                    a.cognome
+                    a.cognome,
+                    comportamento_problema.data
                 FROM comportamento_problema 
                 JOIN account a ON a.id = firma
-                WHERE id_persona = %s AND id_semestre {semester_constraint}
-                ORDER BY anno DESC, mese_int DESC, giorno DESC
+                WHERE id_persona = %s AND semestre_chiave = %s
+                ORDER BY comportamento_problema.data DESC
             """
             
-            if session.get('semester') is not None:
-                cursor.execute(query_behaviors, (person_id, session.get('semester')))
-            else:
-                cursor.execute(query_behaviors, (person_id,))
-            
-            behavior_rows = cursor.fetchall()
+            key = semester_key(session.get('semester'))
+            tags = [record_tag('comportamento_problema', person_id, key)]
+            behavior_rows = query_cache.fetchall(cursor, query_behaviors, (person_id, key), tags)
             
             # Get all evento_comportamento relationships for these behaviors
             if behavior_rows:
@@ -76,8 +75,7 @@ class ProblemBehaviorDAO:
                     WHERE id_evento IN ({placeholders})
                 """
                 
-                cursor.execute(query_events, behavior_ids)
-                event_relationships = cursor.fetchall()
+                event_relationships = query_cache.fetchall(cursor, query_events, behavior_ids, tags)
                 
                 # Create a mapping of behavior_id -> set of problem_ids
                 behavior_to_problems = {}
@@ -94,7 +92,7 @@ class ProblemBehaviorDAO:
                 behavior_dict = {
                     'id': row[0],
                     'person_id': row[1],
-                    'date': str(row[4]) + '-' + str(row[3]).zfill(2) + '-' + str(row[2]).zfill(2),
+                    'date': str(row[12]),
                     'intensity': row[5],
                     'duration': row[6],
                     'cause': row[7],
@@ -173,6 +171,7 @@ class ProblemBehaviorDAO:
                 
                 cursor.execute(query_problems, params)
             
+            query_cache.invalidate_record(connection, 'comportamento_problema', data['person_id'])
             connection.commit()
         
         except Exception as e:
@@ -194,12 +193,15 @@ class ProblemBehaviorDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
+            owner = query_cache.record_owner(cursor, 'comportamento_problema', behavior_id)
             
             # Delete from evento_comportamento first
             cursor.execute("DELETE FROM evento_comportamento WHERE id_comportamento = %s", (behavior_id,))
             
             # Then delete from comportamento_problema
             cursor.execute("DELETE FROM comportamento_problema WHERE id = %s", (behavior_id,))
+            if owner:
+                query_cache.invalidate_record(connection, 'comportamento_problema', *owner)
             
             connection.commit()
         
@@ -5,18 +5,19 @@ Data Access Object for epileptic seizures
 from typing import List
 from flask import session
 from config.database import db_config
+from config.query_cache import query_cache, record_tag
+from dao.appreciations_summary_dao import semester_key
 
 class SeizureDAO:
     """Data Access Object for epileptic seizures"""
     
     def get_seizures(self, person_id: int) -> List[dict]:
         """Get all seizures for a specific person."""
-        semester_constraint = " = %s" if session.get('semester') is not None else " IS NULL"
-        query = f"""
-            SELECT crisi_epilettica.*, account.nome, account.cognome FROM crisi_epilettica
+        query = """
+            SELECT crisi_epilettica.*, account.nome, account.cognome, crisi_epilettica.data FROM crisi_epilettica
             JOIN account ON crisi_epilettica.firma = account.id
-            WHERE id_persona = %s AND id_semestre {semester_constraint}
-            ORDER BY anno DESC, mese_int DESC, giorno DESC
+            WHERE id_persona = %s AND semestre_chiave = %s
+            ORDER BY crisi_epilettica.data DESC
         """
         
         connection = None
@@ -25,11 +26,8 @@ class SeizureDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
-            if session.get('semester') is not None:
-                cursor.execute(query, (person_id, session.get('semester')))
-            else:
-                cursor.execute(query, (person_id,))
-            results = cursor.fetchall()
+            key = semester_key(session.get('semester'))
+            results = query_cache.fetchall(cursor, query, (person_id, key), [record_tag('crisi_epilettica', person_id, key)])
             
             seizures = []
             for row in results:
@@ -38,7 +36,7 @@ class SeizureDAO:
                 seizures.append({
                     'id': row[0],
                     'person_id': row[1],
-                    'date': str(row[4]) + '-' + str(row[3]).zfill(2) + '-' + str(row[2]).zfill(2),
+                    'date': str(row[12]),
                     'time': t,
                     'duration': row[6],
                     'notes': row[7],
@@ -78,6 +76,7 @@ class SeizureDAO:
                 data.get('notes', 'NULL'),
                 session.get('user_id')
             ))
+            query_cache.invalidate_record(connection, 'crisi_epilettica', data['person_id'])
             connection.commit()
 
         except Exception as e:
@@ -103,7 +102,10 @@ class SeizureDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
+            owner = query_cache.record_owner(cursor, 'crisi_epilettica', seizure_id)
             cursor.execute(query, (seizure_id,))
+            if owner:
+                query_cache.invalidate_record(connection, 'crisi_epilettica', *owner)
             connection.commit()
 
         except Exception as e:
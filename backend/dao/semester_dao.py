@@ -2,12 +2,56 @@
 Data Access Object for semester management
 """
 
-from typing import List
+import json
+from typing import Callable, List, Optional
 
 from flask import session
+from config import partitioning
 from config.database import db_config
+from config.migrations import ROLLOVER_TABLE
+from config.partitioning import STAGING_SUFFIX
+from config.query_cache import query_cache
+from dao.appreciations_summary_dao import appreciations_summary_dao, SUMMARY_TABLE
 from info import mesi_ita
 
+ROLLOVER_RUNNING = 'running'
+ROLLOVER_DONE = 'done'
+ROLLOVER_FAILED = 'failed'
+ROLLOVER_LOCK = 'cdd_legrigne_cambio_semestre'
+ROLLOVER_CHUNK_ROWS = 2000
+
+def rollover_tables(progress: dict) -> dict:
+    """rows, done and percent moved of every table of a rollover's progress"""
+    tables = {}
+    for table_name, table in progress.items():
+        span = (table['mark'] or 0) - table['first'] + 1
+        done_share = 1 if table['done'] else (
+            (table['after'] - table['first'] + 1) / span if table['mark'] and span > 0 else 0
+        )
+        tables[table_name] = {'rows': table['rows'], 'done': table['done'],
+                              'percent': round(100 * min(1, max(0, done_share)), 1)}
+    return tables
+
+def rollover_percent(tables: dict) -> float:
+    return round(sum(t['percent'] for t in tables.values()) / len(tables), 1) if tables else 100
+
+def rollover_semester(cursor, table_name: str, row_id: int) -> Optional[int]:
+    """Semester a live row of table_name belongs to in riepilogo_gradimento, None if the live one.
+
+    begin_rollover moves the summary at once, while the rows up to its mark
+    keep id_semestre NULL until their chunk is moved: until then they
+    count towards the new semester.
+    """
+    cursor.execute(f"SELECT id_semestre, avanzamento FROM {ROLLOVER_TABLE} WHERE stato <> %s "
+                   "ORDER BY id DESC LIMIT 1", (ROLLOVER_DONE,))
+    unfinished = cursor.fetchone()
+    if unfinished is None:
+        return None
+    table = json.loads(unfinished[1]).get(table_name)
+    if table is None or table['done'] or table['mark'] is None or row_id > table['mark']:
+        return None
+    return unfinished[0]
+
 class SemesterDAO:
     """Data Access Object for semester management"""
     
@@ -46,13 +90,30 @@ class SemesterDAO:
                 connection.close()
                 
     def create_new_semester(self) -> None:
-        """Create a new semester"""
+        """Create a new semester, moving the live records to it before returning"""
+        self.run_rollover(self.begin_rollover())
+
+    def begin_rollover(self) -> int:
+        """Create a new semester and the checkpoint of its rollover, return the rollover id.
+
+        The records to move are those written so far: the highest id of every
+        table is recorded now, and what is written afterwards stays live.
+        The appreciations summary moves at once, since later activity entries
+        are added to the live semester's rows. If a rollover is still running
+        or has failed, its id is returned instead, to be resumed.
+        """
         connection = None
         cursor = None
         
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
+
+            cursor.execute(f"SELECT id FROM {ROLLOVER_TABLE} WHERE stato <> %s ORDER BY id DESC LIMIT 1",
+                           (ROLLOVER_DONE,))
+            unfinished = cursor.fetchone()
+            if unfinished:
+                return unfinished[0]
             
             # Optimized: Get first and last activity dates in separate but efficient queries
             cursor.execute("""
@@ -81,24 +142,176 @@ class SemesterDAO:
                           (start_date, end_date))
             semester_id = cursor.lastrowid
             
-            # Get all tables with id_semestre column (excluding views)
+            # Get all tables with id_semestre column (excluding views), and whether they have an id
             cursor.execute("""
-                SELECT table_name 
-                FROM information_schema.columns 
-                WHERE column_name = 'id_semestre' 
-                AND table_schema = DATABASE()
-                AND table_name != 'semestre' AND table_name != 'grad'
-            """)
+                SELECT c.table_name, EXISTS (
+                    SELECT 1 FROM information_schema.columns k
+                    WHERE k.table_schema = c.table_schema AND k.table_name = c.table_name
+                    AND k.column_name = 'id'
+                )
+                FROM information_schema.columns c
+                WHERE c.column_name = 'id_semestre' 
+                AND c.table_schema = DATABASE()
+                AND c.table_name NOT IN ('semestre', 'grad', %s, %s)
+                AND c.table_name NOT LIKE %s
+            """, (SUMMARY_TABLE, ROLLOVER_TABLE, '%' + STAGING_SUFFIX.replace('_', '\\_') + '%'))
             
             tables_with_semester = cursor.fetchall()
+            partitioned = partitioning.partitioned_tables(cursor)
             
-            # Update all related tables in batch
-            for table in tables_with_semester:
-                table_name = table[0]
-                cursor.execute(f"UPDATE `{table_name}` SET id_semestre = %s WHERE id_semestre IS NULL", 
-                              (semester_id,))
+            progress = {}
+            for table_name, has_id in tables_with_semester:
+                mark = None
+                first = 0
+                if has_id:
+                    cursor.execute(f"SELECT MIN(id), MAX(id) FROM `{table_name}`")
+                    first, mark = cursor.fetchone()
+                progress[table_name] = {
+                    'first': first or 0,
+                    'mark': (mark or 0) if has_id else None,
+                    'after': first - 1 if first else 0,
+                    'rows': 0,
+                    'partitioned': table_name in partitioned,
+                    'done': False,
+                }
+            appreciations_summary_dao.close_semester(cursor, semester_id)
+            cursor.execute(
+                f"INSERT INTO {ROLLOVER_TABLE} (id_semestre, stato, avanzamento) VALUES (%s, %s, %s)",
+                (semester_id, ROLLOVER_RUNNING, json.dumps(progress))
+            )
+            rollover_id = cursor.lastrowid
             
             connection.commit()
+            return rollover_id
+
+        except Exception as e:
+            if connection:
+                connection.rollback()
+            raise e
+
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def run_rollover(self, rollover_id: int, chunk_rows: int = ROLLOVER_CHUNK_ROWS,
+                     on_progress: Optional[Callable[[dict], None]] = None) -> bool:
+        """Move the records of a rollover to its semester, resuming from its checkpoint.
+
+        Rows are updated in primary key chunks, each committed together with
+        the checkpoint (then passed to on_progress), so the tables stay
+        writable and an interrupted rollover continues where it stopped.
+        Partitioned tables move their live partition instead
+        (config.partitioning). A named lock keeps a rollover to one worker;
+        returns False if another one holds it.
+        """
+        connection = None
+        cursor = None
+        locked = False
+        
+        try:
+            connection = db_config.get_dedicated_connection()
+            cursor = connection.cursor()
+            cursor.execute("SELECT GET_LOCK(%s, 0)", (ROLLOVER_LOCK,))
+            locked = cursor.fetchone()[0] == 1
+            if not locked:
+                return False
+
+            cursor.execute(f"SELECT id_semestre, stato, avanzamento FROM {ROLLOVER_TABLE} WHERE id = %s",
+                           (rollover_id,))
+            semester_id, state, progress = cursor.fetchone()
+            if state == ROLLOVER_DONE:
+                return True
+            progress = json.loads(progress)
+            if state == ROLLOVER_FAILED:
+                cursor.execute(f"UPDATE {ROLLOVER_TABLE} SET stato = %s, errore = NULL WHERE id = %s",
+                               (ROLLOVER_RUNNING, rollover_id))
+                connection.commit()
+
+            def checkpoint():
+                cursor.execute(f"UPDATE {ROLLOVER_TABLE} SET avanzamento = %s WHERE id = %s",
+                               (json.dumps(progress), rollover_id))
+                connection.commit()
+                # Every guest's live rows and the new semester's changed
+                query_cache.invalidate_all()
+                if on_progress:
+                    on_progress(progress)
+
+            for table_name, table in progress.items():
+                if table['done']:
+                    continue
+                if table['partitioned']:
+                    table['rows'] = partitioning.roll_over(connection, table_name, semester_id, table['mark'])
+                elif table['mark'] is None:
+                    cursor.execute(f"UPDATE `{table_name}` SET id_semestre = %s WHERE id_semestre IS NULL",
+                                   (semester_id,))
+                    table['rows'] = cursor.rowcount
+                else:
+                    while table['after'] < table['mark']:
+                        end = min(table['after'] + chunk_rows, table['mark'])
+                        cursor.execute(
+                            f"UPDATE `{table_name}` SET id_semestre = %s "
+                            f"WHERE id > %s AND id <= %s AND id_semestre IS NULL",
+                            (semester_id, table['after'], end)
+                        )
+                        table['rows'] += cursor.rowcount
+                        table['after'] = end
+                        checkpoint()
+                table['done'] = True
+                checkpoint()
+
+            cursor.execute(f"UPDATE {ROLLOVER_TABLE} SET stato = %s, finito_il = NOW() WHERE id = %s",
+                           (ROLLOVER_DONE, rollover_id))
+            connection.commit()
+            return True
+
+        except Exception as e:
+            if connection:
+                connection.rollback()
+                if locked:
+                    cursor.execute(f"UPDATE {ROLLOVER_TABLE} SET stato = %s, errore = %s WHERE id = %s",
+                                   (ROLLOVER_FAILED, str(e), rollover_id))
+                    connection.commit()
+            raise e
+
+        finally:
+            if cursor:
+                if locked:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (ROLLOVER_LOCK,))
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def get_rollover(self) -> Optional[dict]:
+        """State and progress of the latest rollover, None if there never was one"""
+        connection = None
+        cursor = None
+
+        try:
+            connection = db_config.get_connection()
+            cursor = connection.cursor()
+            cursor.execute(f"""
+                SELECT id, id_semestre, stato, avanzamento, errore, iniziato_il, finito_il, IS_USED_LOCK(%s)
+                FROM {ROLLOVER_TABLE} ORDER BY id DESC LIMIT 1
+            """, (ROLLOVER_LOCK,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+
+            tables = rollover_tables(json.loads(row[3]))
+            return {
+                'id': row[0],
+                'semester_id': row[1],
+                'state': row[2],
+                'error': row[4],
+                'started_at': str(row[5]),
+                'finished_at': str(row[6]) if row[6] else None,
+                # A running rollover nobody works on was interrupted and can be resumed
+                'active': row[7] is not None,
+                'percent': rollover_percent(tables),
+                'tables': tables,
+            }
 
         except Exception as e:
             if connection:
@@ -5,17 +5,18 @@ Data Access Object for Shower
 from typing import List
 from flask import session
 from config.database import db_config
+from config.query_cache import query_cache, record_tag
+from dao.appreciations_summary_dao import semester_key
 
 class ShowerDAO:
     """Data Access Object for Shower"""
     
     def get_shower_entries(self, person_id: int) -> List[dict]:
-        semester_constraint = " = %s" if session.get('semester') is not None else " IS NULL"
-        query = f"""
-            SELECT doccia.*, account.nome, account.cognome FROM doccia
+        query = """
+            SELECT doccia.*, account.nome, account.cognome, doccia.data FROM doccia
             JOIN account ON doccia.firma = account.id
-            WHERE id_persona = %s AND id_semestre {semester_constraint}
-            ORDER BY anno DESC, mese_int DESC, giorno DESC
+            WHERE id_persona = %s AND semestre_chiave = %s
+            ORDER BY doccia.data DESC
         """
         
         connection = None
@@ -24,18 +25,15 @@ class ShowerDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
-            if session.get('semester') is not None:
-                cursor.execute(query, (person_id, session.get('semester')))
-            else:
-                cursor.execute(query, (person_id,))
-            results = cursor.fetchall()
+            key = semester_key(session.get('semester'))
+            results = query_cache.fetchall(cursor, query, (person_id, key), [record_tag('doccia', person_id, key)])
 
             toilet_entries = []
             for row in results:
                 toilet_entries.append({
                     'id': row[0],
                     'person_id': row[1],
-                    'date': str(row[4]) + '-' + str(row[3]).zfill(2) + '-' + str(row[2]).zfill(2),
+                    'date': str(row[11]),
                     'done': row[5],
                     'notes': row[6],
                     'signature': f"{row[9]} {row[10]}"
@@ -78,6 +76,7 @@ class ShowerDAO:
                 data.get('notes', 'NULL'),
                 session.get('user_id')
             ))
+            query_cache.invalidate_record(connection, 'doccia', data['person_id'])
             connection.commit()
 
         except Exception as e:
@@ -100,7 +99,10 @@ class ShowerDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
+            owner = query_cache.record_owner(cursor, 'doccia', entry_id)
             cursor.execute(query, (entry_id,))
+            if owner:
+                query_cache.invalidate_record(connection, 'doccia', *owner)
             connection.commit()
 
         except Exception as e:
@@ -5,18 +5,19 @@ Data Access Object for Targeted activities
 from typing import List
 from flask import session
 from config.database import db_config
+from config.query_cache import query_cache, record_tag
+from dao.appreciations_summary_dao import semester_key
 
 class TargetDAO:
     """Data Access Object for Targeted activities"""
     
     def get_target_entries(self, person_id: int) -> List[dict]:
         """Get target entries for a specific person"""
-        semester_constraint = " = %s" if session.get('semester') is not None else " IS NULL"
-        query = f"""
-            SELECT attivita_mirata.*, account.nome, account.cognome FROM attivita_mirata
+        query = """
+            SELECT attivita_mirata.*, account.nome, account.cognome, attivita_mirata.data FROM attivita_mirata
             JOIN account ON attivita_mirata.firma = account.id
-            WHERE id_persona = %s AND id_semestre {semester_constraint}
-            ORDER BY anno DESC, mese_int DESC, giorno DESC
+            WHERE id_persona = %s AND semestre_chiave = %s
+            ORDER BY attivita_mirata.data DESC
         """
         
         connection = None
@@ -25,18 +26,15 @@ class TargetDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
-            if session.get('semester') is not None:
-                cursor.execute(query, (person_id, session.get('semester')))
-            else:
-                cursor.execute(query, (person_id,))
-            results = cursor.fetchall()
+            key = semester_key(session.get('semester'))
+            results = query_cache.fetchall(cursor, query, (person_id, key), [record_tag('attivita_mirata', person_id, key)])
             
             target_entries = []
             for row in results:
                 target_entries.append({
                     'id': row[0],
                     'person_id': row[1],
-                    'date': str(row[4]) + '-' + str(row[3]).zfill(2) + '-' + str(row[2]).zfill(2),
+                    'date': str(row[11]),
                     'event': row[5],
                     'intervention': row[6],
                     'signature': f"{row[9]} {row[10]}",
@@ -77,6 +75,7 @@ class TargetDAO:
                 data['intervention'],
                 session.get('user_id')
             ))
+            query_cache.invalidate_record(connection, 'attivita_mirata', data['person_id'])
             connection.commit()
 
         except Exception as e:
@@ -100,7 +99,10 @@ class TargetDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
+            owner = query_cache.record_owner(cursor, 'attivita_mirata', id)
             cursor.execute(query, (id,))
+            if owner:
+                query_cache.invalidate_record(connection, 'attivita_mirata', *owner)
             connection.commit()
 
         except Exception as e:
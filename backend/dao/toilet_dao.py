@@ -5,18 +5,19 @@ Data Access Object for Toilet
 from typing import List
 from flask import session
 from config.database import db_config
+from config.query_cache import query_cache, record_tag
+from dao.appreciations_summary_dao import semester_key
 
 class ToiletDAO:
     """Data Access Object for Toilet"""
     
     def get_toilet_entries(self, person_id: int) -> List[dict]:
         """Get toilet entries for a specific person"""
-        semester_constraint = " = %s" if session.get('semester') is not None else " IS NULL"
-        query = f"""
-            SELECT bagno.*, account.nome, account.cognome FROM bagno
+        query = """
+            SELECT bagno.*, account.nome, account.cognome, bagno.data FROM bagno
             JOIN account ON bagno.firma = account.id
-            WHERE id_persona = %s AND id_semestre {semester_constraint}
-            ORDER BY anno DESC, mese_int DESC, giorno DESC, mattino ASC
+            WHERE id_persona = %s AND semestre_chiave = %s
+            ORDER BY bagno.data DESC, mattino ASC
         """
         
         connection = None
@@ -25,18 +26,15 @@ class ToiletDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
-            if session.get('semester') is not None:
-                cursor.execute(query, (person_id, session.get('semester')))
-            else:
-                cursor.execute(query, (person_id,))
-            results = cursor.fetchall()
+            key = semester_key(session.get('semester'))
+            results = query_cache.fetchall(cursor, query, (person_id, key), [record_tag('bagno', person_id, key)])
 
             toilet_entries = []
             for row in results:
                 toilet_entries.append({
                     'id': row[0],
                     'person_id': row[1],
-                    'date': str(row[4]) + '-' + str(row[3]).zfill(2) + '-' + str(row[2]).zfill(2),
+                    'date': str(row[16]),
                     'morning': row[5],
                     'urine': row[6],
                     'feces': row[7],
@@ -92,6 +90,7 @@ class ToiletDAO:
                 redbess, period, belt,
                 session.get('user_id')
             ))
+            query_cache.invalidate_record(connection, 'bagno', data['person_id'])
             connection.commit()
 
         except Exception as e:
@@ -117,7 +116,10 @@ class ToiletDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
+            owner = query_cache.record_owner(cursor, 'bagno', entry_id)
             cursor.execute(query, (entry_id,))
+            if owner:
+                query_cache.invalidate_record(connection, 'bagno', *owner)
             connection.commit()
 
         except Exception as e:
@@ -2,19 +2,23 @@
 Data Access Object for vital parameters
 """
 
-from typing import List
+from typing import Dict, List
+
+import numpy as np
 from flask import session
 from config.database import db_config
+from config.query_cache import query_cache, record_tag
+from dao.appreciations_summary_dao import semester_key
+from charts.series import rows_to_columns, with_epoch_days
 
 class VitalDAO:
     """Data Access Object for vital parameters"""
     
     def get_vital_measurements(self, person_id: int) -> List[dict]:
-        semester_constraint = " = %s" if session.get('semester') is not None else " IS NULL"
-        query = f"""
-            SELECT * FROM pressione
-            WHERE id_persona = %s AND id_semestre {semester_constraint}
-            ORDER BY anno DESC, mese_int DESC, giorno DESC
+        query = """
+            SELECT pressione.*, data FROM pressione
+            WHERE id_persona = %s AND semestre_chiave = %s
+            ORDER BY data DESC
         """
         
         connection = None
@@ -23,18 +27,15 @@ class VitalDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
-            if session.get('semester') is not None:
-                cursor.execute(query, (person_id, session.get('semester')))
-            else:
-                cursor.execute(query, (person_id,))
-            results = cursor.fetchall()
+            key = semester_key(session.get('semester'))
+            results = query_cache.fetchall(cursor, query, (person_id, key), [record_tag('pressione', person_id, key)])
 
             vital_measurements = []
             for row in results:
                 vital_measurements.append({
                     'id': row[0],
                     'person_id': row[1],
-                    'date': str(row[4]) + '-' + str(row[3]).zfill(2) + '-' + str(row[2]).zfill(2),
+                    'date': str(row[-1]),  # data, after the table's own columns
                     'min_pressure': row[5],
                     'max_pressure': row[6],
                     'temperature': row[7],
@@ -55,6 +56,41 @@ class VitalDAO:
             if connection:
                 connection.close()
 
+    def get_vital_series(self, person_id: int) -> Dict[str, np.ndarray]:
+        """Get blood pressure measurements as chronological columns (date, min/max pressure)"""
+        query = """
+            SELECT * FROM pressione
+            WHERE id_persona = %s AND semestre_chiave = %s
+            ORDER BY data
+        """
+        
+        connection = None
+        cursor = None
+        
+        try:
+            connection = db_config.get_connection()
+            cursor = connection.cursor()
+            key = semester_key(session.get('semester'))
+            rows = query_cache.fetchall(cursor, query, (person_id, key), [record_tag('pressione', person_id, key)])
+            return with_epoch_days(rows_to_columns(rows, {
+                'year': (4, 'int16'),
+                'month': (3, 'int8'),
+                'day': (2, 'int8'),
+                'min_pressure': (5, 'float32'),
+                'max_pressure': (6, 'float32'),
+            }))
+
+        except Exception as e:
+            if connection:
+                connection.rollback()
+            raise e
+
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
     def create_vital_entry(self, data: dict) -> None:
         """Create a new vital entry"""
         query = """
@@ -79,6 +115,7 @@ class VitalDAO:
                 data['heart_rate'],
                 data['saturation']
             ))
+            query_cache.invalidate_record(connection, 'pressione', data['person_id'])
             connection.commit()
 
         except Exception as e:
@@ -101,7 +138,10 @@ class VitalDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
+            owner = query_cache.record_owner(cursor, 'pressione', entry_id)
             cursor.execute(query, (entry_id,))
+            if owner:
+                query_cache.invalidate_record(connection, 'pressione', *owner)
             connection.commit()
 
         except Exception as e:
@@ -2,19 +2,23 @@
 Data Access Object for Weight
 """
 
-from typing import List
+from typing import Dict, List
+
+import numpy as np
 from flask import session
 from config.database import db_config
+from config.query_cache import query_cache, record_tag
+from dao.appreciations_summary_dao import semester_key
+from charts.series import rows_to_columns, with_epoch_days
 
 class WeightDAO:
     """Data Access Object for Weight"""
     
     def get_weight_measurements(self, person_id: int) -> List[dict]:
-        semester_constraint = " = %s" if session.get('semester') is not None else " IS NULL"
-        query = f"""
-            SELECT * FROM peso
-            WHERE id_persona = %s AND id_semestre {semester_constraint}
-            ORDER BY anno DESC, mese_int DESC, giorno DESC
+        query = """
+            SELECT peso.*, data FROM peso
+            WHERE id_persona = %s AND semestre_chiave = %s
+            ORDER BY data DESC
         """
         
         connection = None
@@ -23,18 +27,15 @@ class WeightDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
-            if session.get('semester') is not None:
-                cursor.execute(query, (person_id, session.get('semester')))
-            else:
-                cursor.execute(query, (person_id,))
-            results = cursor.fetchall()
+            key = semester_key(session.get('semester'))
+            results = query_cache.fetchall(cursor, query, (person_id, key), [record_tag('peso', person_id, key)])
 
             weight_measurements = []
             for row in results:
                 weight_measurements.append({
                     'id': row[0],
                     'person_id': row[1],
-                    'date': str(row[4]) + '-' + str(row[3]).zfill(2) + '-' + str(row[2]).zfill(2),
+                    'date': str(row[-1]),  # data, after the table's own columns
                     'weight': row[5]
                 })
             return weight_measurements
@@ -51,6 +52,40 @@ class WeightDAO:
             if connection:
                 connection.close()
 
+    def get_weight_series(self, person_id: int) -> Dict[str, np.ndarray]:
+        """Get weight measurements as chronological columns (date, weight)"""
+        query = """
+            SELECT * FROM peso
+            WHERE id_persona = %s AND semestre_chiave = %s
+            ORDER BY data
+        """
+        
+        connection = None
+        cursor = None
+        
+        try:
+            connection = db_config.get_connection()
+            cursor = connection.cursor()
+            key = semester_key(session.get('semester'))
+            rows = query_cache.fetchall(cursor, query, (person_id, key), [record_tag('peso', person_id, key)])
+            return with_epoch_days(rows_to_columns(rows, {
+                'year': (4, 'int16'),
+                'month': (3, 'int8'),
+                'day': (2, 'int8'),
+                'weight': (5, 'float32'),
+            }))
+
+        except Exception as e:
+            if connection:
+                connection.rollback()
+            raise e
+
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
     def create_weight_entry(self, data: dict) -> None:
         """Create a new weight entry"""
         query = """
@@ -71,6 +106,7 @@ class WeightDAO:
                 int(date[0]),  # year
                 data['value']
             ))
+            query_cache.invalidate_record(connection, 'peso', data['person_id'])
             connection.commit()
 
         except Exception as e:
@@ -93,7 +129,10 @@ class WeightDAO:
         try:
             connection = db_config.get_connection()
             cursor = connection.cursor()
+            owner = query_cache.record_owner(cursor, 'peso', entry_id)
             cursor.execute(query, (entry_id,))
+            if owner:
+                query_cache.invalidate_record(connection, 'peso', *owner)
             connection.commit()
 
         except Exception as e:
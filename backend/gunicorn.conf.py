@@ -8,7 +8,10 @@ backlog = 2048
 
 # Worker processes
 workers = 4
-worker_class = "sync"
+# Threads, so that an open graph stream (/appreciations/stream) takes one thread
+# rather than a whole worker; request state lives in flask.g and the pool is shared
+worker_class = "gthread"
+threads = 4
 worker_connections = 1000
 timeout = 30
 keepalive = 2
@@ -32,6 +35,12 @@ user = 'elia'
 group = 'elia'
 tmp_upload_dir = None
 
+# Server hooks
+def post_fork(server, worker):
+    """Make sure a worker never reuses database connections opened by the master"""
+    from config.database import db_config
+    db_config.reset_pool()
+
 # SSL (if needed)
 # keyfile = "/path/to/keyfile"
 # certfile = "/path/to/certfile"
@@ -21,7 +21,14 @@ from servlets.target_servlet import target_bp
 from servlets.seizure_servlet import seizures_bp
 from servlets.weight_servlet import weight_bp
 from servlets.vital_servlet import vital_bp
+from servlets.stats_servlet import stats_bp
+from servlets.jobs_servlet import jobs_bp
 from config.database import db_config
+from config.unit_of_work import init_unit_of_work
+from config.request_timing import init_request_timing
+from config.metrics import init_metrics
+from charts.plot_cache import plot_cache
+from config.query_cache import query_cache
 
 def create_app():
     """Application factory pattern"""
@@ -37,6 +44,15 @@ def create_app():
         "http://192.168.1.*"  # Allow any device in the same subnet
     ])
     
+    # Server-Timing header and access log; first, so its total covers the other hooks
+    init_request_timing(app)
+    
+    # Prometheus request metrics, served by /metrics
+    init_metrics(app)
+    
+    # One connection and one transaction per request
+    init_unit_of_work(app)
+    
     # Register blueprints (servlets)
     app.register_blueprint(account_bp)
     app.register_blueprint(home_bp)
@@ -52,6 +68,8 @@ def create_app():
     app.register_blueprint(seizures_bp)
     app.register_blueprint(weight_bp)
     app.register_blueprint(vital_bp)
+    app.register_blueprint(stats_bp)
+    app.register_blueprint(jobs_bp)
 
     @app.route('/ping')
     def ping():
@@ -68,7 +86,14 @@ def create_app():
             if not sess:
                 return {"status": "error", "message": "Invalid session"}, 500
 
-            return {"status": "ok", "database_time": str(db_time), "session": sess}, 200
+            return {
+                "status": "ok",
+                "database_time": str(db_time),
+                "session": sess,
+                "pool": db_config.pool_stats(),
+                "plot_cache": plot_cache.stats(),
+                "query_cache": query_cache.stats()
+            }, 200
         except Exception as e:
             return {"status": "error", "message": str(e)}, 500
     
@@ -2,10 +2,11 @@
 Account servlet for handling user account operations: login, logout, password reset, etc.
 """
 
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, Response, request, jsonify, send_file, session, url_for
 from config.check_session import check_session
 import hashlib
-import datetime
+from config.backup import Backup
+from config.restore import Restore
 from dao.account_dao import account_dao
 
 account_bp = Blueprint('account', __name__)
@@ -152,16 +153,119 @@ def backup_database():
         return jsonify({'error': 'Missing required fields'}), 400
 
     password_sha256 = hashlib.sha256(password.encode('utf-8')).hexdigest()
+    # 'archive': a tar of a parallel per-table dump instead of a single .sql.gz
+    engine = 'archive' if data.get('format') == 'archive' else None
 
     try:
-        sql_backup = account_dao.backup_database(password_sha256)
-        if sql_backup:
+        backup = account_dao.backup_database(password_sha256, engine)
+        if backup:
             return jsonify({
-                'message': 'Database backup successful', 
-                'sql': sql_backup,
-                'filename': f'cdd_legrigne_backup_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.sql'
+                'message': 'Database backup ready',
+                'backup_id': backup.id,
+                'engine': backup.meta['engine'],
+                'filename': backup.meta['filename'],
+                'download_url': url_for('account.download_backup', backup_id=backup.id),
+                'job_id': backup.meta['job_id']
             }), 200
         else:
             return jsonify({'error': 'Invalid password'}), 401
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+def find_backup(backup_id):
+    """The backup with this id if it belongs to the logged in user"""
+    backup = Backup.open(backup_id)
+    if backup is None or backup.meta['owner'] != session.get('user_id'):
+        return None
+    return backup
+
+@account_bp.route('/backup_database/<backup_id>', methods=['GET'])
+def download_backup(backup_id):
+    """Download a backup as gzip-compressed SQL; ?offset=N resumes an interrupted download"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    backup = find_backup(backup_id)
+    if backup is None:
+        return jsonify({'error': 'Backup not found'}), 404
+
+    offset = request.args.get('offset', type=int, default=0)
+    status = backup.status()
+    if offset < 0 or offset > status['size']:
+        return jsonify({'error': 'Invalid offset'}), 416
+
+    # Finished backups are plain files: let send_file answer Range requests too
+    # (not Content-Encoding: gzip, clients would inflate it and lose the byte offsets)
+    if status['complete'] and 'offset' not in request.args:
+        return send_file(backup.spool_path, mimetype=backup.mimetype, as_attachment=True,
+                         download_name=status['filename'], conditional=True)
+
+    response = Response(backup.stream(offset), mimetype=backup.mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={status["filename"]}'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@account_bp.route('/backup_database/<backup_id>/status', methods=['GET'])
+def backup_status(backup_id):
+    """How many bytes of a backup exist and whether it is complete"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    backup = find_backup(backup_id)
+    if backup is None:
+        return jsonify({'error': 'Backup not found'}), 404
+
+    try:
+        return jsonify(backup.status()), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@account_bp.route('/restore_database', methods=['POST'])
+def restore_database():
+    """Restore the database from an uploaded backup (archive .tar or .sql/.sql.gz dump)"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    if session.get('permissions', 0) < 10:
+        return jsonify({'error': 'Insufficient permissions'}), 403
+
+    password = request.form.get('password')
+    upload = request.files.get('backup')
+
+    if not password or not upload:
+        return jsonify({'error': 'Missing required fields'}), 400
+
+    password_sha256 = hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+    try:
+        restore = account_dao.restore_database(password_sha256, upload)
+        if restore:
+            return jsonify({
+                'message': 'Database restore started',
+                'restore_id': restore.id,
+                'status_url': url_for('account.restore_status', restore_id=restore.id),
+                'job_id': restore.status()['job_id']
+            }), 202
+        else:
+            return jsonify({'error': 'Invalid password'}), 401
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@account_bp.route('/restore_database/<restore_id>', methods=['GET'])
+def restore_status(restore_id):
+    """Progress of a restore, and its report (rows, rows/s, phases) once complete"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    restore = Restore.open(restore_id)
+    if restore is None:
+        return jsonify({'error': 'Restore not found'}), 404
+
+    try:
+        status = restore.status()
+        if status['owner'] != session.get('user_id'):
+            return jsonify({'error': 'Restore not found'}), 404
+        return jsonify(status), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
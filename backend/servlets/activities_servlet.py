@@ -4,18 +4,44 @@ Activities servlet, responsible for handling requests related to partecipazione_
 
 from flask import Blueprint, request, jsonify, session
 from config.check_session import check_session
+from charts.downsample import downsample_columns, downsample_points
+from charts.series import series_payload, wants_series
+from charts.rendering import render_activities
+from charts.responses import Chart, plot_url, png_response, wants_embedded_plot
 from dao.activities_dao import activities_dao
 from datetime import datetime, timedelta
-import io
-import base64
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-
-matplotlib.use('Agg')
 
 activities_bp = Blueprint('activities', __name__)
 
+def build_activities_chart(activities) -> Chart:
+    """ Extract the plotted series from activity entries """
+    dates = []
+    moods = []
+    communications = []
+
+    for activity in activities:
+        try:
+            date_obj = datetime.strptime(activity['date'], '%Y-%m-%d')
+            # If your activity dict has a boolean or flag for morning
+            if not activity.get('morning', True):
+                # Shift afternoon by 12 hours
+                date_obj += timedelta(hours=12)
+            if activity['mood'] is None or activity['communication'] is None:
+                continue
+            dates.append(date_obj)
+            moods.append(activity['mood'])
+            communications.append(activity['communication'])
+        except (ValueError, KeyError):
+            continue
+
+    dates, moods, communications = downsample_points(dates, moods, communications)
+
+    return Chart(
+        'activities',
+        {'dates': dates, 'moods': moods, 'communications': communications},
+        lambda: render_activities(dates, moods, communications)
+    )
+
 @activities_bp.route('/activities', methods=['GET'])
 def get_activities():
     """ Get activities for a specific person """
@@ -30,69 +56,45 @@ def get_activities():
     
     try:
 
-        activities = activities_dao.get_activities(person_id, month=month)
-        
-        # Extract dates and values for plotting
-        dates = []
-        moods = []
-        communications = []
-
-        for activity in activities:
-            try:
-                date_obj = datetime.strptime(activity['date'], '%Y-%m-%d')
-                # If your activity dict has a boolean or flag for morning
-                if not activity.get('morning', True):
-                    # Shift afternoon by 12 hours
-                    date_obj += timedelta(hours=12)
-                if activity['mood'] is None or activity['communication'] is None:
-                    continue
-                dates.append(date_obj)
-                moods.append(activity['mood'])
-                communications.append(activity['communication'])
-            except (ValueError, KeyError):
-                continue
+        if wants_series():
+            columns = activities_dao.get_activity_series(person_id, month=month)
+            downsampled = downsample_columns(columns, y=('mood', 'communication'))
+            return jsonify(series_payload(downsampled, source_length=len(columns['date']))), 200
 
-        # Create the plot
-        plt.figure(figsize=(10, 6))
-        plt.plot(dates, moods, marker='o', label='Umore', linewidth=2, color='#005073')
-        plt.plot(dates, communications, marker='s', label='Comunicazione', linewidth=2, color='#60A5FA')
-
-        plt.xlabel('Data')
-        plt.ylabel('Indice')
-        # plt.title(f'Adesione e partecipazione')
-        plt.legend()
-        plt.grid(True, alpha=0.3)
-        plt.gca().yaxis.set_major_locator(plt.MaxNLocator(integer=True))
-        plt.ylim(0.5, 8.5)
-        
-        # # Set transparent background
-        # plt.gca().patch.set_alpha(0.5)
-        # plt.gcf().patch.set_alpha(0.5)
-
-        # Format x-axis dates
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-        # plt.gca().xaxis.set_major_locator(mdates.MonthLocator())
-        plt.xticks(rotation=45)
-
-        plt.tight_layout()
-
-        # Convert plot to base64 string
-        img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='png')
-        img_buffer.seek(0)
-        plot_image = base64.b64encode(img_buffer.getvalue()).decode()
-        plt.close()
+        activities = activities_dao.get_activities(person_id, month=month)
+        chart = build_activities_chart(activities)
 
         # Add plot to response
         activities_response = {
             'activities': activities,
-            'plot_image': plot_image
+            'plot_url': plot_url('activities.get_activities_plot', chart, person_id=person_id, month=month)
         }
+        if wants_embedded_plot():
+            activities_response['plot_image'] = chart.base64()
 
         return jsonify(activities_response), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+
+@activities_bp.route('/activities/plot.png', methods=['GET'])
+def get_activities_plot():
+    """ Get the mood/communication chart of a specific person as a PNG image """
+    person_id = request.args.get('person_id', type=int)
+    month = request.args.get('month', type=int, default=None)
+
+    if check_session() is False:
+        return jsonify({'error': 'Unauthorized access'}), 401
+    
+    if not person_id:
+        return jsonify({'error': 'Missing or invalid person_id'}), 400
+    
+    try:
+        activities = activities_dao.get_activities(person_id, month=month)
+        return png_response(build_activities_chart(activities))
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
     
 @activities_bp.route('/new_activity_entry', methods=['POST'])
 def create_activity_entry():
@@ -2,218 +2,361 @@
 Appreciations Servlet, responsible for handling appreciation-related requests.
 """
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, session
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from config.check_session import check_session
+from config.jobs import JOB_CANCELLED, JOB_FAILED, PROGRESS_INTERVAL, enqueue, get_job, job_kind
+from config.metrics import metrics
+from charts.series import series_payload, wants_series
+from charts.plot_cache import plot_cache
+from charts.rendering import render_appreciation
 from dao.activities_dao import activities_dao
 from datetime import datetime
-import io
 import base64
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 from info import mesi_ita
 import uuid
 import json
 import os
+import shutil
 import tempfile
 import time
 
-matplotlib.use('Agg')
-
-appreciations_bp = Blueprint('appreciations', __name__)
-
 appreciations_bp = Blueprint('appreciations', __name__)
 
-# Use file-based session storage for multi-worker compatibility
+# Use file-based session storage for multi-worker compatibility: each session is a
+# directory holding a small manifest plus one file per finished graph, so any
+# gunicorn worker can serve any session without rewriting the rendered graphs
 SESSIONS_DIR = os.path.join(tempfile.gettempdir(), 'appreciations_sessions')
+SESSION_MAX_AGE = 3600  # seconds
 
-def ensure_sessions_dir():
-    """Ensure the sessions directory exists"""
-    if not os.path.exists(SESSIONS_DIR):
-        os.makedirs(SESSIONS_DIR, exist_ok=True)
+# Graphs are rendered by an 'appreciation_graphs' job in the job worker,
+# through a bounded process pool there, one task per person
+GRAPH_WORKERS = os.cpu_count() or 1
+GRAPH_POLL_INTERVAL = 0.1  # seconds between checks for a newly finished graph
+# The stream holds one of the gthread worker's threads (gunicorn.conf.py), not the worker
+STREAM_MAX_DURATION = 25   # stay below nginx's proxy_read_timeout; EventSource reconnects
+NEXT_GRAPH_MAX_WAIT = 1    # the polling fallback keeps its requests short: the client asks again
+JOB_CHECK_INTERVAL = 1     # seconds between checks of the graph job while the stream waits
 
-def get_session_file_path(session_id):
-    """Get the file path for a session"""
-    return os.path.join(SESSIONS_DIR, f"{session_id}.json")
+_graph_executor = None
+_graph_executor_pid = None
 
-def save_session_data(session_id, data):
-    """Save session data to file"""
-    ensure_sessions_dir()
-    file_path = get_session_file_path(session_id)
+def get_graph_executor() -> ProcessPoolExecutor:
+    """Get this process's graph process pool, creating it after a fork"""
+    global _graph_executor, _graph_executor_pid
+    if _graph_executor is None or _graph_executor_pid != os.getpid():
+        _graph_executor = ProcessPoolExecutor(max_workers=GRAPH_WORKERS)
+        _graph_executor_pid = os.getpid()
+    return _graph_executor
+
+def get_session_dir(session_id):
+    """Get the directory of a session, None if the id is not a valid session id"""
     try:
-        with open(file_path, 'w') as f:
-            json.dump(data, f)
-    except Exception as e:
-        print(f"Error saving session data: {e}")
+        return os.path.join(SESSIONS_DIR, str(uuid.UUID(session_id)))
+    except ValueError:
+        return None
 
-def load_session_data(session_id):
-    """Load session data from file"""
-    file_path = get_session_file_path(session_id)
-    if not os.path.exists(file_path):
+def write_file_atomic(path, content):
+    """Write a text file so that readers never see it half written"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def save_manifest(session_dir, manifest):
+    """Create the session directory and its manifest"""
+    os.makedirs(session_dir, exist_ok=True)
+    write_file_atomic(os.path.join(session_dir, 'manifest.json'), json.dumps(manifest))
+
+def load_manifest(session_dir):
+    """Load a session manifest, None if the session does not exist"""
+    if session_dir is None:
         return None
     try:
-        with open(file_path, 'r') as f:
+        with open(os.path.join(session_dir, 'manifest.json'), 'r') as f:
             return json.load(f)
+    except FileNotFoundError:
+        return None
     except Exception as e:
         print(f"Error loading session data: {e}")
         return None
 
-def delete_session_data(session_id):
-    """Delete session data file"""
-    file_path = get_session_file_path(session_id)
+def read_graph(session_dir, person_id):
+    """Return (finished, graph_base64) for a person; graph is None if rendering failed"""
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-    except Exception as e:
-        print(f"Error deleting session data: {e}")
+        with open(os.path.join(session_dir, f"{person_id}.b64"), 'r') as f:
+            return True, f.read()
+    except FileNotFoundError:
+        return os.path.exists(os.path.join(session_dir, f"{person_id}.failed")), None
+
+def mark_failed(session_dir, person_id):
+    """Record that a person's graph will not be rendered, unless it already has a result"""
+    if not read_graph(session_dir, person_id)[0]:
+        write_file_atomic(os.path.join(session_dir, f"{person_id}.failed"), '')
+
+def graph_job_failure(manifest):
+    """Why the session's graph job stopped for good, None while it is queued, running or done"""
+    job = get_job(manifest['job_id']) if manifest.get('job_id') else None
+    if job is not None and job['state'] in (JOB_FAILED, JOB_CANCELLED):
+        return f"Graph rendering {job['state']}" + (f": {job['error']}" if job['error'] else '')
+    return None
+
+def read_next_index(session_dir):
+    try:
+        with open(os.path.join(session_dir, 'next_index'), 'r') as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def delete_session_data(session_dir):
+    """Delete a session directory"""
+    shutil.rmtree(session_dir, ignore_errors=True)
 
 def cleanup_old_sessions():
-    """Clean up old session files to prevent disk space issues"""
-    ensure_sessions_dir()
+    """Clean up old session directories to prevent disk space issues"""
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
     try:
         current_time = time.time()
-        for filename in os.listdir(SESSIONS_DIR):
-            if filename.endswith('.json'):
-                file_path = os.path.join(SESSIONS_DIR, filename)
-                # Remove files older than 1 hour
-                if current_time - os.path.getmtime(file_path) > 3600:
-                    os.remove(file_path)
+        for entry in os.scandir(SESSIONS_DIR):
+            if current_time - entry.stat().st_mtime > SESSION_MAX_AGE:
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
     except Exception as e:
         print(f"Error cleaning up old sessions: {e}")
 
 def generate_graph(person, month):
     """Generate graph for a person and return the base64 encoded image"""
     try:
-        plt.figure(figsize=(10, 6))
         x_labels = [activity['abbreviazione'] for activity in person['activities']]
         adesione_values = [activity['media_adesione'] for activity in person['activities']]
         partecipazione_values = [activity['media_partecipazione'] for activity in person['activities']]
-        
-        x = range(len(x_labels))
-        width = 0.35
-        
-        plt.bar([i - width/2 for i in x], adesione_values, width, label='Adesione', color='#005073')
-        plt.bar([i + width/2 for i in x], partecipazione_values, width, label='Partecipazione', color='#60A5FA')
-        plt.xticks(x, x_labels)
-        
-        plt.xlabel('Attività')
-        plt.ylabel('%')
         if month is not None:
             month_name = mesi_ita[int(month) - 1]
-            plt.title(f'Gradimenti attività per {person["nome"]} {person["cognome"]} - {month_name}')
+            title = f'Gradimenti attività per {person["nome"]} {person["cognome"]} - {month_name}'
         else:
-            plt.title(f'Gradimenti attività per {person["nome"]} {person["cognome"]}')
-        plt.legend()
-        plt.grid(True, alpha=0.3)
-        plt.gca().yaxis.set_major_locator(plt.MaxNLocator(integer=True))
-        plt.ylim(0, 104)
-        
-        plt.tight_layout()
-        img_buf = io.BytesIO()
-        plt.savefig(img_buf, format='png')
-        img_buf.seek(0)
-        img_base64 = base64.b64encode(img_buf.getvalue()).decode()
-        plt.close()
+            title = f'Gradimenti attività per {person["nome"]} {person["cognome"]}'
         
-        return img_base64
+        _, png = plot_cache.get_or_render(
+            'appreciation',
+            {'labels': x_labels, 'adesione': adesione_values, 'partecipazione': partecipazione_values, 'title': title},
+            lambda: render_appreciation(x_labels, adesione_values, partecipazione_values, title)
+        )
+        return base64.b64encode(png).decode()
         
     except Exception as e:
         print(f"Error generating graph for person {person['id_persona']}: {str(e)}")
         return None
 
+def render_graph_job(person, month, session_dir):
+    """Process pool job: render a person's graph and store it in the session directory"""
+    graph_base64 = generate_graph(person, month)
+    if graph_base64:
+        write_file_atomic(os.path.join(session_dir, f"{person['id_persona']}.b64"), graph_base64)
+    else:
+        write_file_atomic(os.path.join(session_dir, f"{person['id_persona']}.failed"), '')
+    return graph_base64 is not None
+
+def graph_job_done(future):
+    """Runs in the worker once a graph job has finished, failed or been cancelled"""
+    metrics.add_gauge('cdd_appreciation_graph_queue_depth', -1)
+
+@job_kind('appreciation_graphs', queue='graphs')
+def render_graphs(context, params):
+    """Job: render every person's graph into the session directory"""
+    session_dir = get_session_dir(params['session_id'])
+    executor = get_graph_executor()
+    futures = {}
+    for person in params['persons']:
+        metrics.add_gauge('cdd_appreciation_graph_queue_depth', 1)
+        future = executor.submit(render_graph_job, person, params['month'], session_dir)
+        future.add_done_callback(graph_job_done)
+        futures[future] = person['id_persona']
+    
+    pending = set(futures)
+    total = len(pending)
+    rendered = 0
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+            rendered += sum(1 for future in done if future.result())
+            context.progress({'current': total - len(pending), 'total': total})
+            context.check()
+    finally:
+        for future in pending:
+            future.cancel()
+        # On cancel, interrupt or crash, the readers must not wait for graphs nobody renders
+        for future, person_id in futures.items():
+            if future.cancelled() or not future.done() or future.exception() is not None:
+                mark_failed(session_dir, person_id)
+    return {'rendered': rendered, 'failed': total - rendered}
+
+def sse_event(event, data):
+    """Format a Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @appreciations_bp.route('/appreciations', methods=['GET'])
 def get_appreciations():
-    """ Get appreciations for all persons - returns data immediately without graphs """
+    """ Get appreciations for all persons - returns data immediately and renders graphs in background """
     if check_session() is False:
         return jsonify({'error': 'Unauthorized access'}), 401
     
     try:
         month = request.args.get('month')
+        if wants_series():
+            # Raw numbers only: no graph session, the client draws the charts
+            series = activities_dao.get_appreciations_series(month=month)
+            return jsonify(series_payload(
+                series['columns'],
+                persons=series['persons'],
+                activities=series['activities']
+            )), 200
+        
         appreciations = activities_dao.get_appreciations(month=month)
         
         # Generate a unique session ID for this request
         session_id = str(uuid.uuid4())
+        session_dir = get_session_dir(session_id)
         
         # Clean up old sessions periodically
         cleanup_old_sessions()
         
-        # Store session data for graph generation
+        # Queue the graphs right away; results land in the session directory
         graph_data = appreciations.get('appreciations', [])
-        session_data = {
-            'persons': graph_data,
-            'month': month,
-            'generated_graphs': {},
-            'next_index': 0
+        manifest = {
+            'persons': [person['id_persona'] for person in graph_data],
+            'month': month
         }
-        save_session_data(session_id, session_data)
+        save_manifest(session_dir, manifest)
+        job_id = enqueue('appreciation_graphs', {
+            'session_id': session_id,
+            'month': month,
+            'persons': graph_data
+        }, session.get('user_id'))
+        # Lets the readers tell a failed or cancelled job from a slow one
+        manifest['job_id'] = job_id
+        save_manifest(session_dir, manifest)
         
-        # Remove graph field from initial response and mark as not ready
+        # Graphs are delivered later by the stream/polling endpoints
         for person in graph_data:
             person['graph'] = None
             person['graph_ready'] = False
         
         # Add session_id to response
         appreciations['session_id'] = session_id
+        appreciations['job_id'] = job_id
         
         return jsonify(appreciations), 200
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@appreciations_bp.route('/appreciations/stream/<session_id>', methods=['GET'])
+def stream_graphs(session_id):
+    """ Stream graphs as Server-Sent Events as soon as they are rendered """
+    if check_session() is False:
+        return jsonify({'error': 'Unauthorized access'}), 401
+    
+    session_dir = get_session_dir(session_id)
+    manifest = load_manifest(session_dir)
+    if manifest is None:
+        return jsonify({'error': 'Session not found'}), 404
+    
+    def generate():
+        pending = list(manifest['persons'])
+        total = len(pending)
+        sent = 0
+        deadline = time.monotonic() + STREAM_MAX_DURATION
+        job_checked_at = time.monotonic()
+        yield "retry: 500\n\n"
+        
+        while pending and time.monotonic() < deadline:
+            still_pending = []
+            for person_id in pending:
+                finished, graph_base64 = read_graph(session_dir, person_id)
+                if not finished:
+                    still_pending.append(person_id)
+                    continue
+                sent += 1
+                progress = {'current': sent, 'total': total}
+                if graph_base64 is None:
+                    yield sse_event('graph_error', {'person_id': person_id, 'progress': progress})
+                else:
+                    yield sse_event('graph', {'person_id': person_id, 'graph': graph_base64, 'progress': progress})
+            if len(still_pending) == len(pending):
+                if time.monotonic() - job_checked_at >= JOB_CHECK_INTERVAL:
+                    job_checked_at = time.monotonic()
+                    failure = graph_job_failure(manifest)
+                    if failure:
+                        yield sse_event('failed', {'error': failure})
+                        return
+                time.sleep(GRAPH_POLL_INTERVAL)
+            pending = still_pending
+        
+        # Without 'done' the browser reconnects and receives the finished graphs again
+        if not pending:
+            yield sse_event('done', {'completed': True})
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # let nginx forward events immediately
+    })
+
 @appreciations_bp.route('/appreciations/next-graph/<session_id>', methods=['GET'])
 def get_next_graph(session_id):
-    """ Generate and return the next graph in the queue """
+    """ Return the next graph in the queue, waiting briefly for it to be rendered """
     if check_session() is False:
         return jsonify({'error': 'Unauthorized access'}), 401
     
     try:
-        session_data = load_session_data(session_id)
-        if session_data is None:
+        session_dir = get_session_dir(session_id)
+        manifest = load_manifest(session_dir)
+        if manifest is None:
             return jsonify({'error': 'Session not found'}), 404
         
-        persons = session_data['persons']
-        month = session_data['month']
-        next_index = session_data['next_index']
+        persons = manifest['persons']
+        next_index = read_next_index(session_dir)
         
-        # Check if there are more graphs to generate
+        # Check if there are more graphs to return
         if next_index >= len(persons):
             # Clean up session when complete
-            delete_session_data(session_id)
+            delete_session_data(session_dir)
             return jsonify({'completed': True}), 200
         
-        # Generate the next graph
-        person = persons[next_index]
-        graph_base64 = generate_graph(person, month)
+        person_id = persons[next_index]
+        progress = {'current': next_index + 1, 'total': len(persons)}
+        deadline = time.monotonic() + NEXT_GRAPH_MAX_WAIT
+        finished, graph_base64 = read_graph(session_dir, person_id)
+        while not finished and time.monotonic() < deadline:
+            time.sleep(GRAPH_POLL_INTERVAL)
+            finished, graph_base64 = read_graph(session_dir, person_id)
         
-        if graph_base64:
-            # Store the generated graph
-            session_data['generated_graphs'][str(person['id_persona'])] = graph_base64
-            session_data['next_index'] = next_index + 1
-            
-            # Check if this was the last graph
-            is_completed = next_index + 1 >= len(persons)
-            
-            # Save updated session data
-            if not is_completed:
-                save_session_data(session_id, session_data)
-            else:
-                # Clean up session when complete
-                delete_session_data(session_id)
-            
-            return jsonify({
-                'person_id': person['id_persona'],
-                'graph': graph_base64,
-                'completed': is_completed,
-                'progress': {
-                    'current': next_index + 1,
-                    'total': len(persons)
-                }
-            }), 200
-        else:
+        if not finished:
+            failure = graph_job_failure(manifest)
+            if failure:
+                # Completed: no other graph is coming
+                delete_session_data(session_dir)
+                return jsonify({'completed': True, 'error': failure}), 200
+            # Still rendering: the client simply asks again
+            return jsonify({'completed': False, 'progress': {'current': next_index, 'total': len(persons)}}), 200
+        
+        write_file_atomic(os.path.join(session_dir, 'next_index'), str(next_index + 1))
+        if graph_base64 is None:
             # Skip this person if graph generation failed
-            session_data['next_index'] = next_index + 1
-            save_session_data(session_id, session_data)
-            return jsonify({'error': f'Failed to generate graph for person {person["id_persona"]}'}), 500
+            return jsonify({'error': f'Failed to generate graph for person {person_id}'}), 500
+        
+        # Check if this was the last graph
+        is_completed = next_index + 1 >= len(persons)
+        if is_completed:
+            delete_session_data(session_dir)
+        
+        return jsonify({
+            'person_id': person_id,
+            'graph': graph_base64,
+            'completed': is_completed,
+            'progress': progress
+        }), 200
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -225,14 +368,13 @@ def get_person_graph(session_id, person_id):
         return jsonify({'error': 'Unauthorized access'}), 401
     
     try:
-        session_data = load_session_data(session_id)
-        if session_data is None:
+        session_dir = get_session_dir(session_id)
+        if load_manifest(session_dir) is None:
             return jsonify({'ready': False}), 200
         
-        generated_graphs = session_data['generated_graphs']
-        
-        if str(person_id) in generated_graphs:
-            return jsonify({'graph': generated_graphs[str(person_id)], 'ready': True}), 200
+        finished, graph_base64 = read_graph(session_dir, person_id)
+        if graph_base64 is not None:
+            return jsonify({'graph': graph_base64, 'ready': True}), 200
         else:
             return jsonify({'ready': False}), 200
     
@@ -246,11 +388,17 @@ def get_all_graphs_status(session_id):
         return jsonify({'error': 'Unauthorized access'}), 401
     
     try:
-        session_data = load_session_data(session_id)
-        if session_data is None:
+        session_dir = get_session_dir(session_id)
+        manifest = load_manifest(session_dir)
+        if manifest is None:
             return jsonify({'graphs': {}}), 200
         
-        return jsonify({'graphs': session_data['generated_graphs']}), 200
+        graphs = {}
+        for person_id in manifest['persons']:
+            _, graph_base64 = read_graph(session_dir, person_id)
+            if graph_base64 is not None:
+                graphs[str(person_id)] = graph_base64
+        return jsonify({'graphs': graphs}), 200
     
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
@@ -0,0 +1,79 @@
+"""
+Jobs servlet: state, progress, result files and cancellation of the background jobs
+"""
+
+from flask import Blueprint, request, jsonify, send_file, session, url_for
+from config.check_session import check_session
+from config.jobs import artifact_path, cancel_job, get_job, list_jobs
+
+jobs_bp = Blueprint('jobs', __name__)
+
+def find_job(job_id):
+    """The job with this id if the logged in user owns it (or is an admin)"""
+    job = get_job(job_id)
+    if job is None or (job['owner'] != session.get('user_id') and session.get('permissions', 0) < 10):
+        return None
+    for artifact in job['artifacts']:
+        artifact['url'] = url_for('jobs.download_artifact', job_id=job_id, name=artifact['name'])
+    return job
+
+@jobs_bp.route('/jobs', methods=['GET'])
+def get_jobs():
+    """The latest jobs of the logged in user, of everyone for admins"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    limit = request.args.get('limit', default=20, type=int)
+    owner = None if session.get('permissions', 0) >= 10 else session.get('user_id')
+
+    try:
+        return jsonify(list_jobs(owner, max(1, min(limit, 100)))), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@jobs_bp.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """State, progress, result and result files of a job"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    try:
+        job = find_job(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@jobs_bp.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel(job_id):
+    """Cancel a queued job, or ask a running one to stop"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    try:
+        job = find_job(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        if not job['cancellable']:
+            return jsonify({'error': f"A {job['state']} {job['kind']} job cannot be cancelled"}), 409
+        cancel_job(job_id)
+        return jsonify(find_job(job_id)), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@jobs_bp.route('/jobs/<int:job_id>/artifacts/<name>', methods=['GET'])
+def download_artifact(job_id, name):
+    """Download a result file of a job"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    try:
+        if find_job(job_id) is None:
+            return jsonify({'error': 'Job not found'}), 404
+        path = artifact_path(job_id, name)
+        if path is None:
+            return jsonify({'error': 'File not found'}), 404
+        return send_file(path, as_attachment=True, download_name=name, conditional=True)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
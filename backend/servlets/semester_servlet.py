@@ -4,10 +4,24 @@ Semester servlet, responsible for handling semester views changea
 
 from flask import Blueprint, request, jsonify, session
 from config.check_session import check_session
-from dao.semester_dao import semester_dao
+from config.jobs import enqueue, job_kind
+from dao.semester_dao import semester_dao, rollover_percent, rollover_tables, ROLLOVER_RUNNING
 
 semester_bp = Blueprint('semester', __name__)
 
+@job_kind('semester_rollover', cancellable=False)
+def run_rollover(context, params: dict) -> dict:
+    """Job: move the records of a rollover to its semester (resumable, so not cancellable)"""
+    def progress(tables):
+        context.progress({'percent': rollover_percent(rollover_tables(tables))})
+    if not semester_dao.run_rollover(params['rollover_id'], on_progress=progress):
+        raise Exception(f"semester rollover {params['rollover_id']} is running elsewhere")
+    return {'rollover_id': params['rollover_id']}
+
+def start_rollover(rollover_id: int) -> int:
+    """Queue the job of a rollover unless it is already queued or running, return its id"""
+    return enqueue('semester_rollover', {'rollover_id': rollover_id}, session.get('user_id'), key=str(rollover_id))
+
 @semester_bp.route('/semesters_list', methods=['GET'])
 def get_semesters():
     """Get all semesters"""
@@ -55,13 +69,31 @@ def reset_semester():
     
 @semester_bp.route('/new_semester', methods=['GET'])
 def new_semester():
-    """Create a new semester"""
+    """Create a new semester; the records move to it in the background (see /new_semester/status)"""
+    if check_session() is False:
+        return jsonify({'error': 'Unauthorized access'}), 401
+    
+    try:
+        job_id = start_rollover(semester_dao.begin_rollover())
+        return jsonify({**semester_dao.get_rollover(), 'job_id': job_id}), 202
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@semester_bp.route('/new_semester/status', methods=['GET'])
+def new_semester_status():
+    """Progress of the latest semester rollover, resuming it if it was interrupted"""
     if check_session() is False:
         return jsonify({'error': 'Unauthorized access'}), 401
     
     try:
-        semester_dao.create_new_semester()
-        return jsonify({'message': 'New semester created successfully'}), 200
+        rollover = semester_dao.get_rollover()
+        if rollover is None:
+            return jsonify({'error': 'No semester rollover found'}), 404
+        if rollover['state'] == ROLLOVER_RUNNING and not rollover['active']:
+            # Queued, or interrupted: either way its job is queued once
+            rollover['job_id'] = start_rollover(rollover['id'])
+        return jsonify(rollover), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
\ No newline at end of file
@@ -0,0 +1,78 @@
+"""
+Stats servlet: query timings, the slow-query log and the query cache hit rates for admin users,
+Prometheus metrics for a scraper on the Pi itself
+"""
+
+from flask import Blueprint, Response, jsonify, request, session
+from config.check_session import check_session
+from config.metrics import exposition, metrics
+from config.query_cache import collected_stats
+from config.query_stats import query_stats
+
+stats_bp = Blueprint('stats', __name__)
+
+QUERY_ORDERS = ('total_ms', 'count', 'mean_ms', 'max_ms', 'rows')
+
+@stats_bp.route('/query_stats', methods=['GET'])
+def get_query_stats():
+    """Top-N queries over all workers, by total time unless ?order= says otherwise"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    if session.get('permissions', 0) < 10:
+        return jsonify({'error': 'Insufficient permissions'}), 403
+
+    top = request.args.get('top', default=20, type=int)
+    order = request.args.get('order', default='total_ms')
+    if order not in QUERY_ORDERS:
+        return jsonify({'error': f"order must be one of {', '.join(QUERY_ORDERS)}"}), 400
+
+    try:
+        return jsonify(query_stats.top(max(1, top), order)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@stats_bp.route('/query_stats/slow', methods=['GET'])
+def get_slow_queries():
+    """The latest slow queries with their EXPLAIN plans, newest first"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    if session.get('permissions', 0) < 10:
+        return jsonify({'error': 'Insufficient permissions'}), 403
+
+    limit = request.args.get('limit', default=50, type=int)
+
+    try:
+        return jsonify({
+            'slow_ms': query_stats.slow_ms,
+            'queries': query_stats.slow_queries(max(1, limit))
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@stats_bp.route('/query_cache', methods=['GET'])
+def get_query_cache_stats():
+    """Query cache hits, misses and hit rates over all workers, per DAO method"""
+    if not check_session():
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    if session.get('permissions', 0) < 10:
+        return jsonify({'error': 'Insufficient permissions'}), 403
+
+    try:
+        return jsonify(collected_stats(metrics.collect())), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@stats_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text format, summed over every gunicorn worker"""
+    # Only for a local Prometheus scraping gunicorn directly: nginx sets these headers
+    if 'X-Forwarded-For' in request.headers or 'X-Real-IP' in request.headers:
+        return jsonify({'error': 'Not found'}), 404
+
+    try:
+        return Response(exposition(metrics.collect()), mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
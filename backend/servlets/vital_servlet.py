@@ -1,18 +1,38 @@
 from flask import Blueprint, request, jsonify, session
 from dao.vital_dao import vital_dao
 from config.check_session import check_session
+from charts.downsample import downsample_columns, downsample_points
+from charts.series import series_payload, wants_series
+from charts.rendering import render_vitals
+from charts.responses import Chart, plot_url, png_response, wants_embedded_plot
 from datetime import datetime
-import io
-import base64
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-
-matplotlib.use('Agg')
 
 vital_bp = Blueprint('vital', __name__)
 
 
+def build_vitals_chart(vitals) -> Chart:
+    """ Extract the plotted series from vital entries """
+    dates = []
+    min_pressures = []
+    max_pressures = []
+
+    for vital in vitals:
+        try:
+            date_obj = datetime.strptime(vital['date'], '%Y-%m-%d')
+            dates.append(date_obj)
+            min_pressures.append(float(vital['min_pressure']))
+            max_pressures.append(float(vital['max_pressure']))
+        except (ValueError, KeyError):
+            continue
+
+    dates, min_pressures, max_pressures = downsample_points(dates, min_pressures, max_pressures)
+
+    return Chart(
+        'vitals',
+        {'dates': dates, 'min_pressures': min_pressures, 'max_pressures': max_pressures},
+        lambda: render_vitals(dates, min_pressures, max_pressures)
+    )
+
 @vital_bp.route('/vitals', methods=['GET'])
 def get_vitals():
     """ Get vital entries for a specific person """
@@ -26,62 +46,44 @@ def get_vitals():
     
     try:
 
-        vitals = vital_dao.get_vital_measurements(person_id)
+        if wants_series():
+            columns = vital_dao.get_vital_series(person_id)
+            return jsonify(series_payload(downsample_columns(columns), source_length=len(columns['date']))), 200
 
-        # Extract dates and values for plotting
-        dates = []
-        min_pressures = []
-        max_pressures = []
-
-        for vital in vitals:
-            try:
-                date_obj = datetime.strptime(vital['date'], '%Y-%m-%d')
-                dates.append(date_obj)
-                min_pressures.append(float(vital['min_pressure']))
-                max_pressures.append(float(vital['max_pressure']))
-            except (ValueError, KeyError):
-                continue
-
-        # Create the plot
-        plt.figure(figsize=(10, 6))
-        plt.plot(dates, max_pressures, marker='s', label='Massima', linewidth=2, color='#60A5FA')
-        plt.plot(dates, min_pressures, marker='o', label='Minima', linewidth=2, color='#005073')
-
-        plt.xlabel('Data')
-        plt.ylabel('Valore (mmHg)')
-        plt.legend()
-        plt.grid(True, alpha=0.3)
-        # plt.gca().yaxis.set_major_locator(plt.MaxNLocator(integer=True))
-        
-        # # Set transparent background
-        # plt.gca().patch.set_alpha(0.5)
-        # plt.gcf().patch.set_alpha(0.5)
-
-        # Format x-axis dates
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-        # plt.gca().xaxis.set_major_locator(mdates.MonthLocator())
-        plt.xticks(rotation=45)
-
-        plt.tight_layout()
-
-        # Convert plot to base64 string
-        img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='png')
-        img_buffer.seek(0)
-        plot_image = base64.b64encode(img_buffer.getvalue()).decode()
-        plt.close()
+        vitals = vital_dao.get_vital_measurements(person_id)
+        chart = build_vitals_chart(vitals)
 
         # Add plot to response
         vital_response = {
             'vitals': vitals,
-            'plot_image': plot_image
+            'plot_url': plot_url('vital.get_vitals_plot', chart, person_id=person_id)
         }
+        if wants_embedded_plot():
+            vital_response['plot_image'] = chart.base64()
 
         return jsonify(vital_response), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@vital_bp.route('/vitals/plot.png', methods=['GET'])
+def get_vitals_plot():
+    """ Get the blood pressure chart of a specific person as a PNG image """
+    person_id = request.args.get('person_id', type=int)
+    
+    if check_session() is False:
+        return jsonify({'error': 'Unauthorized access'}), 401
+    
+    if not person_id:
+        return jsonify({'error': 'Missing or invalid person_id'}), 400
+    
+    try:
+        vitals = vital_dao.get_vital_measurements(person_id)
+        return png_response(build_vitals_chart(vitals))
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @vital_bp.route('/new_vital', methods=['POST'])
 def create_vital_entry():
     """ Create a new vital entry """
@@ -1,18 +1,36 @@
 from flask import Blueprint, request, jsonify, session
 from dao.weight_dao import weight_dao
 from config.check_session import check_session
+from charts.downsample import downsample_columns, downsample_points
+from charts.series import series_payload, wants_series
+from charts.rendering import render_weight
+from charts.responses import Chart, plot_url, png_response, wants_embedded_plot
 from datetime import datetime
-import io
-import base64
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-
-matplotlib.use('Agg')
 
 weight_bp = Blueprint('weight', __name__)
 
 
+def build_weight_chart(weights) -> Chart:
+    """ Extract the plotted series from weight entries """
+    dates = []
+    measurements = []
+
+    for weight in weights:
+        try:
+            date_obj = datetime.strptime(weight['date'], '%Y-%m-%d')
+            dates.append(date_obj)
+            measurements.append(float(weight['weight']))
+        except (ValueError, KeyError):
+            continue
+
+    dates, measurements = downsample_points(dates, measurements)
+
+    return Chart(
+        'weight',
+        {'dates': dates, 'measurements': measurements},
+        lambda: render_weight(dates, measurements)
+    )
+
 @weight_bp.route('/weights', methods=['GET'])
 def get_weights():
     """ Get weight entries for a specific person """
@@ -26,59 +44,44 @@ def get_weights():
     
     try:
 
-        weights = weight_dao.get_weight_measurements(person_id)
+        if wants_series():
+            columns = weight_dao.get_weight_series(person_id)
+            return jsonify(series_payload(downsample_columns(columns), source_length=len(columns['date']))), 200
 
-        # Extract dates and values for plotting
-        dates = []
-        measurements = []
-
-        for weight in weights:
-            try:
-                date_obj = datetime.strptime(weight['date'], '%Y-%m-%d')
-                dates.append(date_obj)
-                measurements.append(float(weight['weight']))
-            except (ValueError, KeyError):
-                continue
-
-        # Create the plot
-        plt.figure(figsize=(10, 6))
-        plt.plot(dates, measurements, marker='o', label='Peso', linewidth=2, color='#005073')
-
-        plt.xlabel('Data')
-        plt.ylabel('Peso (kg)')
-        plt.legend()
-        plt.grid(True, alpha=0.3)
-        # plt.gca().yaxis.set_major_locator(plt.MaxNLocator(integer=True))
-        
-        # # Set transparent background
-        # plt.gca().patch.set_alpha(0.5)
-        # plt.gcf().patch.set_alpha(0.5)
-
-        # Format x-axis dates
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-        # plt.gca().xaxis.set_major_locator(mdates.MonthLocator())
-        plt.xticks(rotation=45)
-
-        plt.tight_layout()
-
-        # Convert plot to base64 string
-        img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='png')
-        img_buffer.seek(0)
-        plot_image = base64.b64encode(img_buffer.getvalue()).decode()
-        plt.close()
+        weights = weight_dao.get_weight_measurements(person_id)
+        chart = build_weight_chart(weights)
 
         # Add plot to response
         weight_response = {
             'weights': weights,
-            'plot_image': plot_image
+            'plot_url': plot_url('weight.get_weight_plot', chart, person_id=person_id)
         }
+        if wants_embedded_plot():
+            weight_response['plot_image'] = chart.base64()
 
         return jsonify(weight_response), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@weight_bp.route('/weights/plot.png', methods=['GET'])
+def get_weight_plot():
+    """ Get the weight chart of a specific person as a PNG image """
+    person_id = request.args.get('person_id', type=int)
+    
+    if check_session() is False:
+        return jsonify({'error': 'Unauthorized access'}), 401
+    
+    if not person_id:
+        return jsonify({'error': 'Missing or invalid person_id'}), 400
+    
+    try:
+        weights = weight_dao.get_weight_measurements(person_id)
+        return png_response(build_weight_chart(weights))
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @weight_bp.route('/new_weight', methods=['POST'])
 def create_weight_entry():
     """ Create a new weight entry """
@@ -0,0 +1,71 @@
+"""
+Background job worker, run next to gunicorn by cdd-legrigne-worker.service
+
+Takes the jobs the web workers queue (config.jobs), one thread per queue.
+Every HEARTBEAT_INTERVAL it also queues again the jobs of a worker that
+died, and now and then removes old jobs. On SIGTERM it stops taking jobs
+and asks the running ones to stop at their next check: they are queued
+again and resumed by the next start. Usage (from the backend directory):
+
+    python worker.py
+"""
+import os
+import signal
+import threading
+import time
+
+from config import jobs
+from config.database import db_config
+from main import app  # noqa: F401 - importing the app registers every job kind
+
+POLL_INTERVAL = float(os.environ.get('JOBS_POLL_INTERVAL', 0.5))  # seconds between looks at an empty queue
+POOL_SIZE = int(os.environ.get('JOBS_POOL_SIZE', 8))  # job connections plus the ones the jobs open themselves
+CLEANUP_INTERVAL = 3600
+STOP_TIMEOUT = 50  # systemd kills the worker after TimeoutStopSec=60
+
+def run_queue(queue: str, worker: str, stopping: threading.Event) -> None:
+    while not stopping.is_set():
+        try:
+            job = jobs.claim(worker, queue=queue)
+        except Exception as e:
+            print(f"Error taking a job from the {queue} queue: {e}")
+            job = None
+        if job is None:
+            stopping.wait(POLL_INTERVAL)
+            continue
+        jobs.run_job(job, worker, stopping)
+
+def run() -> None:
+    db_config.pool.max_size = POOL_SIZE
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    worker = jobs.worker_name()
+    threads = [
+        threading.Thread(target=run_queue, args=(queue, f"{worker}:{queue}", stopping), name=f"jobs-{queue}")
+        for queue in jobs.queues()
+    ]
+    print(f"Job worker {worker}: queues {', '.join(jobs.queues())}")
+    for thread in threads:
+        thread.start()
+
+    cleaned_at = 0.0
+    while not stopping.is_set():
+        try:
+            for job_id in jobs.requeue_interrupted():
+                print(f"Job {job_id}: its worker died, queued again")
+            if time.monotonic() - cleaned_at > CLEANUP_INTERVAL:
+                jobs.cleanup_old_jobs()
+                cleaned_at = time.monotonic()
+        except Exception as e:
+            print(f"Error checking the running jobs: {e}")
+        stopping.wait(jobs.HEARTBEAT_INTERVAL)
+
+    print(f"Job worker {worker}: stopping")
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+
+if __name__ == '__main__':
+    run()
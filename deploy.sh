@@ -16,6 +16,7 @@ APP_DIR="/home/elia"
 BACKEND_DIR="$APP_DIR/backend"
 BUILD_DIR="$APP_DIR/frontend"
 SERVICE_NAME="cdd-legrigne"
+WORKER_SERVICE_NAME="cdd-legrigne-worker"
 DEV_DIR="/mnt/Shared/Elia/Documenti/Codici/cdd_legrigne"
 
 # Create necessary directories
@@ -47,6 +48,15 @@ else
     pip install -r requirements.txt
 fi
 
+# Bring the schema up to date before the new code starts serving
+echo "Applying database migrations..."
+cd $BACKEND_DIR
+venv/bin/python -m config.migrations apply || { echo "Migrations failed: the services were not restarted"; exit 1; }
+
+# Create/refresh the appreciation summary table used by /appreciations, checked against the grad view
+echo "Rebuilding appreciation summary table..."
+venv/bin/python -m dao.appreciations_summary_dao rebuild || { echo "The appreciation summary differs from grad: the services were not restarted"; exit 1; }
+
 # Set correct permissions
 echo "Setting permissions..."
 chown -R elia:elia $BACKEND_DIR
@@ -57,8 +67,10 @@ chown -R elia:elia $BUILD_DIR
 # Install and configure systemd service
 echo "Installing systemd service..."
 cp $BACKEND_DIR/cdd-legrigne.service /etc/systemd/system/
+cp $BACKEND_DIR/cdd-legrigne-worker.service /etc/systemd/system/
 systemctl daemon-reload
 systemctl enable $SERVICE_NAME
+systemctl enable $WORKER_SERVICE_NAME
 
 # Install nginx configuration
 echo "Installing nginx configuration..."
@@ -84,8 +96,15 @@ fi
 # Start services
 echo "Starting services..."
 systemctl restart $SERVICE_NAME
+systemctl restart $WORKER_SERVICE_NAME
 systemctl restart nginx
 
+# The summary was rebuilt while the previous code, which may not maintain it, was serving:
+# rebuild it again for the appreciations written since
+echo "Rebuilding appreciation summary table with the new code live..."
+cd $BACKEND_DIR
+venv/bin/python -m dao.appreciations_summary_dao rebuild || echo "✗ Appreciation summary rebuild failed"
+
 # Check service status
 echo "Checking service status..."
 if systemctl is-active --quiet $SERVICE_NAME; then
@@ -95,6 +114,13 @@ else
     systemctl status $SERVICE_NAME
 fi
 
+if systemctl is-active --quiet $WORKER_SERVICE_NAME; then
+    echo "✓ Job worker service is running"
+else
+    echo "✗ Job worker service failed to start"
+    systemctl status $WORKER_SERVICE_NAME
+fi
+
 if systemctl is-active --quiet nginx; then
     echo "✓ Nginx service is running"
 else
@@ -107,6 +133,7 @@ echo "Your application should be available at http://192.168.1.101"
 echo ""
 echo "Useful commands:"
 echo "  Check gunicorn logs: sudo journalctl -u $SERVICE_NAME -f"
+echo "  Check job worker logs: sudo journalctl -u $WORKER_SERVICE_NAME -f"
 echo "  Check nginx logs: sudo tail -f /var/log/nginx/error.log"
 echo "  Restart gunicorn: sudo systemctl restart $SERVICE_NAME"
 echo "  Restart nginx: sudo systemctl restart nginx"
@@ -20,8 +20,8 @@ const BackupDatabaseForm: React.FC = () => {
       )) as any;
 
       if (response.status === 200) {
-        // Create a blob from the response data
-        const blob = new Blob([response.data.sql], { type: "application/sql" });
+        // Download the compressed dump, resuming if the connection drops
+        const blob = await apiService.downloadBackup(response.data.download_url);
 
         // Create a download link
         const url = window.URL.createObjectURL(blob);
@@ -29,7 +29,7 @@ const BackupDatabaseForm: React.FC = () => {
         link.href = url;
         link.download = `database_monitoraggi_backup_${
           new Date().toISOString().split("T")[0]
-        }.sql`;
+        }.sql.gz`;
 
         // Trigger download
         document.body.appendChild(link);
@@ -14,6 +14,7 @@ import NewActivityForm from "../components/forms/NewActivity";
 import "../styles/activities.css";
 import { useSemester } from "../contexts/SemesterContext";
 import apiService from "../services/apiService";
+import { API_CONFIG } from "../config/api";
 import { MdNotInterested } from "react-icons/md";
 import MonthSelector from "../components/MonthSelector";
 
@@ -54,7 +55,7 @@ const Activities: React.FC = () => {
         const data = response.data as any;
         const retr_activities = data.activities as Activity[];
         setActivities(retr_activities);
-        setGraph(data.plot_image);
+        setGraph(API_CONFIG.getUrl(data.plot_url));
 
         const lastActivity = retr_activities[0];
         if (!lastActivity) {
@@ -383,7 +384,7 @@ const Activities: React.FC = () => {
         ) : (
           <div className="activities-graph-container">
             <img
-              src={`data:image/png;base64,${graph}`}
+              src={graph}
               alt="Activities Graph"
             />
             <div className="legend">
@@ -1,4 +1,4 @@
-import React, { Fragment, useEffect, useState, useCallback } from "react";
+import React, { Fragment, useEffect, useState, useCallback, useRef } from "react";
 import { useNavigate } from "react-router-dom";
 import { usePlace } from "../contexts/PlaceContext";
 import { useUser } from "../contexts/UserContext";
@@ -97,6 +97,9 @@ const Appreciations: React.FC = () => {
   const [graphsLoading, setGraphsLoading] = useState<Set<number>>(new Set());
   const [graphProgress, setGraphProgress] = useState<{ current: number, total: number } | null>(null);
   const [isGeneratingGraphs, setIsGeneratingGraphs] = useState<boolean>(false);
+  const graphStreamRef = useRef<EventSource | null>(null);
+  // Session whose graphs are being polled for; a new month stops the previous loop
+  const graphSessionRef = useRef<string | null>(null);
 
   const fetchAppreciations = useCallback(
     async (month?: number | null): Promise<void> => {
@@ -128,7 +131,7 @@ const Appreciations: React.FC = () => {
             const loadingSet = new Set(data.appreciations.map(p => p.id_persona));
             setGraphsLoading(loadingSet);
             setGraphProgress({ current: 0, total: data.appreciations.length });
-            startSequentialGraphGeneration(data.session_id);
+            startGraphStream(data.session_id);
           }
         }
       } finally {
@@ -138,13 +141,91 @@ const Appreciations: React.FC = () => {
     [navigate]
   );
 
+  const closeGraphStream = () => {
+    graphStreamRef.current?.close();
+    graphStreamRef.current = null;
+    graphSessionRef.current = null;
+  };
+
+  const applyGraph = (personId: number, graph: string) => {
+    setAppreciations(prev =>
+      prev.map(appreciation =>
+        appreciation.id_persona === personId
+          ? { ...appreciation, graph, graph_ready: true }
+          : appreciation
+      )
+    );
+    setGraphsLoading(prev => {
+      const newSet = new Set(prev);
+      newSet.delete(personId);
+      return newSet;
+    });
+  };
+
+  // Receive graphs as Server-Sent Events while the server renders them in parallel,
+  // falling back to one request per graph if the stream cannot be opened
+  const startGraphStream = (sessionId: string) => {
+    closeGraphStream();
+    if (typeof EventSource === "undefined") {
+      startSequentialGraphGeneration(sessionId);
+      return;
+    }
+
+    setIsGeneratingGraphs(true);
+    const source = apiService.openGraphStream(sessionId);
+    graphStreamRef.current = source;
+    let received = false;
+
+    const finish = () => {
+      closeGraphStream();
+      setIsGeneratingGraphs(false);
+      setGraphsLoading(new Set());
+      setGraphProgress(null);
+    };
+
+    source.addEventListener("graph", (event) => {
+      received = true;
+      const graphResponse = JSON.parse((event as MessageEvent).data) as NextGraphResponse;
+      if (graphResponse.person_id && graphResponse.graph) {
+        applyGraph(graphResponse.person_id, graphResponse.graph);
+      }
+      if (graphResponse.progress) {
+        setGraphProgress(graphResponse.progress);
+      }
+    });
+    source.addEventListener("graph_error", (event) => {
+      received = true;
+      const graphResponse = JSON.parse((event as MessageEvent).data) as NextGraphResponse;
+      console.error("Failed to generate graph for person", graphResponse.person_id);
+      if (graphResponse.progress) {
+        setGraphProgress(graphResponse.progress);
+      }
+    });
+    source.addEventListener("done", finish);
+    source.addEventListener("failed", (event) => {
+      console.error("Graph rendering stopped:", JSON.parse((event as MessageEvent).data).error);
+      finish();
+    });
+    source.onerror = () => {
+      // Reconnection is automatic once the stream has worked
+      if (!received) {
+        closeGraphStream();
+        startSequentialGraphGeneration(sessionId);
+      }
+    };
+  };
+
   const startSequentialGraphGeneration = useCallback(
     async (sessionId: string) => {
+      graphSessionRef.current = sessionId;
       setIsGeneratingGraphs(true);
 
       try {
-        while (true) {
+        while (graphSessionRef.current === sessionId) {
           const response = await apiService.fetchNextGraph(sessionId);
+          if (graphSessionRef.current !== sessionId) {
+            break;
+          }
 
           if (response.error) {
             console.error("Error fetching next graph:", response.error);
@@ -156,25 +237,7 @@ const Appreciations: React.FC = () => {
           // Process the graph data if available
           if (graphResponse.person_id && graphResponse.graph) {
             // Update the specific person's graph
-            setAppreciations(prev =>
-              prev.map(appreciation => {
-                if (appreciation.id_persona === graphResponse.person_id) {
-                  return {
-                    ...appreciation,
-                    graph: graphResponse.graph!,
-                    graph_ready: true
-                  };
-                }
-                return appreciation;
-              })
-            );
-
-            // Update loading set and progress
-            setGraphsLoading(prev => {
-              const newSet = new Set(prev);
-              newSet.delete(graphResponse.person_id!);
-              return newSet;
-            });
+            applyGraph(graphResponse.person_id, graphResponse.graph);
 
             if (graphResponse.progress) {
               setGraphProgress(graphResponse.progress);
@@ -183,7 +246,10 @@ const Appreciations: React.FC = () => {
 
           // Check for completion AFTER processing the graph
           if (graphResponse.completed) {
-            // All graphs are completed
+            // All graphs are completed, or the graph job stopped
+            if (graphResponse.error) {
+              console.error("Graph rendering stopped:", graphResponse.error);
+            }
             setIsGeneratingGraphs(false);
             setGraphsLoading(new Set());
             setGraphProgress(null);
@@ -201,12 +267,14 @@ const Appreciations: React.FC = () => {
   // Cleanup when component unmounts
   useEffect(() => {
     return () => {
+      closeGraphStream();
       setIsGeneratingGraphs(false);
     };
   }, []);
 
   const handleMonthChange = (month: number | null) => {
     // Stop any ongoing graph generation
+    closeGraphStream();
     setIsGeneratingGraphs(false);
 
     // Reset state
@@ -24,6 +24,16 @@ interface Person {
   }[];
 }
 
+interface SemesterRollover {
+  id: number;
+  semester_id: number;
+  state: "running" | "done" | "failed";
+  error: string | null;
+  percent: number;
+}
+
+const ROLLOVER_POLL_MS = 2000;
+
 const MainPage: React.FC = () => {
   const fetchPersons = async (): Promise<void> => {
     const response = await apiService.fetchPersons();
@@ -63,10 +73,26 @@ const MainPage: React.FC = () => {
       return;
     }
 
-    if (response.data) {
-      console.log("New semester created successfully:", response.data);
+    // The records move to the new semester in the background: wait for it
+    let rollover = response.data as SemesterRollover | undefined;
+    while (rollover && rollover.state === "running") {
+      await new Promise((resolve) => setTimeout(resolve, ROLLOVER_POLL_MS));
+      const status = await apiService.newSemesterStatus();
+      if (status.error) {
+        console.error("API call failed:", status.error);
+        return;
+      }
+      rollover = status.data as SemesterRollover;
+      console.log(`Semester rollover: ${rollover.percent}%`);
+    }
+
+    if (rollover && rollover.state === "failed") {
+      console.error("Semester rollover failed:", rollover.error);
+      alert("Semester rollover failed: " + rollover.error);
+      return;
     }
 
+    console.log("New semester created successfully:", rollover);
     window.location.reload();
   };
 
@@ -9,6 +9,7 @@ import { useUser } from "../contexts/UserContext";
 import { usePlace } from "../contexts/PlaceContext";
 import { useSemester } from "../contexts/SemesterContext";
 import apiService from "../services/apiService";
+import { API_CONFIG } from "../config/api";
 import { MdNotInterested } from "react-icons/md";
 import NewVitalForm from "../components/forms/NewVital";
 import { ImStatsBars } from "react-icons/im";
@@ -44,7 +45,7 @@ const Vital: React.FC = () => {
     if (response.data) {
       const data = response.data as any
       setVitals(data.vitals as VitalEntry[]);
-      setGraph(data.plot_image as any);
+      setGraph(API_CONFIG.getUrl(data.plot_url));
     }
     setIsLoading(false);
   };
@@ -254,7 +255,7 @@ const Vital: React.FC = () => {
             )}
           </tbody>
         </table>) :
-          (<img className="pressure-graph" src={`data:image/png;base64,${graph}`} alt="Vital Graph" />)}
+          (<img className="pressure-graph" src={graph} alt="Vital Graph" />)}
         {formIsShown && (
           <GenericForm
             title={editingVital ? "Modifica peso" : "Nuova registrazione"}
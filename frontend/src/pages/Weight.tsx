@@ -9,6 +9,7 @@ import { useUser } from "../contexts/UserContext";
 import { usePlace } from "../contexts/PlaceContext";
 import { useSemester } from "../contexts/SemesterContext";
 import apiService from "../services/apiService";
+import { API_CONFIG } from "../config/api";
 import { MdNotInterested } from "react-icons/md";
 import NewWeightForm from "../components/forms/NewWeight";
 
@@ -39,7 +40,7 @@ const Weight: React.FC = () => {
     if (response.data) {
       const data = response.data as any
       setWeights(data.weights as WeightEntry[]);
-      setGraph(data.plot_image as any);
+      setGraph(API_CONFIG.getUrl(data.plot_url));
     }
     setIsLoading(false);
   };
@@ -233,7 +234,7 @@ const Weight: React.FC = () => {
             )}
           </tbody>
         </table>
-        <img className="always-visible-graph" src={`data:image/png;base64,${graph}`} alt="Weight Graph" />
+        <img className="always-visible-graph" src={graph} alt="Weight Graph" />
         {formIsShown && (
           <GenericForm
             title={editingWeight ? "Modifica peso" : "Nuova registrazione"}
@@ -142,6 +142,12 @@ class ApiService {
     return this.get(`/appreciations${queryString}`);
   }
 
+  openGraphStream(sessionId: string): EventSource {
+    return new EventSource(API_CONFIG.getUrl(`/appreciations/stream/${sessionId}`), {
+      withCredentials: true,
+    });
+  }
+
   async fetchNextGraph(sessionId: string) {
     return this.get(`/appreciations/next-graph/${sessionId}`);
   }
@@ -218,10 +224,64 @@ class ApiService {
     return this.get('/new_semester');
   }
 
+  async newSemesterStatus() {
+    return this.get('/new_semester/status');
+  }
+
   async backupDatabase(password: string) {
     return this.post('/backup_database', { password });
   }
 
+  /**
+   * Download a backup (gzip-compressed SQL) registered by backupDatabase.
+   * The server streams it while dumping, a few seconds per request; the
+   * download resumes from the bytes already received until it is complete.
+   * Only requests that bring nothing new count towards maxAttempts.
+   */
+  async downloadBackup(downloadUrl: string, maxAttempts = 20): Promise<Blob> {
+    const parts: Uint8Array[] = [];
+    let received = 0;
+
+    for (let attempt = 0; attempt < maxAttempts; attempt++) {
+      const before = received;
+      try {
+        const response = await fetch(
+          API_CONFIG.getUrl(`${downloadUrl}?offset=${received}`),
+          { credentials: 'include' }
+        );
+        if (!response.ok || !response.body) {
+          throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const reader = response.body.getReader();
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          parts.push(value);
+          received += value.length;
+        }
+      } catch (error) {
+        console.warn('Backup download interrupted, resuming:', error);
+      }
+
+      const status = await this.get<{ size: number; complete: boolean; error: string | null }>(
+        `${downloadUrl}/status`
+      );
+      if (status.status !== 200 || !status.data) {
+        throw new Error(status.error || 'Backup not available');
+      }
+      if (status.data.error) {
+        throw new Error(status.data.error);
+      }
+      if (status.data.complete && received >= status.data.size) {
+        return new Blob(parts, { type: 'application/gzip' });
+      }
+      if (received > before) {
+        attempt = -1;
+      }
+    }
+    throw new Error('Backup download failed after several attempts');
+  }
+
   async fetchToiletRecords(params?: any) {
     const queryString = params ? `?${new URLSearchParams(params).toString()}` : '';
     return this.get(`/toilet${queryString}`);
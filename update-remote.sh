@@ -49,7 +49,17 @@ ssh ${REMOTE_USER}@${REMOTE_HOST} "find ${REMOTE_BACKEND_DIR} -type d -name '__p
 echo "📂 Copying backend to server..."
 rsync -av --exclude='__pycache__' backend/ ${REMOTE_USER}@${REMOTE_HOST}:${REMOTE_BACKEND_DIR}/
 
-# 5. Restart services on server
+# 5. Bring dependencies and the schema up to date before the new code starts serving (as deploy.sh does)
+echo "🗄️ Updating packages, applying database migrations and rebuilding the appreciation summary..."
+ssh ${REMOTE_USER}@${REMOTE_HOST} "
+  set -e
+  cd ${REMOTE_BACKEND_DIR}
+  venv/bin/pip install -r requirements.txt
+  venv/bin/python -m config.migrations apply
+  venv/bin/python -m dao.appreciations_summary_dao rebuild
+"
+
+# 6. Restart services on server
 echo "🔄 Restarting server services..."
 ssh ${REMOTE_USER}@${REMOTE_HOST} "
   # Restart backend service first
@@ -60,8 +70,26 @@ ssh ${REMOTE_USER}@${REMOTE_HOST} "
     echo '⚠️ Gunicorn is not running on service cdd-legrigne!'
   fi
   
-  # Then restart nginx to ensure proper proxy configuration
-  if systemctl is-active --quiet nginx; then
+  # The job worker runs the same code: install its unit (a Pi set up before it existed
+  # has none, and every job would stay queued) and (re)start it, as deploy.sh does
+  echo 'Installing and restarting the job worker...'
+  sudo cp ${REMOTE_BACKEND_DIR}/cdd-legrigne-worker.service /etc/systemd/system/
+  sudo systemctl daemon-reload
+  sudo systemctl enable --now cdd-legrigne-worker
+  sudo systemctl restart cdd-legrigne-worker
+  if ! systemctl is-active --quiet cdd-legrigne-worker; then
+    echo '⚠️ The job worker failed to start on service cdd-legrigne-worker!'
+    sudo systemctl status cdd-legrigne-worker --no-pager
+  fi
+  
+  # Then install the site configuration (upload limits, proxy timeouts) and restart nginx,
+  # keeping the running configuration if the new one does not pass nginx -t
+  sudo cp /etc/nginx/sites-available/cdd-legrigne /etc/nginx/sites-available/cdd-legrigne.previous
+  sudo cp ${REMOTE_BACKEND_DIR}/nginx-site.conf /etc/nginx/sites-available/cdd-legrigne
+  if ! sudo nginx -t; then
+    echo '⚠️ The nginx configuration is invalid, keeping the previous one!'
+    sudo mv /etc/nginx/sites-available/cdd-legrigne.previous /etc/nginx/sites-available/cdd-legrigne
+  elif systemctl is-active --quiet nginx; then
     echo 'Restarting nginx (reverse proxy)...'
     sudo systemctl restart nginx
   else
@@ -69,6 +97,11 @@ ssh ${REMOTE_USER}@${REMOTE_HOST} "
   fi
 "
 
+# 7. The old code did not maintain the summary: rebuild it again now that the new one does,
+# for the appreciations written between step 5 and the restart
+echo "🗄️ Rebuilding the appreciation summary with the new code live..."
+ssh ${REMOTE_USER}@${REMOTE_HOST} "cd ${REMOTE_BACKEND_DIR} && venv/bin/python -m dao.appreciations_summary_dao rebuild"
+
 echo "✅ Deployment complete!"
 
 echo "🌐 Running curl to make it re-generate __pycache__ folders..."